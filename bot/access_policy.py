@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import logging
+
+# Mapping of budget period to cost period
+BUDGET_COST_MAP = {
+    "monthly": "cost_month",
+    "daily": "cost_today",
+    "all-time": "cost_all_time"
+}
+
+
+def _user_ids_by_position(user_ids: str) -> list[int | None]:
+    """
+    Returns the user id at each position of a comma-separated list, None for blank or invalid entries.
+    Positions matter, as budgets are matched to users by position.
+    """
+    return [int(user_id) if user_id.strip().isdigit() else None for user_id in user_ids.split(',')]
+
+
+def _parse_user_ids(user_ids: str) -> list[int]:
+    return [user_id for user_id in _user_ids_by_position(user_ids) if user_id is not None]
+
+
+class AccessPolicy:
+    """
+    Who can use the bot and with which budget, compiled once from the bot configuration.
+    """
+
+    def __init__(self, config: dict):
+        """
+        Compiles the policy.
+        :param config: A dictionary containing the bot configuration
+        """
+        self.allow_all = config['allowed_user_ids'] == '*'
+        self.admin_ids = frozenset(_parse_user_ids(config['admin_user_ids']))
+        allowed_ids = [] if self.allow_all else _parse_user_ids(config['allowed_user_ids'])
+        self.allowed_ids = frozenset(allowed_ids)
+        # Users whose membership authorizes a group chat
+        self.group_member_ids = list(dict.fromkeys(allowed_ids + list(self.admin_ids)))
+
+        self.budget_period = config['budget_period']
+        self.guest_budget = config['guest_budget']
+        self.unlimited_budgets = config['user_budgets'] == '*'
+        self.default_budget = None
+        self.user_budgets = {}  # {user_id: budget}
+        if not self.unlimited_budgets:
+            user_budgets = config['user_budgets'].split(',')
+            if self.allow_all:
+                # same budget for all users, use value in first position of budget list
+                if len(user_budgets) > 1:
+                    logging.warning('multiple values for budgets set with unrestricted user list '
+                                    'only the first value is used as budget for everyone.')
+                self.default_budget = float(user_budgets[0])
+            else:
+                for index, user_id in enumerate(_user_ids_by_position(config['allowed_user_ids'])):
+                    if user_id is None or user_id in self.user_budgets:
+                        continue
+                    if index < len(user_budgets):
+                        self.user_budgets[user_id] = float(user_budgets[index])
+                    else:
+                        logging.warning(f'No budget set for user id: {user_id}. Budget list shorter than user list.')
+                        self.user_budgets[user_id] = 0.0
+
+    def is_admin(self, user_id: int) -> bool:
+        """
+        Checks if the user is an admin of the bot
+        """
+        return user_id in self.admin_ids
+
+    def is_allowed_user(self, user_id: int) -> bool:
+        """
+        Checks if the user is allowed to use the bot on their own, i.e. not only as a guest in a group chat
+        """
+        return self.allow_all or user_id in self.allowed_ids or user_id in self.admin_ids
+
+    def is_guest(self, user_id: int) -> bool:
+        """
+        Checks if the user's usage is also counted against the guest budget
+        """
+        return user_id not in self.allowed_ids
+
+    def user_budget(self, user_id: int) -> float | None:
+        """
+        Get the user's budget.
+        :param user_id: User id
+        :return: The user's budget as a float, or None if the user is not found in the allowed user list
+        """
+        # no budget restrictions for admins and '*'-budget lists
+        if self.unlimited_budgets or user_id in self.admin_ids:
+            return float('inf')
+        if self.default_budget is not None:
+            return self.default_budget
+        return self.user_budgets.get(user_id)
+
+    def cost_period(self) -> str:
+        """
+        Returns the key of the usage tracker cost matching the budget period
+        """
+        return BUDGET_COST_MAP[self.budget_period]
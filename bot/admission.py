@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import Counter
+
+from rate_limiter import TokenBucket, MAX_IDLE_BUCKETS
+
+
+class AdmissionController:
+    """
+    Decides whether a new request (a prompt, an image, a transcription...) may start.
+    Requests are limited by the number of requests in flight per user and per chat, and by a
+    token bucket on each user's request rate. A request over the limits waits for a free slot
+    for a short time, or is rejected right away if the wait queue is disabled.
+    A limit of 0 disables it.
+    """
+
+    def __init__(self, config: dict):
+        """
+        Initializes the controller.
+        :param config: A dictionary containing the bot configuration
+        """
+        self.max_user_requests = config['max_concurrent_requests_per_user']
+        self.max_chat_requests = config['max_concurrent_requests_per_chat']
+        self.user_rate = config['user_requests_per_minute'] / 60
+        self.user_burst = config['user_request_burst']
+        self.admin_max_requests = config['admin_max_concurrent_requests']
+        self.admin_rate = config['admin_requests_per_minute'] / 60
+        self.queue_timeout = config['admission_queue_timeout']
+
+        self.user_requests = Counter()  # {user_id: requests in flight}
+        self.chat_requests = Counter()  # {chat_id: requests in flight}
+        self.tickets = {}  # {ticket: (user_id, chat_id)}
+        self.buckets = {}  # {user_id: TokenBucket}
+        self.released: asyncio.Condition | None = None  # created in the event loop running the bot
+
+    async def admit(self, ticket, user_id: int, chat_id: int, is_admin: bool = False) -> bool:
+        """
+        Admits a request, waiting up to the queue timeout for a free slot.
+        Admitted requests must be released with `release` once done.
+        :param ticket: A unique identifier of the request (e.g. the update id)
+        :param user_id: The user who sent the request
+        :param chat_id: The chat the request was sent in
+        :param is_admin: Whether the user is an admin, admins have their own limits and no chat limit
+        :return: Whether the request can start
+        """
+        if self.released is None:
+            self.released = asyncio.Condition()
+        max_user_requests = self.admin_max_requests if is_admin else self.max_user_requests
+        max_chat_requests = 0 if is_admin else self.max_chat_requests
+        bucket = self.__bucket(user_id, is_admin)
+        deadline = time.monotonic() + self.queue_timeout
+
+        async with self.released:
+            while True:
+                delay = bucket.delay() if bucket is not None else 0.0
+                slots_free = (max_user_requests <= 0 or self.user_requests[user_id] < max_user_requests) and \
+                             (max_chat_requests <= 0 or self.chat_requests[chat_id] < max_chat_requests)
+                if slots_free and delay == 0:
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (slots_free and delay > remaining):
+                    logging.info(f'Request from user {user_id} in chat {chat_id} rejected: '
+                                 f'{self.user_requests[user_id]} requests in flight for the user, '
+                                 f'{self.chat_requests[chat_id]} in the chat')
+                    return False
+                try:
+                    # Wake up when a request is released, or when the bucket has a new token
+                    await asyncio.wait_for(self.released.wait(), timeout=min(remaining, delay or remaining))
+                except asyncio.TimeoutError:
+                    pass
+
+            if bucket is not None:
+                bucket.consume()
+            self.user_requests[user_id] += 1
+            self.chat_requests[chat_id] += 1
+            self.tickets[ticket] = (user_id, chat_id)
+        return True
+
+    async def release(self, ticket):
+        """
+        Releases the slot of an admitted request, does nothing if the request was not admitted
+        """
+        if ticket not in self.tickets:
+            return
+        user_id, chat_id = self.tickets.pop(ticket)
+        for counter, key in ((self.user_requests, user_id), (self.chat_requests, chat_id)):
+            counter[key] -= 1
+            if counter[key] <= 0:
+                del counter[key]
+        async with self.released:
+            self.released.notify_all()
+
+    def __bucket(self, user_id: int, is_admin: bool) -> TokenBucket | None:
+        rate = self.admin_rate if is_admin else self.user_rate
+        if rate <= 0:
+            return None
+        if user_id not in self.buckets:
+            if len(self.buckets) > MAX_IDLE_BUCKETS:
+                self.buckets = {key: bucket for key, bucket in self.buckets.items() if not bucket.is_idle()}
+            self.buckets[user_id] = TokenBucket(rate, self.user_burst)
+        bucket = self.buckets[user_id]
+        bucket.rate = rate
+        return bucket
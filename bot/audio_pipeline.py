@@ -0,0 +1,272 @@
+from __future__ import annotations
+
+import asyncio
+import atexit
+import contextlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+from dataclasses import dataclass
+from typing import NamedTuple
+
+from utils import gather_or_cancel
+
+# Matches the input duration reported by ffmpeg, e.g. "Duration: 00:01:02.50"
+DURATION_PATTERN = re.compile(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)')
+
+# Matches the progress reported by ffmpeg, e.g. "time=00:01:02.50", used when the input has no duration
+PROGRESS_PATTERN = re.compile(r'time=(\d+):(\d+):(\d+(?:\.\d+)?)')
+
+# Maximum size of a file accepted by the transcription API
+MAX_TRANSCRIPTION_FILE_SIZE = 25 * 1024 * 1024
+
+# Audio formats accepted by the transcription API as they are, with the file extension telling the format
+PASSTHROUGH_FORMATS = {
+    'audio/ogg': 'ogg',
+    'audio/opus': 'ogg',
+    'audio/mpeg': 'mp3',
+    'audio/mp3': 'mp3',
+    'audio/mp4': 'm4a',
+    'audio/x-m4a': 'm4a',
+    'audio/m4a': 'm4a',
+    'audio/wav': 'wav',
+    'audio/x-wav': 'wav',
+    'audio/flac': 'flac',
+    'audio/x-flac': 'flac',
+    'audio/webm': 'webm',
+}
+
+# Anything else is reduced to what speech recognition needs: the first audio track only (video frames are
+# not decoded), downmixed to mono, resampled to 16 kHz and encoded at a low bitrate
+SPEECH_OUTPUT_ARGS = ['-map', '0:a:0', '-vn', '-ac', '1', '-ar', '16000', '-c:a', 'libmp3lame', '-b:a', '32k',
+                      '-f', 'mp3']
+SPEECH_EXTENSION = 'mp3'
+
+# Silences (below -35 dB for at least 0.4 seconds) where long recordings are preferably split
+SILENCE_FILTER = 'silencedetect=noise=-35dB:d=0.4'
+SILENCE_PATTERN = re.compile(r'silence_(start|end): (-?\d+(?:\.\d+)?)')
+
+# Seconds of audio shared by consecutive segments, so that no word is lost at a cut
+SEGMENT_OVERLAP = 2.0
+
+
+class AudioConversionError(Exception):
+    """
+    Raised when ffmpeg fails to convert a file
+    """
+    pass
+
+
+class AudioFile(NamedTuple):
+    """
+    Audio data along with the file name to send it with, whose extension tells the format
+    """
+    data: bytes
+    filename: str
+
+
+@dataclass(frozen=True)
+class PreparedAudio:
+    """
+    Audio ready to be transcribed: the whole recording, or consecutive overlapping segments of long recordings
+    """
+    segments: tuple[AudioFile, ...]
+    duration: float | None  # in seconds
+
+
+def passthrough_extension(mime_type: str | None, size: int) -> str | None:
+    """
+    Returns the extension to send a file with as it is, or None if it must be transcoded
+    :param mime_type: The mime type of the file
+    :param size: The size of the file in bytes
+    """
+    if size > MAX_TRANSCRIPTION_FILE_SIZE:
+        return None
+    return PASSTHROUGH_FORMATS.get((mime_type or '').lower())
+
+
+class AudioPipeline:
+    """
+    Converts audio and video files with ffmpeg subprocesses, without blocking the event loop.
+    Inputs are written to scratch files in a temporary directory owned by the pipeline
+    (some containers, like mp4, can only be read from seekable files), outputs are read from ffmpeg's stdout.
+    """
+
+    def __init__(self, segment_duration: float, max_processes: int | None = None):
+        """
+        Initializes the pipeline.
+        :param segment_duration: Recordings longer than this many seconds are split into segments
+        :param max_processes: Maximum number of concurrent ffmpeg processes, defaults to the number of CPUs
+        """
+        self.segment_duration = segment_duration
+        self.max_processes = max_processes or os.cpu_count() or 1
+        self.processes = None  # semaphore, created in the running event loop
+        self.temp_dir = tempfile.mkdtemp(prefix='chatgpt-telegram-bot-')
+        atexit.register(self.close)
+
+    def close(self):
+        """
+        Deletes the scratch directory
+        """
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    @contextlib.asynccontextmanager
+    async def scratch_file(self, name: str, data: bytes):
+        """
+        Writes data to a scratch file, which is deleted when the context exits.
+        :param name: A name unique to the request (e.g. containing the update id)
+        :param data: The file content
+        :return: The path of the scratch file
+        """
+        path = os.path.join(self.temp_dir, os.path.basename(name))
+        await asyncio.get_running_loop().run_in_executor(None, self.__write, path, data)
+        try:
+            yield path
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+    async def prepare(self, name: str, data: bytes, mime_type: str | None,
+                      duration: float | None = None) -> PreparedAudio:
+        """
+        Prepares a file for transcription. Supported audio formats are passed through untouched,
+        other files (videos, unsupported or too large files) are transcoded to compact speech audio.
+        Long recordings are split on silences into overlapping segments, which can be transcribed concurrently.
+        :param name: A name unique to the request (e.g. containing the update id)
+        :param data: The file content
+        :param mime_type: The mime type of the file
+        :param duration: The duration of the file in seconds, if known
+        :return: The audio to transcribe
+        """
+        extension = passthrough_extension(mime_type, len(data))
+        if extension is not None and duration is not None and duration <= self.segment_duration:
+            return PreparedAudio((AudioFile(data, f'{name}.{extension}'),), duration)
+
+        async with self.scratch_file(name, data) as path:
+            if duration is None:
+                duration = await self.probe_duration(path)
+
+            if duration is None or duration <= self.segment_duration:
+                if extension is not None:
+                    return PreparedAudio((AudioFile(data, f'{name}.{extension}'),), duration)
+                audio, transcoded_duration = await self.run_ffmpeg(path, SPEECH_OUTPUT_ARGS)
+                logging.info(f'Transcoded {mime_type} file from {len(data)} to {len(audio)} bytes')
+                return PreparedAudio((AudioFile(audio, f'{name}.{SPEECH_EXTENSION}'),),
+                                     duration or transcoded_duration)
+
+            segments = plan_segments(duration, await self.detect_silences(path), self.segment_duration)
+            outputs = await gather_or_cancel(*(
+                self.run_ffmpeg(path, SPEECH_OUTPUT_ARGS,
+                                input_args=['-ss', f'{start:.3f}', '-t', f'{end - start:.3f}'])
+                for start, end in segments
+            ))
+
+        logging.info(f'Split {mime_type} file of {duration:.0f}s into {len(segments)} segments')
+        return PreparedAudio(tuple(AudioFile(audio, f'{name}_{index}.{SPEECH_EXTENSION}')
+                                   for index, (audio, _) in enumerate(outputs)), duration)
+
+    async def detect_silences(self, path: str) -> list[tuple[float, float]]:
+        """
+        Returns the silences of the file's audio track, as (start, end) timestamps in seconds
+        """
+        returncode, _, log = await self.__ffmpeg('-i', path, '-map', '0:a:0', '-af', SILENCE_FILTER, '-f', 'null', '-')
+        if returncode != 0:
+            logging.warning(f'ffmpeg failed to detect silences with exit code {returncode}: {log[-500:]}')
+            return []
+        return parse_silences(log)
+
+    async def probe_duration(self, path: str) -> float | None:
+        """
+        Returns the duration of a file in seconds, if ffmpeg can tell it without decoding the file
+        """
+        # Without an output, ffmpeg only prints the input information (and exits with an error)
+        _, _, log = await self.__ffmpeg('-i', path)
+        return parse_duration(log)
+
+    async def run_ffmpeg(self, path: str, output_args: list[str],
+                         input_args: list[str] = ()) -> tuple[bytes, float | None]:
+        """
+        Runs ffmpeg on a file, writing the output to stdout.
+        :param path: The input file
+        :param output_args: The output options (codec, format...)
+        :param input_args: The input options (e.g. the part of the file to read)
+        :return: The output data and the duration of the input in seconds, if ffmpeg reported it
+        """
+        returncode, output, log = await self.__ffmpeg(*input_args, '-i', path, *output_args, 'pipe:1')
+        if returncode != 0:
+            logging.warning(f'ffmpeg failed with exit code {returncode}: {log[-500:]}')
+            raise AudioConversionError(log.splitlines()[-1] if log else 'ffmpeg failed')
+        return output, parse_duration(log)
+
+    async def __ffmpeg(self, *args: str) -> tuple[int, bytes, str]:
+        """
+        Runs an ffmpeg process, killing it if the request is cancelled
+        :return: The exit code, the output and the log of ffmpeg
+        """
+        if self.processes is None:
+            self.processes = asyncio.Semaphore(self.max_processes)
+        async with self.processes:
+            process = await asyncio.create_subprocess_exec(
+                'ffmpeg', '-hide_banner', '-nostdin', *args,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            try:
+                output, log = await process.communicate()
+            except asyncio.CancelledError:
+                with contextlib.suppress(ProcessLookupError):
+                    process.kill()
+                await process.wait()
+                raise
+        return process.returncode, output, log.decode(errors='replace').strip()
+
+    @staticmethod
+    def __write(path: str, data: bytes):
+        with open(path, 'wb') as file:
+            file.write(data)
+
+
+def parse_duration(ffmpeg_output: str) -> float | None:
+    """
+    Returns the input duration in seconds reported in ffmpeg's output, if any
+    """
+    matches = DURATION_PATTERN.findall(ffmpeg_output)[:1] or PROGRESS_PATTERN.findall(ffmpeg_output)[-1:]
+    if len(matches) == 0:
+        return None
+    hours, minutes, seconds = matches[0]
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def parse_silences(ffmpeg_output: str) -> list[tuple[float, float]]:
+    """
+    Returns the silences reported by ffmpeg's silencedetect filter, as (start, end) timestamps in seconds
+    """
+    silences = []
+    start = None
+    for kind, timestamp in SILENCE_PATTERN.findall(ffmpeg_output):
+        if kind == 'start':
+            start = max(0.0, float(timestamp))
+        elif start is not None:
+            silences.append((start, float(timestamp)))
+            start = None
+    return silences
+
+
+def plan_segments(duration: float, silences: list[tuple[float, float]], segment_duration: float,
+                  overlap: float = SEGMENT_OVERLAP) -> list[tuple[float, float]]:
+    """
+    Splits a recording into segments of at most about `segment_duration` seconds.
+    Each cut is placed in the middle of the latest silence in the last quarter of the segment
+    (or at the maximum duration if there is none), and segments overlap by `overlap` seconds on each side.
+    :return: The (start, end) timestamps of the segments in seconds
+    """
+    pauses = [(start + end) / 2 for start, end in silences]
+    cuts = [0.0]
+    while duration - cuts[-1] > segment_duration:
+        latest_cut = cuts[-1] + segment_duration
+        candidates = [pause for pause in pauses if latest_cut - segment_duration / 4 <= pause <= latest_cut]
+        cuts.append(max(candidates, default=latest_cut))
+    cuts.append(duration)
+    return [(max(0.0, start - overlap), min(duration, end + overlap)) for start, end in zip(cuts, cuts[1:])]
@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Any
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    A size-bounded in-memory cache whose entries expire after a time to live.
+    When the cache is full, the least recently used entry is evicted.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        """
+        Initializes the cache.
+        :param max_size: The maximum number of entries
+        :param ttl: The default time to live of an entry, in seconds
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # {key: (expires_at, value)}
+
+    def get(self, key, default: Any = None) -> Any:
+        """
+        Returns the value of a key, or the default value if it is missing or expired
+        """
+        entry = self.entries.get(key, _MISSING)
+        if entry is _MISSING:
+            return default
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self.entries[key]
+            return default
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value: Any, ttl: float | None = None):
+        """
+        Stores a value, optionally with a specific time to live
+        """
+        self.entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def pop(self, key, default: Any = None) -> Any:
+        """
+        Removes a key and returns its value, or the default value if it is missing or expired
+        """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            return default
+        del self.entries[key]
+        return value
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class SQLiteLRUCache:
+    """
+    A size-bounded persistent cache stored in a table of an SQLite database,
+    which survives restarts and is shared by all worker processes.
+    Each key maps to a row of values. When the cache is full, the least recently used entries are evicted.
+    Database errors are logged and treated as cache misses, the database is accessed from executor threads.
+    """
+
+    def __init__(self, path: str, table: str, columns: dict[str, str], max_size: int):
+        """
+        Initializes the cache, creating the table if needed.
+        :param path: The path of the database file
+        :param table: The name of the table
+        :param columns: The SQL types of the value columns by name, e.g. {'transcript': 'TEXT NOT NULL'}
+        :param max_size: The maximum number of entries
+        """
+        self.path = path
+        self.table = table
+        self.columns = list(columns)
+        self.max_size = max_size
+        column_definitions = ''.join(f'{name} {sql_type}, ' for name, sql_type in columns.items())
+        with self.__connect() as connection:
+            connection.execute(f'CREATE TABLE IF NOT EXISTS {table} ('
+                               f'key TEXT PRIMARY KEY, {column_definitions}last_used REAL NOT NULL)')
+            connection.execute(f'CREATE INDEX IF NOT EXISTS {table}_last_used ON {table} (last_used)')
+
+    async def get(self, keys: list[str]) -> dict[str, tuple]:
+        """
+        Returns the values of the cached keys among the given ones, marking them as recently used
+        :return: The rows of values by key, missing keys are left out
+        """
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, self.__get, keys)
+        except sqlite3.Error as e:
+            logging.warning(f'Failed to read the {self.table} cache: {str(e)}')
+            return {}
+
+    async def set(self, rows: dict[str, tuple]):
+        """
+        Stores rows of values, evicting the least recently used entries if the cache is full
+        :param rows: The rows of values by key
+        """
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.__set, rows)
+        except sqlite3.Error as e:
+            logging.warning(f'Failed to write the {self.table} cache: {str(e)}')
+
+    def __get(self, keys: list[str]) -> dict[str, tuple]:
+        if len(keys) == 0:
+            return {}
+        placeholders = ', '.join('?' * len(keys))
+        with self.__connect() as connection:
+            rows = connection.execute(f'SELECT key, {", ".join(self.columns)} FROM {self.table} '
+                                      f'WHERE key IN ({placeholders})', keys).fetchall()
+            connection.execute(f'UPDATE {self.table} SET last_used = ? WHERE key IN ({placeholders})',
+                               (time.time(), *keys))
+        return {row[0]: tuple(row[1:]) for row in rows}
+
+    def __set(self, rows: dict[str, tuple]):
+        now = time.time()
+        placeholders = ', '.join('?' * (len(self.columns) + 2))
+        with self.__connect() as connection:
+            connection.executemany(f'INSERT OR REPLACE INTO {self.table} (key, {", ".join(self.columns)}, last_used) '
+                                   f'VALUES ({placeholders})',
+                                   [(key, *values, now) for key, values in rows.items()])
+            connection.execute(f'DELETE FROM {self.table} WHERE key NOT IN '
+                               f'(SELECT key FROM {self.table} ORDER BY last_used DESC LIMIT ?)', (self.max_size,))
+
+    @contextlib.contextmanager
+    def __connect(self):
+        """
+        Opens a connection committing the changes on exit.
+        Connections are short-lived, as they are used from executor threads.
+        """
+        connection = sqlite3.connect(self.path, timeout=10)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import logging
+
+from telegram import Bot, Update, constants
+from telegram.ext import CallbackContext
+
+from rate_limiter import PRIORITY_CHAT_ACTION
+from utils import get_thread_id
+
+# Chat actions are shown for 5 seconds, or until the bot sends a message
+CHAT_ACTION_INTERVAL = 4.5
+
+
+class _Heartbeat:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.references = 0
+
+
+class ChatActionService:
+    """
+    Keeps chat actions (typing, uploading a photo...) visible while requests are being processed.
+    There is a single heartbeat per chat, thread and action, shared by all requests needing it
+    and stopped as soon as the last of them is done.
+    """
+
+    def __init__(self):
+        self.heartbeats = {}  # {(chat_id, thread_id, action): _Heartbeat}
+
+    @contextlib.asynccontextmanager
+    async def keep(self, bot: Bot, chat_id: int, thread_id: int | None, action: str):
+        """
+        Shows the chat action for as long as the context is active
+        """
+        key = (chat_id, thread_id, action)
+        heartbeat = self.heartbeats.get(key)
+        if heartbeat is None:
+            heartbeat = _Heartbeat(asyncio.create_task(self.__beat(bot, chat_id, thread_id, action)))
+            self.heartbeats[key] = heartbeat
+        heartbeat.references += 1
+        try:
+            yield
+        finally:
+            heartbeat.references -= 1
+            if heartbeat.references == 0:
+                heartbeat.task.cancel()
+                if self.heartbeats.get(key) is heartbeat:
+                    del self.heartbeats[key]
+
+    async def wrap_with_indicator(self, update: Update, context: CallbackContext, coroutine,
+                                  chat_action: constants.ChatAction = "", is_inline=False):
+        """
+        Runs a coroutine while showing a chat action to the user.
+        The coroutine runs in the calling task, so cancelling the request cancels it as well.
+        """
+        if is_inline:
+            return await coroutine()
+        async with self.keep(context.bot, update.effective_chat.id, get_thread_id(update), chat_action):
+            return await coroutine()
+
+    @staticmethod
+    async def __beat(bot: Bot, chat_id: int, thread_id: int | None, action: str):
+        while True:
+            try:
+                await bot.send_chat_action(chat_id, action, message_thread_id=thread_id,
+                                           rate_limit_args={'priority': PRIORITY_CHAT_ACTION})
+            except Exception as e:
+                logging.warning(f'Failed to send chat action {action} to chat {chat_id}: {str(e)}')
+            await asyncio.sleep(CHAT_ACTION_INTERVAL)
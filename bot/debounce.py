@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Any
+
+
+class KeyedDebouncer:
+    """
+    Collects items submitted under the same key in quick succession.
+    Every submission restarts the key's quiet window. Once the window elapses without new items,
+    the last submitter receives the whole batch and the earlier submitters receive None.
+    """
+
+    def __init__(self, window: float):
+        """
+        Initializes the debouncer.
+        :param window: Number of seconds without new items after which a batch is complete
+        """
+        self.window = window
+        self.batches = {}  # {key: [items]}
+        self.generations = {}  # {key: number of the latest submission}
+
+    async def submit(self, key, item: Any) -> list | None:
+        """
+        Adds an item to the key's batch and waits for the batch to settle.
+        :param key: The key to group items by (e.g. a user or chat id)
+        :param item: The item to add
+        :return: All items of the batch in submission order, or None if a later submission took over
+        """
+        self.batches.setdefault(key, []).append(item)
+        generation = self.generations.get(key, 0) + 1
+        self.generations[key] = generation
+        try:
+            await asyncio.sleep(self.window)
+        except asyncio.CancelledError:
+            if self.generations.get(key) == generation:
+                self.__discard(key)
+            raise
+        if self.generations.get(key) != generation:
+            return None
+        return self.__discard(key)
+
+    def is_pending(self, key) -> bool:
+        """
+        Returns whether a batch is being collected for the key
+        """
+        return key in self.batches
+
+    def __discard(self, key) -> list:
+        self.generations.pop(key, None)
+        return self.batches.pop(key, [])
@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import asyncio
+import itertools
+import logging
+
+# Seconds to wait for stopped generations to wrap up (closing the stream, finishing the message)
+STOP_TIMEOUT = 10.0
+
+
+class Generation:
+    """
+    An answer being generated, i.e. the task handling the user's request
+    """
+
+    def __init__(self, generation_id: int, chat_id: int, user_id: int, task: asyncio.Task):
+        self.generation_id = generation_id
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.task = task
+        self.stopped = False
+
+
+class GenerationRegistry:
+    """
+    Keeps track of the answers being generated in each chat, so that they can be stopped
+    (by the user, on /reset or when a newer prompt supersedes them).
+    A stopped generation is cancelled: the request handler can tell it apart from other
+    cancellations through `Generation.stopped`.
+    """
+
+    def __init__(self):
+        self.generations = {}  # {generation_id: Generation}
+        self.ids = itertools.count(1)
+
+    def start(self, chat_id: int, user_id: int) -> Generation:
+        """
+        Registers the current task as a new generation in the chat
+        """
+        generation = Generation(next(self.ids), chat_id, user_id, asyncio.current_task())
+        self.generations[generation.generation_id] = generation
+        return generation
+
+    def finish(self, generation: Generation):
+        """
+        Unregisters a generation once its task is done with it
+        """
+        self.generations.pop(generation.generation_id, None)
+
+    def get(self, generation_id: int) -> Generation | None:
+        """
+        Returns the generation with the given id, if it is still in progress
+        """
+        return self.generations.get(generation_id)
+
+    def in_chat(self, chat_id: int) -> list[Generation]:
+        """
+        Returns the generations in progress in the chat
+        """
+        return [generation for generation in self.generations.values() if generation.chat_id == chat_id]
+
+    async def stop(self, generations: list[Generation], timeout: float = STOP_TIMEOUT) -> int:
+        """
+        Cancels the generations and waits for them to wrap up.
+        :param generations: The generations to stop
+        :param timeout: Maximum number of seconds to wait
+        :return: The number of generations stopped
+        """
+        current_task = asyncio.current_task()
+        tasks = []
+        for generation in generations:
+            if generation.task is current_task or generation.task.done():
+                continue
+            if not generation.stopped:
+                generation.stopped = True
+                generation.task.cancel()
+            tasks.append(generation.task)
+        if len(tasks) > 0:
+            logging.info(f'Stopping {len(tasks)} generation(s) in chat {generations[0].chat_id}')
+            _, pending = await asyncio.wait(tasks, timeout=timeout)
+            if len(pending) > 0:
+                logging.warning(f'{len(pending)} stopped generation(s) did not finish within {timeout}s')
+        return len(tasks)
@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+
+import telegram
+from telegram import Bot, ChatMember, ChatMemberUpdated
+
+from cache import TTLCache
+
+MEMBER_STATUSES = (ChatMember.OWNER, ChatMember.ADMINISTRATOR, ChatMember.MEMBER)
+
+# Maximum number of cached groups and memberships
+MAX_CACHED_CHATS = 10000
+MAX_CACHED_MEMBERSHIPS = 100000
+
+# Unauthorized groups are checked again sooner, so that newly added members are noticed quickly
+NEGATIVE_TTL_FACTOR = 0.2
+
+
+class GroupMembershipCache:
+    """
+    Decides whether a group chat is authorized, i.e. whether at least one allowed user or admin is a member.
+    Results are cached with a time to live and kept fresh with `ChatMemberUpdated` updates
+    (which Telegram only sends if the bot is an administrator of the group).
+    Memberships missing from the cache are looked up in parallel, stopping at the first member found.
+    """
+
+    def __init__(self, ttl: float):
+        """
+        Initializes the cache.
+        :param ttl: Number of seconds the authorization of a group and memberships are cached
+        """
+        self.ttl = ttl
+        self.authorized_chats = TTLCache(MAX_CACHED_CHATS, ttl)  # {chat_id: bool}
+        self.memberships = TTLCache(MAX_CACHED_MEMBERSHIPS, ttl)  # {(chat_id, user_id): bool}
+        self.pending = {}  # {chat_id: task resolving the authorization}
+
+    async def is_authorized(self, bot: Bot, chat_id: int, user_ids: list[int]) -> bool:
+        """
+        Checks whether any of the given users is a member of the group.
+        :param bot: The bot to look up memberships with
+        :param chat_id: The group chat id
+        :param user_ids: The allowed users and admins
+        :return: Boolean indicating if the group is authorized
+        """
+        authorized = self.authorized_chats.get(chat_id)
+        if authorized is not None:
+            return authorized
+
+        # Concurrent messages from the same group share a single resolution
+        if chat_id not in self.pending:
+            self.pending[chat_id] = asyncio.create_task(self.__resolve(bot, chat_id, user_ids))
+        task = self.pending[chat_id]
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if task.done() and self.pending.get(chat_id) is task:
+                del self.pending[chat_id]
+
+    def on_chat_member(self, chat_member: ChatMemberUpdated):
+        """
+        Updates the cache with a membership change
+        """
+        chat_id = chat_member.chat.id
+        user_id = chat_member.new_chat_member.user.id
+        is_member = chat_member.new_chat_member.status in MEMBER_STATUSES
+        self.memberships.set((chat_id, user_id), is_member)
+        if is_member:
+            # The group might be authorized now
+            if self.authorized_chats.get(chat_id) is False:
+                self.authorized_chats.pop(chat_id)
+        else:
+            # The group might not be authorized anymore
+            self.authorized_chats.pop(chat_id)
+
+    def forget_chat(self, chat_id: int):
+        """
+        Drops the cached authorization of a group, e.g. when the bot leaves it
+        """
+        self.authorized_chats.pop(chat_id)
+
+    async def __resolve(self, bot: Bot, chat_id: int, user_ids: list[int]) -> bool:
+        unknown_user_ids = []
+        for user_id in user_ids:
+            is_member = self.memberships.get((chat_id, user_id))
+            if is_member:
+                logging.info(f'{user_id} is a member. Allowing group chat message...')
+                self.authorized_chats.set(chat_id, True)
+                return True
+            if is_member is None:
+                unknown_user_ids.append(user_id)
+
+        lookups = {asyncio.create_task(self.__is_member(bot, chat_id, user_id)): user_id
+                   for user_id in unknown_user_ids}
+        error = None
+        try:
+            pending = set(lookups)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for lookup in done:
+                    if lookup.exception() is not None:
+                        error = error or lookup.exception()
+                    elif lookup.result():
+                        logging.info(f'{lookups[lookup]} is a member. Allowing group chat message...')
+                        self.authorized_chats.set(chat_id, True)
+                        return True
+        finally:
+            for lookup in lookups:
+                lookup.cancel()
+
+        if error is not None:
+            # Do not cache a result that might be wrong
+            raise error
+        self.authorized_chats.set(chat_id, False, ttl=self.ttl * NEGATIVE_TTL_FACTOR)
+        return False
+
+    async def __is_member(self, bot: Bot, chat_id: int, user_id: int) -> bool:
+        try:
+            chat_member = await bot.get_chat_member(chat_id, user_id)
+            is_member = chat_member.status in MEMBER_STATUSES
+        except telegram.error.BadRequest as e:
+            if str(e) != "User not found":
+                raise e
+            is_member = False
+        self.memberships.set((chat_id, user_id), is_member)
+        return is_member
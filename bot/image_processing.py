@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+import asyncio
+import io
+from dataclasses import dataclass
+from typing import Sequence
+
+from PIL import Image, ImageOps, features
+from telegram import PhotoSize
+
+# Vision models scale images down to fit these bounds (shortest side, longest side) per detail level,
+# any larger image only costs upload time and memory ('auto' is treated as 'high', as for token counting)
+VISION_BOUNDS = {
+    'low': (512, 512),
+    'high': (768, 2048),
+    'auto': (768, 2048),
+}
+
+JPEG_QUALITY = 85
+WEBP_QUALITY = 85
+
+
+@dataclass(frozen=True)
+class PreparedImage:
+    """
+    An image encoded for the vision model
+    """
+    data: bytes
+    mime_type: str
+    width: int
+    height: int
+
+
+def vision_size(width: int, height: int, detail: str) -> tuple[int, int]:
+    """
+    Returns the size of an image once scaled down to the bounds the vision model uses for the detail level
+    """
+    short_bound, long_bound = VISION_BOUNDS.get(detail, VISION_BOUNDS['high'])
+    short_side, long_side = min(width, height), max(width, height)
+    factor = max(short_side / short_bound, long_side / long_bound)
+    if factor <= 1:
+        return width, height
+    return max(1, int(width / factor)), max(1, int(height / factor))
+
+
+def select_photo_size(photo_sizes: Sequence[PhotoSize], detail: str) -> PhotoSize:
+    """
+    Returns the smallest of the sizes Telegram offers for a photo that still covers
+    what the vision model looks at, so that larger sizes are not downloaded only to be scaled down
+    :param photo_sizes: The available sizes of the photo
+    :param detail: The vision detail level (low, high or auto)
+    """
+    largest = max(photo_sizes, key=lambda photo_size: photo_size.width * photo_size.height)
+    width, height = vision_size(largest.width, largest.height, detail)
+    # Sizes are rounded by Telegram, allow for a pixel of difference
+    sufficient = [photo_size for photo_size in photo_sizes
+                  if photo_size.width >= width - 1 and photo_size.height >= height - 1]
+    return min(sufficient, key=lambda photo_size: photo_size.width * photo_size.height, default=largest)
+
+
+def prepare_image(data: bytes, detail: str) -> PreparedImage:
+    """
+    Downscales an image to what the vision model will look at and re-encodes it without metadata,
+    as JPEG or, for images with transparency, as WebP (PNG if WebP is not supported).
+    :param data: The original image
+    :param detail: The vision detail level (low, high or auto)
+    :return: The prepared image
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        size = vision_size(image.width, image.height, detail)
+        if size != image.size:
+            image = image.resize(size, Image.LANCZOS)
+
+        output = io.BytesIO()
+        has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+        if not has_alpha:
+            image.convert('RGB').save(output, format='JPEG', quality=JPEG_QUALITY, optimize=True)
+            mime_type = 'image/jpeg'
+        elif features.check('webp'):
+            image.convert('RGBA').save(output, format='WEBP', quality=WEBP_QUALITY)
+            mime_type = 'image/webp'
+        else:
+            image.convert('RGBA').save(output, format='PNG', optimize=True)
+            mime_type = 'image/png'
+        return PreparedImage(output.getvalue(), mime_type, image.width, image.height)
+
+
+async def prepare_image_async(data: bytes, detail: str) -> PreparedImage:
+    """
+    Prepares an image for the vision model in a worker thread, without blocking the event loop
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, prepare_image, data, detail)
@@ -0,0 +1,32 @@
+from __future__ import annotations
+
+from cache import SQLiteLRUCache
+
+
+class ImageStore:
+    """
+    A persistent store of the images referenced by conversation histories, keyed by the hash of their content.
+    Histories only hold compact references, the images are loaded when a request to the model is built.
+    """
+
+    def __init__(self, path: str, max_size: int):
+        """
+        Initializes the store, creating the database if needed.
+        :param path: The path of the database file
+        :param max_size: The maximum number of images
+        """
+        self.cache = SQLiteLRUCache(path, 'images', {'data': 'BLOB NOT NULL'}, max_size)
+
+    async def get(self, keys: list[str]) -> dict[str, bytes]:
+        """
+        Returns the stored images among the given keys
+        :return: The images by key, evicted images are missing
+        """
+        return {key: data for key, (data,) in (await self.cache.get(keys)).items()}
+
+    async def add(self, images: dict[str, bytes]):
+        """
+        Stores images, evicting the least recently used ones if the store is full
+        :param images: The images by key
+        """
+        await self.cache.set({key: (data,) for key, data in images.items()})
@@ -5,9 +5,16 @@ from dotenv import load_dotenv
 
 from plugin_manager import PluginManager
 from openai_helper import OpenAIHelper, default_max_tokens, are_functions_available
+from sharding import ShardedBot
 from telegram_bot import ChatGPTTelegramBot
 
 
+def create_bot(openai_config: dict, telegram_config: dict, plugin_config: dict) -> ChatGPTTelegramBot:
+    plugin_manager = PluginManager(config=plugin_config)
+    openai_helper = OpenAIHelper(config=openai_config, plugin_manager=plugin_manager)
+    return ChatGPTTelegramBot(config=telegram_config, openai=openai_helper)
+
+
 def main():
     # Read .env file
     load_dotenv()
@@ -53,11 +60,17 @@ def main():
         'bot_language': os.environ.get('BOT_LANGUAGE', 'en'),
         'show_plugins_used': os.environ.get('SHOW_PLUGINS_USED', 'false').lower() == 'true',
         'whisper_prompt': os.environ.get('WHISPER_PROMPT', ''),
+        'transcription_max_concurrent_segments': int(os.environ.get('TRANSCRIPTION_MAX_CONCURRENT_SEGMENTS', 4)),
         'vision_model': os.environ.get('VISION_MODEL', 'gpt-4o'),
         'enable_vision_follow_up_questions': os.environ.get('ENABLE_VISION_FOLLOW_UP_QUESTIONS', 'true').lower() == 'true',
         'vision_prompt': os.environ.get('VISION_PROMPT', 'What is in this image'),
         'vision_detail': os.environ.get('VISION_DETAIL', 'auto'),
         'vision_max_tokens': int(os.environ.get('VISION_MAX_TOKENS', '300')),
+        'vision_image_max_turns': int(os.environ.get('VISION_IMAGE_MAX_TURNS', 3)),
+        'vision_image_store_size': int(os.environ.get('VISION_IMAGE_STORE_SIZE', 1000)),
+        'vision_image_store_path': os.environ.get('VISION_IMAGE_STORE_PATH', 'vision_images.db'),
+        'vision_cache_size': int(os.environ.get('VISION_CACHE_SIZE', 1000)),
+        'vision_cache_ttl': int(os.environ.get('VISION_CACHE_TTL', 86400)),
         'tts_model': os.environ.get('TTS_MODEL', 'tts-1'),
         'tts_voice': os.environ.get('TTS_VOICE', 'alloy'),
     }
@@ -99,7 +112,32 @@ def main():
         'tts_model': os.environ.get('TTS_MODEL', 'tts-1'),
         'tts_prices': [float(i) for i in os.environ.get('TTS_PRICES', "0.015,0.030").split(",")],
         'transcription_price': float(os.environ.get('TRANSCRIPTION_PRICE', 0.006)),
+        'transcription_segment_duration': float(os.environ.get('TRANSCRIPTION_SEGMENT_DURATION', 600)),
+        'transcription_cache_size': int(os.environ.get('TRANSCRIPTION_CACHE_SIZE', 1000)),
+        'transcription_cache_path': os.environ.get('TRANSCRIPTION_CACHE_PATH', 'transcription_cache.db'),
+        'transcription_cache_billing': os.environ.get('TRANSCRIPTION_CACHE_BILLING', 'full').lower(),
+        'vision_cache_billing': os.environ.get('VISION_CACHE_BILLING', 'full').lower(),
+        'vision_detail': os.environ.get('VISION_DETAIL', 'auto'),
         'bot_language': os.environ.get('BOT_LANGUAGE', 'en'),
+        'global_rate_limit': float(os.environ.get('TELEGRAM_GLOBAL_RATE_LIMIT', 30)),
+        'chat_rate_limit': float(os.environ.get('TELEGRAM_CHAT_RATE_LIMIT', 1)),
+        'group_rate_limit': float(os.environ.get('TELEGRAM_GROUP_RATE_LIMIT', 20)),
+        'connection_pool_size': int(os.environ.get('TELEGRAM_CONNECTION_POOL_SIZE', 64)),
+        'pool_timeout': float(os.environ.get('TELEGRAM_POOL_TIMEOUT', 10.0)),
+        'max_concurrent_requests_per_user': int(os.environ.get('MAX_CONCURRENT_REQUESTS_PER_USER', 2)),
+        'max_concurrent_requests_per_chat': int(os.environ.get('MAX_CONCURRENT_REQUESTS_PER_CHAT', 5)),
+        'user_requests_per_minute': float(os.environ.get('USER_REQUESTS_PER_MINUTE', 20)),
+        'user_request_burst': int(os.environ.get('USER_REQUEST_BURST', 5)),
+        'admin_max_concurrent_requests': int(os.environ.get('ADMIN_MAX_CONCURRENT_REQUESTS', 0)),
+        'admin_requests_per_minute': float(os.environ.get('ADMIN_REQUESTS_PER_MINUTE', 0)),
+        'admission_queue_timeout': float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 10.0)),
+        'group_membership_cache_ttl': float(os.environ.get('GROUP_MEMBERSHIP_CACHE_TTL', 300)),
+        'cancel_previous_generation': os.environ.get('CANCEL_PREVIOUS_GENERATION', 'false').lower() == 'true',
+        'message_coalesce_window': float(os.environ.get('MESSAGE_COALESCE_WINDOW', 0.5)),
+        'webhook_url': os.environ.get('WEBHOOK_URL', ''),
+        'webhook_listen': os.environ.get('WEBHOOK_LISTEN', '0.0.0.0'),
+        'webhook_port': int(os.environ.get('WEBHOOK_PORT', 8080)),
+        'webhook_secret_token': os.environ.get('WEBHOOK_SECRET_TOKEN', None) or None,
     }
 
     plugin_config = {
@@ -107,10 +145,14 @@ def main():
     }
 
     # Setup and run ChatGPT and Telegram bot
-    plugin_manager = PluginManager(config=plugin_config)
-    openai_helper = OpenAIHelper(config=openai_config, plugin_manager=plugin_manager)
-    telegram_bot = ChatGPTTelegramBot(config=telegram_config, openai=openai_helper)
-    telegram_bot.run()
+    workers = int(os.environ.get('WORKERS', 1))
+    if workers > 1:
+        # The global rate limit is shared by all workers
+        worker_config = {**telegram_config, 'global_rate_limit': telegram_config['global_rate_limit'] / workers}
+        ShardedBot(config=telegram_config, workers=workers, bot_factory=create_bot,
+                   factory_args=(openai_config, worker_config, plugin_config)).run()
+    else:
+        create_bot(openai_config, telegram_config, plugin_config).run()
 
 
 if __name__ == '__main__':
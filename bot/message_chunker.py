@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+# Telegram's message length limit
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+CODE_FENCE = '```'
+
+
+class MessageChunker:
+    """
+    Splits a growing text into chunks that fit in a Telegram message.
+    Text is fed incrementally and only the pending tail is examined when it outgrows the limit.
+    Chunks are cut at paragraph or line boundaries when possible, and code blocks spanning
+    a cut are closed at the end of the chunk and reopened at the start of the next one.
+    """
+
+    def __init__(self, limit: int = TELEGRAM_MESSAGE_LIMIT):
+        """
+        Initializes the chunker.
+        :param limit: The maximum length of a chunk
+        """
+        self.limit = limit
+        self.tail = ''
+
+    def feed(self, delta: str) -> list[str]:
+        """
+        Adds text to the pending tail.
+        :param delta: The text to add
+        :return: The chunks completed by this text, if any
+        """
+        self.tail += delta
+        completed = []
+        while len(self.tail) > self.limit:
+            completed.append(self.__cut())
+        return completed
+
+    def split(self, text: str) -> list[str]:
+        """
+        Splits a complete text into chunks.
+        :param text: The text to split
+        :return: The list of chunks
+        """
+        chunks = self.feed(text)
+        if len(self.tail) > 0:
+            chunks.append(self.tail)
+            self.tail = ''
+        return chunks
+
+    def __cut(self) -> str:
+        """
+        Removes the first chunk from the tail and returns it
+        """
+        # Keep room to close a code block at the end of the chunk
+        window = self.limit - len(CODE_FENCE) - 1
+        cut = self.__find_cut(window)
+        chunk, rest = self.tail[:cut], self.tail[cut:]
+
+        fence = open_code_fence(chunk)
+        if fence is not None:
+            chunk = chunk.rstrip('\n') + '\n' + CODE_FENCE
+            rest = fence + '\n' + rest.lstrip('\n')
+        else:
+            rest = rest.lstrip('\n')
+
+        self.tail = rest
+        return chunk.rstrip()
+
+    def __find_cut(self, window: int) -> int:
+        """
+        Finds the best position to cut the tail at, preferring paragraphs, then lines, then words
+        """
+        min_cut = window // 2
+        for separator in ('\n\n', '\n', ' '):
+            index = self.tail.rfind(separator, min_cut, window)
+            if index != -1:
+                return index + len(separator)
+        return window
+
+
+def open_code_fence(text: str) -> str | None:
+    """
+    Returns the opening line of the code block left open at the end of the text, if any
+    """
+    fence = None
+    for line in text.split('\n'):
+        stripped = line.strip()
+        if stripped.startswith(CODE_FENCE):
+            fence = stripped if fence is None else None
+    return fence
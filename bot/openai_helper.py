@@ -1,7 +1,10 @@
 from __future__ import annotations
+import asyncio
 import datetime
+import hashlib
 import logging
 import os
+import re
 
 import tiktoken
 
@@ -10,12 +13,17 @@ import openai
 import json
 import httpx
 import io
-from PIL import Image
+from dataclasses import dataclass
 
 from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
 
-from utils import is_direct_result, encode_image, decode_image
+from cache import TTLCache
+from image_processing import prepare_image_async
+from image_store import ImageStore
+from utils import encode_image, gather_or_cancel
 from plugin_manager import PluginManager
+from plugin_result import DirectResult
+from stream_events import TextDelta, ToolCallStarted, ToolCallFinished, StreamFinished
 
 # Models can be found here: https://platform.openai.com/docs/models/overview
 # Models gpt-3.5-turbo-0613 and  gpt-3.5-turbo-16k-0613 will be deprecated on June 13, 2024
@@ -29,6 +37,29 @@ GPT_4O_MODELS = ("gpt-4o", "gpt-4o-mini", "chatgpt-4o-latest")
 O_MODELS = ("o1", "o1-mini", "o1-preview")
 GPT_ALL_MODELS = GPT_3_MODELS + GPT_3_16K_MODELS + GPT_4_MODELS + GPT_4_32K_MODELS + GPT_4_VISION_MODELS + GPT_4_128K_MODELS + GPT_4O_MODELS + O_MODELS
 
+# The model used for transcriptions
+TRANSCRIPTION_MODEL = 'whisper-1'
+
+# Number of characters of the previous segment's transcript used as prompt of the next segment
+TRANSCRIPT_PROMPT_LENGTH = 500
+
+# Maximum number of words repeated at the boundary of two overlapping segments
+MAX_TRANSCRIPT_OVERLAP_WORDS = 30
+
+# Maximum number of characters of the description standing in for images removed from a conversation
+IMAGE_DESCRIPTION_LENGTH = 500
+
+
+@dataclass(frozen=True)
+class CachedInterpretation:
+    """
+    The answer to a vision request, reused when the same images are sent again with the same prompt
+    """
+    content: list  # the content of the request, with references to the images
+    answer: str
+    tokens: int  # tokens of the prompt, the images and the answer, without the rest of the conversation
+
+
 def default_max_tokens(model: str) -> int:
     """
     Gets the default number of max tokens for the given model.
@@ -92,6 +123,56 @@ def localized_text(key, bot_language):
             return key
 
 
+def merge_transcripts(transcripts: list[str]) -> str:
+    """
+    Joins the transcripts of consecutive, overlapping segments.
+    The words transcribed twice, at the end of a segment and the start of the next one, are only kept once.
+    """
+    def normalize(words: list[str]) -> list[str]:
+        return [re.sub(r'\W', '', word.lower()) for word in words]
+
+    merged = []
+    for transcript in transcripts:
+        words = transcript.split()
+        overlap = min(len(merged), len(words), MAX_TRANSCRIPT_OVERLAP_WORDS)
+        while overlap > 0 and normalize(merged[-overlap:]) != normalize(words[:overlap]):
+            overlap -= 1
+        merged.extend(words[overlap:])
+    return ' '.join(merged)
+
+
+def image_refs(message: dict) -> list[dict]:
+    """
+    Returns the references to images in the content of a conversation message
+    """
+    content = message.get('content')
+    if not isinstance(content, list):
+        return []
+    return [part for part in content if part['type'] == 'image_ref']
+
+
+def image_placeholder(messages: list[dict], index: int, count: int) -> dict:
+    """
+    Returns the text standing in for images removed from a message of the conversation:
+    the model's answer to the message, which describes them
+    :param messages: The conversation
+    :param index: The index of the message with the images
+    :param count: The number of images removed
+    """
+    description = None
+    for message in messages[index + 1:]:
+        if message['role'] == 'user':
+            break
+        if message['role'] == 'assistant' and isinstance(message['content'], str):
+            description = message['content']
+            break
+    if description is None:
+        return {'type': 'text', 'text': f'[{count} image(s) no longer available]'}
+    if len(description) > IMAGE_DESCRIPTION_LENGTH:
+        description = description[:IMAGE_DESCRIPTION_LENGTH] + '…'
+    return {'type': 'text', 'text': f'[{count} image(s) no longer available, described as: {description}]'}
+
+
 class OpenAIHelper:
     """
     ChatGPT helper class.
@@ -110,6 +191,11 @@ class OpenAIHelper:
         self.conversations: dict[int: list] = {}  # {chat_id: history}
         self.conversations_vision: dict[int: bool] = {}  # {chat_id: is_vision}
         self.last_updated: dict[int: datetime] = {}  # {chat_id: last_update_timestamp}
+        # Images of the conversations, which only hold references to them
+        self.image_store = ImageStore(config['vision_image_store_path'], config['vision_image_store_size']) \
+            if config['enable_vision_follow_up_questions'] else None
+        self.vision_cache = TTLCache(config['vision_cache_size'], config['vision_cache_ttl']) \
+            if config['vision_cache_size'] > 0 else None
 
     def get_conversation_stats(self, chat_id: int) -> tuple[int, int]:
         """
@@ -132,7 +218,7 @@ class OpenAIHelper:
         response = await self.__common_get_chat_response(chat_id, query)
         if self.config['enable_functions'] and not self.conversations_vision[chat_id]:
             response, plugins_used = await self.__handle_function_call(chat_id, response)
-            if is_direct_result(response):
+            if isinstance(response, DirectResult):
                 return response, '0'
 
         answer = ''
@@ -169,38 +255,76 @@ class OpenAIHelper:
         Stream response from the GPT model.
         :param chat_id: The chat ID
         :param query: The query to send to the model
-        :return: The answer from the model and the number of tokens used, or 'not_finished'
+        :return: An async generator of stream events: `TextDelta` for each new piece of the answer,
+                 `ToolCallStarted`/`ToolCallFinished` around function calls and a final `StreamFinished`
         """
         plugins_used = ()
+        answer_parts = []
         response = await self.__common_get_chat_response(chat_id, query, stream=True)
-        if self.config['enable_functions'] and not self.conversations_vision[chat_id]:
-            response, plugins_used = await self.__handle_function_call(chat_id, response, stream=True)
-            if is_direct_result(response):
-                yield response, '0'
-                return
-
-        answer = ''
-        async for chunk in response:
-            if len(chunk.choices) == 0:
-                continue
-            delta = chunk.choices[0].delta
-            if delta.content:
-                answer += delta.content
-                yield answer, 'not_finished'
-        answer = answer.strip()
+        try:
+            if self.config['enable_functions'] and not self.conversations_vision[chat_id]:
+                times = 0
+                while True:
+                    function_call = await self.__read_function_call(response, stream=True)
+                    if function_call is None:
+                        break
+                    function_name, arguments = function_call
+                    yield ToolCallStarted(function_name=function_name, arguments=arguments)
+                    function_response = await self.__call_function(chat_id, function_name, arguments)
+                    yield ToolCallFinished(function_name=function_name, result=function_response)
+                    if function_name not in plugins_used:
+                        plugins_used += (function_name,)
+                    if isinstance(function_response, DirectResult):
+                        yield StreamFinished(tokens_used=0, direct_result=function_response)
+                        return
+                    await response.close()
+                    response = await self.__request_function_follow_up(chat_id, times, stream=True)
+                    times += 1
+
+            async for event in self.__stream_text_deltas(response):
+                answer_parts.append(event.text)
+                yield event
+        except (asyncio.CancelledError, GeneratorExit):
+            self.__keep_partial_answer(chat_id, answer_parts)
+            raise
+        finally:
+            # Releases the upstream HTTP stream right away if the answer was interrupted
+            await response.close()
+        answer = ''.join(answer_parts).strip()
         self.__add_to_history(chat_id, role="assistant", content=answer)
-        tokens_used = str(self.__count_tokens(self.conversations[chat_id]))
+        tokens_used = self.__count_tokens(self.conversations[chat_id])
 
+        footer = ''
         show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
         plugin_names = tuple(self.plugin_manager.get_plugin_source_name(plugin) for plugin in plugins_used)
         if self.config['show_usage']:
-            answer += f"\n\n---\n💰 {tokens_used} {localized_text('stats_tokens', self.config['bot_language'])}"
+            footer += f"\n\n---\n💰 {tokens_used} {localized_text('stats_tokens', self.config['bot_language'])}"
             if show_plugins_used:
-                answer += f"\n🔌 {', '.join(plugin_names)}"
+                footer += f"\n🔌 {', '.join(plugin_names)}"
         elif show_plugins_used:
-            answer += f"\n\n---\n🔌 {', '.join(plugin_names)}"
+            footer += f"\n\n---\n🔌 {', '.join(plugin_names)}"
+
+        yield StreamFinished(tokens_used=tokens_used, footer=footer)
+
+    def __keep_partial_answer(self, chat_id: int, answer_parts: list[str]):
+        """
+        Adds the part of an interrupted answer that was already received to the history
+        """
+        answer = ''.join(answer_parts).strip()
+        if len(answer) > 0:
+            self.__add_to_history(chat_id, role="assistant", content=answer)
 
-        yield answer, tokens_used
+    @staticmethod
+    async def __stream_text_deltas(response):
+        """
+        Yields a `TextDelta` for every non-empty content delta of a streamed completion
+        """
+        async for chunk in response:
+            if len(chunk.choices) == 0:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                yield TextDelta(text=delta.content)
 
     @retry(
         reraise=True,
@@ -223,6 +347,7 @@ class OpenAIHelper:
             self.last_updated[chat_id] = datetime.datetime.now()
 
             self.__add_to_history(chat_id, role="user", content=query)
+            self.__expire_images(chat_id)
 
             # Summarize the chat history if it's too long to avoid excessive token usage
             token_count = self.__count_tokens(self.conversations[chat_id])
@@ -244,7 +369,7 @@ class OpenAIHelper:
             max_tokens_str = 'max_completion_tokens' if self.config['model'] in O_MODELS else 'max_tokens'
             common_args = {
                 'model': self.config['model'] if not self.conversations_vision[chat_id] else self.config['vision_model'],
-                'messages': self.conversations[chat_id],
+                'messages': await self.__materialize_images(self.conversations[chat_id]),
                 'temperature': self.config['temperature'],
                 'n': self.config['n_choices'],
                 max_tokens_str: self.config['max_tokens'],
@@ -270,6 +395,29 @@ class OpenAIHelper:
             raise Exception(f"⚠️ _{localized_text('error', bot_language)}._ ⚠️\n{str(e)}") from e
 
     async def __handle_function_call(self, chat_id, response, stream=False, times=0, plugins_used=()):
+        function_call = await self.__read_function_call(response, stream)
+        if function_call is None:
+            return response, plugins_used
+
+        function_name, arguments = function_call
+        function_response = await self.__call_function(chat_id, function_name, arguments)
+
+        if function_name not in plugins_used:
+            plugins_used += (function_name,)
+
+        if isinstance(function_response, DirectResult):
+            return function_response, plugins_used
+
+        response = await self.__request_function_follow_up(chat_id, times, stream)
+        return await self.__handle_function_call(chat_id, response, stream, times + 1, plugins_used)
+
+    async def __read_function_call(self, response, stream=False) -> tuple[str, str] | None:
+        """
+        Reads the function call requested by the model, if any.
+        :param response: The (streamed) model response
+        :param stream: Whether the response is streamed
+        :return: A tuple containing the function name and its arguments, or None if no function was called
+        """
         function_name = ''
         arguments = ''
         if stream:
@@ -284,9 +432,9 @@ class OpenAIHelper:
                     elif first_choice.finish_reason and first_choice.finish_reason == 'function_call':
                         break
                     else:
-                        return response, plugins_used
+                        return None
                 else:
-                    return response, plugins_used
+                    return None
         else:
             if len(response.choices) > 0:
                 first_choice = response.choices[0]
@@ -296,31 +444,38 @@ class OpenAIHelper:
                     if first_choice.message.function_call.arguments:
                         arguments += first_choice.message.function_call.arguments
                 else:
-                    return response, plugins_used
+                    return None
             else:
-                return response, plugins_used
+                return None
+        return function_name, arguments
 
+    async def __call_function(self, chat_id, function_name, arguments):
+        """
+        Calls the plugin function and adds its result to the conversation history
+        """
         logging.info(f'Calling function {function_name} with arguments {arguments}')
         function_response = await self.plugin_manager.call_function(function_name, self, arguments)
 
-        if function_name not in plugins_used:
-            plugins_used += (function_name,)
-
-        if is_direct_result(function_response):
+        if isinstance(function_response, DirectResult):
             self.__add_function_call_to_history(chat_id=chat_id, function_name=function_name,
                                                 content=json.dumps({'result': 'Done, the content has been sent'
                                                                               'to the user.'}))
-            return function_response, plugins_used
+        else:
+            self.__add_function_call_to_history(chat_id=chat_id, function_name=function_name,
+                                                content=function_response.to_json())
+        return function_response
 
-        self.__add_function_call_to_history(chat_id=chat_id, function_name=function_name, content=function_response)
-        response = await self.client.chat.completions.create(
+    async def __request_function_follow_up(self, chat_id, times, stream=False):
+        """
+        Requests the model's answer to a function result
+        """
+        return await self.client.chat.completions.create(
             model=self.config['model'],
-            messages=self.conversations[chat_id],
+            messages=await self.__materialize_images(self.conversations[chat_id]),
             functions=self.plugin_manager.get_functions_specs(),
             function_call='auto' if times < self.config['functions_max_consecutive_calls'] else 'none',
             stream=stream
         )
-        return await self.__handle_function_call(chat_id, response, stream, times + 1, plugins_used)
 
     async def generate_image(self, prompt: str) -> tuple[str, str]:
         """
@@ -372,30 +527,111 @@ class OpenAIHelper:
         except Exception as e:
             raise Exception(f"⚠️ _{localized_text('error', bot_language)}._ ⚠️\n{str(e)}") from e
 
-    async def transcribe(self, filename):
+    async def transcribe(self, audio: bytes, filename: str = 'audio.mp3', prompt: str | None = None):
         """
-        Transcribes the audio file using the Whisper model.
+        Transcribes the audio using the Whisper model.
+        :param audio: The audio data
+        :param filename: The file name sent along, its extension tells the audio format
+        :param prompt: Text preceding the audio, if any, to continue the transcript consistently
         """
         try:
-            with open(filename, "rb") as audio:
-                prompt_text = self.config['whisper_prompt']
-                result = await self.client.audio.transcriptions.create(model="whisper-1", file=audio, prompt=prompt_text)
-                return result.text
+            prompt_text = ' '.join(text for text in (self.config['whisper_prompt'], prompt) if text)
+            result = await self.client.audio.transcriptions.create(model=TRANSCRIPTION_MODEL, file=(filename, audio),
+                                                                   prompt=prompt_text)
+            return result.text
         except Exception as e:
             logging.exception(e)
             raise Exception(f"⚠️ _{localized_text('error', self.config['bot_language'])}._ ⚠️\n{str(e)}") from e
 
+    def transcription_cache_key(self, file_unique_id: str) -> str:
+        """
+        Returns the key of a file's transcript, which depends on the transcription model and prompt
+        """
+        prompt_hash = hashlib.sha256(self.config['whisper_prompt'].encode()).hexdigest()[:16]
+        return f'{TRANSCRIPTION_MODEL}:{prompt_hash}:{file_unique_id}'
+
+    def vision_cache_key(self, file_unique_ids: list[str], prompt: str | None = None) -> str:
+        """
+        Returns the key of the answer to a vision request, which depends on the images,
+        the prompt, the vision model and the detail level
+        """
+        prompt = self.config['vision_prompt'] if prompt is None else prompt
+        prompt_hash = hashlib.sha256(prompt.encode()).hexdigest()[:16]
+        return f"{self.config['vision_model']}:{self.config['vision_detail']}:{prompt_hash}:{','.join(file_unique_ids)}"
+
+    def get_cached_interpretation(self, chat_id: int, cache_key: str) -> CachedInterpretation | None:
+        """
+        Returns the cached answer to a vision request, if any,
+        and adds the request and its answer to the conversation as if the images had been interpreted again
+        """
+        cached = self.vision_cache.get(cache_key) if self.vision_cache is not None else None
+        if cached is None:
+            return None
+        if chat_id not in self.conversations or self.__max_age_reached(chat_id):
+            self.reset_chat_history(chat_id)
+        self.last_updated[chat_id] = datetime.datetime.now()
+        self.__add_vision_query_to_history(chat_id, list(cached.content))
+        self.__add_to_history(chat_id, role="assistant", content=cached.answer)
+        return cached
+
+    def __cache_interpretation(self, cache_key: str | None, content: list, answer: str):
+        if cache_key is not None and self.vision_cache is not None and answer != '':
+            tokens = self.__count_interpretation_tokens(content, answer)
+            self.vision_cache.set(cache_key, CachedInterpretation(content, answer, tokens))
+
+    def __count_interpretation_tokens(self, content: list, answer: str) -> int:
+        """
+        Counts the tokens of an interpretation on its own: its prompt, its images and its answer.
+        The rest of the conversation it was part of is not counted, as it is not reused with the answer.
+        """
+        counted = []
+        for part in content:
+            if part['type'] == 'image_ref' and part['image_ref']['tokens'] == 0:
+                # The cost of images is only computed when they are kept for follow-up questions
+                image_ref = part['image_ref']
+                try:
+                    tokens = self.__count_tokens_vision(image_ref['width'], image_ref['height'])
+                except NotImplementedError:
+                    tokens = 0
+                part = {'type': 'image_ref', 'image_ref': {**image_ref, 'tokens': tokens}}
+            counted.append(part)
+        return self.__count_tokens([{'role': 'user', 'content': counted}, {'role': 'assistant', 'content': answer}])
+
+    async def transcribe_segments(self, segments: list[tuple[bytes, str]]) -> str:
+        """
+        Transcribes consecutive, overlapping segments of a recording concurrently and stitches the transcripts.
+        A segment is prompted with the end of the previous segment's transcript, if it is already known.
+        :param segments: The segments, as (audio data, file name) tuples
+        :return: The transcript of the whole recording
+        """
+        if len(segments) == 1:
+            return await self.transcribe(*segments[0])
+
+        transcripts = [None] * len(segments)
+        concurrency = asyncio.Semaphore(max(1, self.config['transcription_max_concurrent_segments']))
+
+        async def _transcribe(index: int):
+            async with concurrency:
+                previous = transcripts[index - 1] if index > 0 else None
+                prompt = previous[-TRANSCRIPT_PROMPT_LENGTH:] if previous else None
+                transcripts[index] = await self.transcribe(*segments[index], prompt=prompt)
+
+        await gather_or_cancel(*(_transcribe(index) for index in range(len(segments))))
+        return merge_transcripts(transcripts)
+
     @retry(
         reraise=True,
         retry=retry_if_exception_type(openai.RateLimitError),
         wait=wait_fixed(20),
         stop=stop_after_attempt(3)
     )
-    async def __common_get_chat_response_vision(self, chat_id: int, content: list, stream=False):
+    async def __common_get_chat_response_vision(self, chat_id: int, content: list, images: dict[str, bytes],
+                                                stream=False):
         """
         Request a response from the GPT model.
         :param chat_id: The chat ID
-        :param query: The query to send to the model
+        :param content: The content of the message, with references to the images
+        :param images: The images referenced by the content, by key
         :return: The answer from the model and the number of tokens used
         """
         bot_language = self.config['bot_language']
@@ -406,14 +642,8 @@ class OpenAIHelper:
             self.last_updated[chat_id] = datetime.datetime.now()
 
             if self.config['enable_vision_follow_up_questions']:
-                self.conversations_vision[chat_id] = True
-                self.__add_to_history(chat_id, role="user", content=content)
-            else:
-                for message in content:
-                    if message['type'] == 'text':
-                        query = message['text']
-                        break
-                self.__add_to_history(chat_id, role="user", content=query)
+                await self.image_store.add(images)
+            self.__add_vision_query_to_history(chat_id, content)
 
             # Summarize the chat history if it's too long to avoid excessive token usage
             token_count = self.__count_tokens(self.conversations[chat_id])
@@ -438,7 +668,7 @@ class OpenAIHelper:
 
             common_args = {
                 'model': self.config['vision_model'],
-                'messages': self.conversations[chat_id][:-1] + [message],
+                'messages': await self.__materialize_images(self.conversations[chat_id][:-1] + [message], images),
                 'temperature': self.config['temperature'],
                 'n': 1, # several choices is not implemented yet
                 'max_tokens': self.config['vision_max_tokens'],
@@ -468,17 +698,121 @@ class OpenAIHelper:
             raise Exception(f"⚠️ _{localized_text('error', bot_language)}._ ⚠️\n{str(e)}") from e
 
 
-    async def interpret_image(self, chat_id, fileobj, prompt=None):
+    async def __prepare_image(self, image: bytes) -> tuple[dict, bytes]:
+        """
+        Downscales and re-encodes an image to what the vision model looks at, off the event loop
+        :return: The reference to the image, as kept in the conversation history, and the prepared image
+        """
+        detail = self.config['vision_detail']
+        prepared = await prepare_image_async(image, detail)
+        logging.info(f'Prepared image for vision: {len(image)} to {len(prepared.data)} bytes, '
+                     f'{prepared.width}x{prepared.height} {prepared.mime_type}')
+        image_ref = {
+            'key': hashlib.sha256(prepared.data).hexdigest(),
+            'mime_type': prepared.mime_type,
+            'width': prepared.width,
+            'height': prepared.height,
+            'detail': detail,
+            # The token cost only matters for images kept in the history
+            'tokens': self.__count_tokens_vision(prepared.width, prepared.height)
+            if self.config['enable_vision_follow_up_questions'] else 0,
+        }
+        return {'type': 'image_ref', 'image_ref': image_ref}, prepared.data
+
+    async def __vision_content(self, images: list[bytes], prompt: str | None) -> tuple[list[dict], dict[str, bytes]]:
         """
-        Interprets a given PNG image file using the Vision model.
+        Builds the content of a vision request: the prompt followed by references to the images,
+        which are prepared concurrently
+        :return: The content and the prepared images by key
         """
-        image = encode_image(fileobj)
         prompt = self.config['vision_prompt'] if prompt is None else prompt
+        prepared = await gather_or_cancel(*(self.__prepare_image(image) for image in images))
+        content = [{'type': 'text', 'text': prompt}] + [part for part, _ in prepared]
+        return content, {part['image_ref']['key']: data for part, data in prepared}
 
-        content = [{'type':'text', 'text':prompt}, {'type':'image_url', \
-                    'image_url': {'url':image, 'detail':self.config['vision_detail'] } }]
+    async def __materialize_images(self, messages: list[dict], images: dict[str, bytes] | None = None) -> list[dict]:
+        """
+        Replaces the image references of the messages by data URLs, to build the payload of a request.
+        The conversation history itself keeps the references only.
+        :param messages: The messages to send
+        :param images: Images already at hand by key, the others are loaded from the image store
+        :return: The messages with their images
+        """
+        images = dict(images or {})
+        missing = list(dict.fromkeys(part['image_ref']['key'] for message in messages
+                                     for part in image_refs(message) if part['image_ref']['key'] not in images))
+        if len(missing) > 0 and self.image_store is not None:
+            images.update(await self.image_store.get(missing))
+
+        materialized = []
+        for index, message in enumerate(messages):
+            if len(image_refs(message)) == 0:
+                materialized.append(message)
+                continue
+            content = []
+            unavailable = 0
+            for part in message['content']:
+                if part['type'] != 'image_ref':
+                    content.append(part)
+                elif part['image_ref']['key'] in images:
+                    image_ref = part['image_ref']
+                    content.append({'type': 'image_url', 'image_url': {
+                        'url': encode_image(images[image_ref['key']], image_ref['mime_type']),
+                        'detail': image_ref['detail'],
+                    }})
+                else:
+                    unavailable += 1
+            if unavailable > 0:
+                logging.warning(f'{unavailable} image(s) of the conversation are no longer in the image store')
+                content.append(image_placeholder(messages, index, unavailable))
+            materialized.append({**message, 'content': content})
+        return materialized
+
+    def __add_vision_query_to_history(self, chat_id: int, content: list):
+        """
+        Adds a vision request to the conversation history, with its images if follow-up questions are enabled
+        and as text only otherwise
+        """
+        if self.config['enable_vision_follow_up_questions']:
+            self.conversations_vision[chat_id] = True
+            self.__add_to_history(chat_id, role="user", content=content)
+        else:
+            for message in content:
+                if message['type'] == 'text':
+                    query = message['text']
+                    break
+            self.__add_to_history(chat_id, role="user", content=query)
+        self.__expire_images(chat_id)
 
-        response = await self.__common_get_chat_response_vision(chat_id, content)
+    def __expire_images(self, chat_id: int):
+        """
+        Removes the images of the conversation history followed by more than `vision_image_max_turns`
+        user messages, replacing them by the model's description of them
+        """
+        max_turns = self.config['vision_image_max_turns']
+        if max_turns <= 0:
+            return
+        conversation = self.conversations[chat_id]
+        turns = 0
+        for index in range(len(conversation) - 1, -1, -1):
+            message = conversation[index]
+            if message['role'] != 'user':
+                continue
+            refs = image_refs(message)
+            if turns > max_turns and len(refs) > 0:
+                content = [part for part in message['content'] if part['type'] != 'image_ref']
+                placeholder = image_placeholder(conversation, index, len(refs))
+                conversation[index] = {**message, 'content': content + [placeholder]}
+            turns += 1
+
+    async def interpret_image(self, chat_id, images: list[bytes], prompt=None, cache_key: str | None = None):
+        """
+        Interprets one or more images (e.g. an album) using the Vision model.
+        The answer is cached under `cache_key`, if given.
+        """
+        content, images = await self.__vision_content(images, prompt)
+
+        response = await self.__common_get_chat_response_vision(chat_id, content, images)
 
         
 
@@ -493,15 +827,16 @@ class OpenAIHelper:
 
         if len(response.choices) > 1 and self.config['n_choices'] > 1:
             for index, choice in enumerate(response.choices):
-                content = choice.message.content.strip()
+                choice_content = choice.message.content.strip()
                 if index == 0:
-                    self.__add_to_history(chat_id, role="assistant", content=content)
+                    self.__add_to_history(chat_id, role="assistant", content=choice_content)
                 answer += f'{index + 1}\u20e3\n'
-                answer += content
+                answer += choice_content
                 answer += '\n\n'
         else:
             answer = response.choices[0].message.content.strip()
             self.__add_to_history(chat_id, role="assistant", content=answer)
+        self.__cache_interpretation(cache_key, content, response.choices[0].message.content.strip())
 
         bot_language = self.config['bot_language']
         # Plugins are not enabled either
@@ -519,17 +854,15 @@ class OpenAIHelper:
 
         return answer, response.usage.total_tokens
 
-    async def interpret_image_stream(self, chat_id, fileobj, prompt=None):
+    async def interpret_image_stream(self, chat_id, images: list[bytes], prompt=None, cache_key: str | None = None):
         """
-        Interprets a given PNG image file using the Vision model.
+        Interprets one or more images (e.g. an album) using the Vision model, streaming the answer.
+        The answer is cached under `cache_key`, if given.
+        :return: An async generator of `TextDelta` events followed by a final `StreamFinished`
         """
-        image = encode_image(fileobj)
-        prompt = self.config['vision_prompt'] if prompt is None else prompt
+        content, images = await self.__vision_content(images, prompt)
 
-        content = [{'type':'text', 'text':prompt}, {'type':'image_url', \
-                    'image_url': {'url':image, 'detail':self.config['vision_detail'] } }]
-
-        response = await self.__common_get_chat_response_vision(chat_id, content, stream=True)
+        response = await self.__common_get_chat_response_vision(chat_id, content, images, stream=True)
 
         
 
@@ -539,28 +872,33 @@ class OpenAIHelper:
         #         yield response, '0'
         #         return
 
-        answer = ''
-        async for chunk in response:
-            if len(chunk.choices) == 0:
-                continue
-            delta = chunk.choices[0].delta
-            if delta.content:
-                answer += delta.content
-                yield answer, 'not_finished'
-        answer = answer.strip()
+        answer_parts = []
+        try:
+            async for event in self.__stream_text_deltas(response):
+                answer_parts.append(event.text)
+                yield event
+        except (asyncio.CancelledError, GeneratorExit):
+            self.__keep_partial_answer(chat_id, answer_parts)
+            raise
+        finally:
+            # Releases the upstream HTTP stream right away if the answer was interrupted
+            await response.close()
+        answer = ''.join(answer_parts).strip()
         self.__add_to_history(chat_id, role="assistant", content=answer)
-        tokens_used = str(self.__count_tokens(self.conversations[chat_id]))
+        tokens_used = self.__count_tokens(self.conversations[chat_id])
+        self.__cache_interpretation(cache_key, content, answer)
 
+        footer = ''
         #show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
         #plugin_names = tuple(self.plugin_manager.get_plugin_source_name(plugin) for plugin in plugins_used)
         if self.config['show_usage']:
-            answer += f"\n\n---\n💰 {tokens_used} {localized_text('stats_tokens', self.config['bot_language'])}"
+            footer += f"\n\n---\n💰 {tokens_used} {localized_text('stats_tokens', self.config['bot_language'])}"
         #     if show_plugins_used:
-        #         answer += f"\n🔌 {', '.join(plugin_names)}"
+        #         footer += f"\n🔌 {', '.join(plugin_names)}"
         # elif show_plugins_used:
-        #     answer += f"\n\n---\n🔌 {', '.join(plugin_names)}"
+        #     footer += f"\n\n---\n🔌 {', '.join(plugin_names)}"
 
-        yield answer, tokens_used
+        yield StreamFinished(tokens_used=tokens_used, footer=footer)
 
     def reset_chat_history(self, chat_id, content=''):
         """
@@ -671,9 +1009,8 @@ class OpenAIHelper:
                         num_tokens += len(encoding.encode(value))
                     else:
                         for message1 in value:
-                            if message1['type'] == 'image_url':
-                                image = decode_image(message1['image_url']['url'])
-                                num_tokens += self.__count_tokens_vision(image)
+                            if message1['type'] == 'image_ref':
+                                num_tokens += message1['image_ref']['tokens']
                             else:
                                 num_tokens += len(encoding.encode(message1['text']))
                 else:
@@ -685,19 +1022,18 @@ class OpenAIHelper:
 
     # no longer needed
 
-    def __count_tokens_vision(self, image_bytes: bytes) -> int:
+    def __count_tokens_vision(self, width: int, height: int) -> int:
         """
         Counts the number of tokens for interpreting an image.
-        :param image_bytes: image to interpret
+        :param width: width of the image to interpret
+        :param height: height of the image to interpret
         :return: the number of tokens required
         """
-        image_file = io.BytesIO(image_bytes)
-        image = Image.open(image_file)
         model = self.config['vision_model']
         if model not in GPT_4_VISION_MODELS:
             raise NotImplementedError(f"""count_tokens_vision() is not implemented for model {model}.""")
         
-        w, h = image.size
+        w, h = width, height
         if w > h: w, h = h, w
         # this computation follows https://platform.openai.com/docs/guides/vision and https://openai.com/pricing#gpt-4-turbo
         base_tokens = 85
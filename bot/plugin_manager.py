@@ -1,5 +1,8 @@
+from __future__ import annotations
+
 import json
 
+from plugin_result import ToolResult, DirectResult, to_plugin_result
 from plugins.gtts_text_to_speech import GTTSTextToSpeech
 from plugins.auto_tts import AutoTextToSpeech
 from plugins.dice import DicePlugin
@@ -49,14 +52,14 @@ class PluginManager:
         """
         return [spec for specs in map(lambda plugin: plugin.get_spec(), self.plugins) for spec in specs]
 
-    async def call_function(self, function_name, helper, arguments):
+    async def call_function(self, function_name, helper, arguments) -> ToolResult | DirectResult:
         """
         Call a function based on the name and parameters provided
         """
         plugin = self.__get_plugin_by_function_name(function_name)
         if not plugin:
-            return json.dumps({'error': f'Function {function_name} not found'})
-        return json.dumps(await plugin.execute(function_name, helper, **json.loads(arguments)), default=str)
+            return ToolResult(data={'error': f'Function {function_name} not found'})
+        return to_plugin_result(await plugin.execute(function_name, helper, **json.loads(arguments)))
 
     def get_plugin_source_name(self, function_name) -> str:
         """
@@ -0,0 +1,41 @@
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass
+from typing import Any
+
+
+@dataclass(frozen=True)
+class ToolResult:
+    """
+    A plugin result to be sent back to the model
+    """
+    data: Any
+
+    def to_json(self) -> str:
+        """
+        Serialises the result for the function message in the conversation history
+        """
+        return json.dumps(self.data, default=str)
+
+
+@dataclass(frozen=True)
+class DirectResult:
+    """
+    A plugin result to be sent directly to the user (e.g. a photo, a file or a dice)
+    """
+    kind: str
+    format: str
+    value: Any
+
+
+def to_plugin_result(response: dict) -> ToolResult | DirectResult:
+    """
+    Wraps the dictionary returned by a plugin in a typed result
+    :param response: The plugin response
+    :return: A `DirectResult` if the response contains a `direct_result` entry, a `ToolResult` otherwise
+    """
+    if isinstance(response, dict) and response.get('direct_result'):
+        result = response['direct_result']
+        return DirectResult(kind=result['kind'], format=result['format'], value=result['value'])
+    return ToolResult(data=response)
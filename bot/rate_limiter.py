@@ -0,0 +1,373 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import itertools
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Coroutine
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from utils import retry_after_seconds
+
+# Request priorities, lower values are sent first
+PRIORITY_FINAL = 0  # messages, uploads and final edits
+PRIORITY_STREAM_EDIT = 1  # intermediate edits of streamed answers
+PRIORITY_CHAT_ACTION = 2  # typing/uploading indicators
+
+# Number of retries after a flood control error, per priority
+DEFAULT_MAX_RETRIES = {
+    PRIORITY_FINAL: 2,
+    PRIORITY_STREAM_EDIT: 0,
+    PRIORITY_CHAT_ACTION: 0,
+}
+
+# Requests sending or editing messages, which count against Telegram's flood limits, are those whose endpoint
+# starts with one of these prefixes or is one of these endpoints. Other requests (e.g. getChatMember, getFile)
+# are sent right away.
+RATE_LIMITED_PREFIXES = ('send', 'edit')
+RATE_LIMITED_ENDPOINTS = {'answerInlineQuery', 'copyMessage', 'copyMessages', 'forwardMessage', 'forwardMessages'}
+
+# Flood control waits longer than this are not retried, the error is raised instead
+MAX_RETRY_AFTER = 60.0
+
+# Chat actions last 5 seconds, there is no point in sending them any later than that
+CHAT_ACTION_MAX_DELAY = 5.0
+
+# Buckets of idle chats are discarded once there are more than this many
+MAX_IDLE_BUCKETS = 1024
+
+# Interval in seconds between two stats log lines
+STATS_LOG_INTERVAL = 60.0
+
+
+class TokenBucket:
+    """
+    A token bucket refilling at a constant rate, used to spread requests over time.
+    A rate of zero disables the limit.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        """
+        Initializes the bucket, initially full.
+        :param rate: The number of tokens added per second
+        :param capacity: The maximum number of tokens, i.e. the allowed burst
+        """
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, now: float | None = None) -> float:
+        """
+        Returns the number of seconds to wait until a token is available
+        """
+        now = now or time.monotonic()
+        wait = max(0.0, self.blocked_until - now)
+        if self.rate <= 0:
+            return wait
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def consume(self):
+        """
+        Takes a token from the bucket
+        """
+        if self.rate > 0:
+            self.tokens -= 1
+
+    def block(self, seconds: float):
+        """
+        Stops handing out tokens for the given number of seconds
+        """
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def is_idle(self) -> bool:
+        """
+        Whether the bucket is full and not blocked, so it can be dropped and recreated later
+        """
+        return self.delay() == 0 and (self.rate <= 0 or self.tokens >= self.capacity)
+
+
+@dataclass(order=True)
+class _QueuedRequest:
+    priority: int
+    sequence: int
+    chat_key: Any = field(compare=False)
+    is_group: bool = field(compare=False)
+    endpoint: str = field(compare=False)
+    action_key: Any = field(compare=False)
+    enqueued_at: float = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+
+
+def is_rate_limited(endpoint: str) -> bool:
+    """
+    Whether requests to the endpoint send or edit messages (or chat actions), i.e. are subject to flood limits
+    """
+    return endpoint.startswith(RATE_LIMITED_PREFIXES) or endpoint in RATE_LIMITED_ENDPOINTS
+
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """
+    Schedules the outbound Bot API requests sending or editing messages.
+    Telegram's global, per-chat and per-group limits are enforced with token buckets and
+    queued requests are sent by priority: final answers first, then intermediate edits of
+    streamed answers, then chat actions. Chat actions that cannot be sent in time are dropped.
+    The priority of a request is derived from its endpoint and can be overridden by passing
+    `rate_limit_args={'priority': ...}` to the bot method.
+    """
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, group_rate: float = 20):
+        """
+        Initializes the rate limiter.
+        :param global_rate: The maximum number of requests per second for the whole bot
+        :param chat_rate: The maximum number of requests per second in a single chat
+        :param group_rate: The maximum number of requests per minute in a single group
+        """
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate / 60
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}  # {chat_key: TokenBucket}
+        self.group_buckets = {}  # {chat_key: TokenBucket}
+
+        self.queue: list[_QueuedRequest] = []
+        self.sequence = itertools.count()
+        self.wakeup: asyncio.Event | None = None  # created in the event loop running the bot
+        self.dispatcher: asyncio.Task | None = None
+
+        # Stats
+        self.requests_sent = 0
+        self.chat_actions_dropped = 0
+        self.flood_waits = 0
+        self.wait_times = {priority: [] for priority in DEFAULT_MAX_RETRIES}  # since the last stats log
+        self.stats_logged_at = time.monotonic()
+
+    async def initialize(self) -> None:
+        self.__start()
+
+    async def shutdown(self) -> None:
+        if self.dispatcher is not None:
+            self.dispatcher.cancel()
+            try:
+                await self.dispatcher
+            except asyncio.CancelledError:
+                pass
+            self.dispatcher = None
+        for request in self.queue:
+            request.future.cancel()
+        self.queue.clear()
+
+    async def process_request(self, callback: Callable[..., Coroutine[Any, Any, Any]], args: Any,
+                              kwargs: dict[str, Any], endpoint: str, data: dict[str, Any],
+                              rate_limit_args: dict | None) -> Any:
+        if not is_rate_limited(endpoint):
+            # Read-only requests (e.g. membership lookups, file downloads) don't count against flood limits
+            return await callback(*args, **kwargs)
+
+        # Requests not addressed to a chat (e.g. inline query answers) only count against the global limit
+        chat_key, is_group = self.__chat_key(data)
+
+        priority = self.__priority(endpoint, rate_limit_args)
+        max_retries = (rate_limit_args or {}).get('max_retries', DEFAULT_MAX_RETRIES.get(priority, 0))
+        action_key = None
+        if endpoint == 'sendChatAction':
+            action_key = (chat_key, data.get('message_thread_id'), data.get('action'))
+            if any(request.action_key == action_key for request in self.queue):
+                # The queued chat action covers this one too
+                return True
+
+        for attempt in range(max_retries + 1):
+            if not await self.__acquire(priority, chat_key, is_group, endpoint, action_key):
+                self.chat_actions_dropped += 1
+                return True
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                retry_after = retry_after_seconds(e)
+                self.flood_waits += 1
+                if chat_key is not None:
+                    self.__chat_bucket(chat_key).block(retry_after)
+                    logging.info(f'Flood control hit for {endpoint} in chat {chat_key}: '
+                                 f'chat blocked for {retry_after}s')
+                else:
+                    self.global_bucket.block(retry_after)
+                    logging.info(f'Flood control hit for {endpoint}: bot blocked for {retry_after}s')
+                if attempt == max_retries or retry_after > MAX_RETRY_AFTER:
+                    raise e
+
+    def stats(self) -> dict:
+        """
+        Returns the current queue depth and the wait times since the last stats log
+        """
+        wait_times = list(itertools.chain.from_iterable(self.wait_times.values()))
+        return {
+            'queue_depth': len(self.queue),
+            'queue_depth_by_priority': {
+                priority: sum(1 for request in self.queue if request.priority == priority)
+                for priority in self.wait_times
+            },
+            'requests_sent': self.requests_sent,
+            'chat_actions_dropped': self.chat_actions_dropped,
+            'flood_waits': self.flood_waits,
+            'average_wait': sum(wait_times) / len(wait_times) if wait_times else 0.0,
+            'max_wait': max(wait_times, default=0.0),
+            'max_wait_by_priority': {
+                priority: max(waits, default=0.0) for priority, waits in self.wait_times.items()
+            },
+        }
+
+    @staticmethod
+    def __chat_key(data: dict[str, Any]) -> tuple[Any, bool]:
+        """
+        Returns the chat a request is addressed to and whether it is a group or channel
+        """
+        chat_id = data.get('chat_id')
+        if chat_id is None:
+            inline_message_id = data.get('inline_message_id')
+            return (('inline', inline_message_id) if inline_message_id is not None else None), False
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            # @channelusername
+            return chat_id, True
+        return chat_id, chat_id < 0
+
+    @staticmethod
+    def __priority(endpoint: str, rate_limit_args: dict | None) -> int:
+        if rate_limit_args and 'priority' in rate_limit_args:
+            return rate_limit_args['priority']
+        if endpoint == 'sendChatAction':
+            return PRIORITY_CHAT_ACTION
+        return PRIORITY_FINAL
+
+    def __chat_bucket(self, chat_key) -> TokenBucket:
+        if chat_key not in self.chat_buckets:
+            self.chat_buckets[chat_key] = TokenBucket(self.chat_rate, self.chat_rate)
+        return self.chat_buckets[chat_key]
+
+    def __group_bucket(self, chat_key) -> TokenBucket:
+        if chat_key not in self.group_buckets:
+            self.group_buckets[chat_key] = TokenBucket(self.group_rate, self.group_rate * 60)
+        return self.group_buckets[chat_key]
+
+    def __start(self):
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.create_task(self.__dispatch())
+
+    async def __acquire(self, priority: int, chat_key, is_group: bool, endpoint: str, action_key) -> bool:
+        """
+        Queues a request and waits for its turn.
+        :return: False if the request was dropped instead
+        """
+        self.__start()
+        request = _QueuedRequest(
+            priority=priority,
+            sequence=next(self.sequence),
+            chat_key=chat_key,
+            is_group=is_group,
+            endpoint=endpoint,
+            action_key=action_key,
+            enqueued_at=time.monotonic(),
+            future=asyncio.get_running_loop().create_future(),
+        )
+        bisect.insort(self.queue, request)
+        self.wakeup.set()
+        try:
+            return await request.future
+        finally:
+            if not request.future.done():
+                request.future.cancel()
+
+    def __delay(self, request: _QueuedRequest, now: float) -> float:
+        if request.chat_key is None:
+            return 0.0
+        delay = self.__chat_bucket(request.chat_key).delay(now)
+        if request.is_group:
+            delay = max(delay, self.__group_bucket(request.chat_key).delay(now))
+        return delay
+
+    async def __dispatch(self):
+        """
+        Hands out the turns to the queued requests, in order of priority
+        """
+        while True:
+            now = time.monotonic()
+            self.__log_stats(now)
+            timeout = None
+            global_delay = self.global_bucket.delay(now)
+            if global_delay > 0:
+                timeout = global_delay
+            else:
+                for request in list(self.queue):
+                    if request.future.done():
+                        # The caller went away
+                        self.queue.remove(request)
+                        continue
+                    if request.priority == PRIORITY_CHAT_ACTION and \
+                            now - request.enqueued_at > CHAT_ACTION_MAX_DELAY:
+                        self.queue.remove(request)
+                        request.future.set_result(False)
+                        continue
+                    delay = self.__delay(request, now)
+                    if delay == 0:
+                        self.__grant(request, now)
+                        timeout = 0
+                        break
+                    timeout = delay if timeout is None else min(timeout, delay)
+
+            if timeout == 0:
+                # Let the granted request run before handing out the next turn
+                await asyncio.sleep(0)
+                continue
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def __grant(self, request: _QueuedRequest, now: float):
+        self.queue.remove(request)
+        self.global_bucket.consume()
+        if request.chat_key is not None:
+            self.__chat_bucket(request.chat_key).consume()
+        if request.is_group:
+            self.__group_bucket(request.chat_key).consume()
+        self.requests_sent += 1
+        self.wait_times.setdefault(request.priority, []).append(now - request.enqueued_at)
+        request.future.set_result(True)
+
+    def __log_stats(self, now: float):
+        """
+        Periodically logs the queue depth and wait times, and drops the buckets of idle chats
+        """
+        if now - self.stats_logged_at < STATS_LOG_INTERVAL:
+            return
+        stats = self.stats()
+        if stats['requests_sent'] > 0 or stats['queue_depth'] > 0:
+            logging.info(f'Rate limiter: queue depth {stats["queue_depth"]}, '
+                         f'{stats["requests_sent"]} requests sent, '
+                         f'average wait {stats["average_wait"]:.2f}s, max wait {stats["max_wait"]:.2f}s, '
+                         f'{stats["chat_actions_dropped"]} chat actions dropped, '
+                         f'{stats["flood_waits"]} flood control errors')
+        self.stats_logged_at = now
+        self.requests_sent = 0
+        self.chat_actions_dropped = 0
+        self.flood_waits = 0
+        self.wait_times = {priority: [] for priority in self.wait_times}
+
+        for buckets in (self.chat_buckets, self.group_buckets):
+            if len(buckets) > MAX_IDLE_BUCKETS:
+                queued = {request.chat_key for request in self.queue}
+                for chat_key in [key for key, bucket in buckets.items() if key not in queued and bucket.is_idle()]:
+                    del buckets[chat_key]
@@ -0,0 +1,391 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import queue
+import signal
+import time
+from typing import Any, Callable
+from urllib.parse import urlparse
+
+from telegram import Bot, Update
+from telegram.error import TelegramError
+from telegram.request import HTTPXRequest
+
+from webhook_server import WebhookServer
+
+# Number of points per worker on the hash ring
+RING_REPLICAS = 100
+
+# Seconds between two heartbeats of a worker
+HEARTBEAT_INTERVAL = 5.0
+
+# A worker that did not send a heartbeat for this many seconds is restarted
+HEARTBEAT_TIMEOUT = 30.0
+
+# Seconds between two load log lines
+LOAD_LOG_INTERVAL = 60.0
+
+# Long polling timeout in seconds
+POLLING_TIMEOUT = 30
+
+# Seconds to wait for a worker to exit before killing it
+SHUTDOWN_TIMEOUT = 10.0
+
+# Seconds to wait for more updates when draining the queue of a stopped worker
+DRAIN_TIMEOUT = 0.5
+
+# Keys of the update types that are not sent in a chat
+USER_SCOPED_UPDATES = ('inline_query', 'chosen_inline_result', 'callback_query')
+
+
+class HashRing:
+    """
+    A consistent hash ring, mapping keys to nodes so that changing the number of nodes
+    only moves a small share of the keys
+    """
+
+    def __init__(self, nodes: list[int], replicas: int = RING_REPLICAS):
+        """
+        Initializes the ring.
+        :param nodes: The nodes to distribute the keys to
+        :param replicas: The number of points per node on the ring
+        """
+        self.points = sorted(
+            (self.__hash(f'{node}:{replica}'), node) for node in nodes for replica in range(replicas)
+        )
+        self.hashes = [point for point, _ in self.points]
+
+    def node_for(self, key) -> int:
+        """
+        Returns the node the key belongs to
+        """
+        index = bisect.bisect(self.hashes, self.__hash(str(key))) % len(self.points)
+        return self.points[index][1]
+
+    @staticmethod
+    def __hash(value: str) -> int:
+        # The built-in hash() is salted per process, so it cannot be used for routing
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+def routing_key(update: dict):
+    """
+    Returns the key an update is routed by: the chat id, or the user id for updates
+    that do not belong to a chat (inline queries and callbacks of inline messages).
+    The id of a private chat is the id of the user, so inline answers are handled by the worker
+    holding the private conversation they continue.
+    """
+    for update_type, content in update.items():
+        if not isinstance(content, dict):
+            continue
+        if update_type == 'callback_query' and isinstance(content.get('message'), dict):
+            return content['message']['chat']['id']
+        if update_type in USER_SCOPED_UPDATES:
+            return content["from"]["id"]
+        if isinstance(content.get('chat'), dict):
+            return content['chat']['id']
+        if isinstance(content.get('from'), dict):
+            return content["from"]["id"]
+    return update.get('update_id')
+
+
+def run_worker(index: int, bot_factory: Callable[..., Any], factory_args: tuple,
+               updates: multiprocessing.Queue, status: multiprocessing.Queue):
+    """
+    Entry point of a worker process: runs a bot handling the updates routed to it
+    """
+    # Ctrl+C reaches the whole process group, the ingress process stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(
+        format=f'%(asctime)s - worker {index} - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    bot = bot_factory(*factory_args)
+    asyncio.run(_serve_worker(index, bot, updates, status))
+
+
+async def _serve_worker(index: int, bot, updates: multiprocessing.Queue, status: multiprocessing.Queue):
+    application = bot.build_application()
+    loop = asyncio.get_running_loop()
+    processed = 0
+
+    async def send_heartbeats():
+        while True:
+            try:
+                pending = updates.qsize()
+            except NotImplementedError:
+                # Not available on macOS
+                pending = 0
+            status.put((index, {
+                'time': time.time(),
+                'processed': processed,
+                'pending': pending + application.update_queue.qsize(),
+            }))
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    async with application:
+        if index == 0:
+            # Commands only need to be registered once
+            await bot.post_init(application)
+        await application.start()
+        heartbeat = asyncio.create_task(send_heartbeats())
+        try:
+            while True:
+                data = await loop.run_in_executor(None, updates.get)
+                if data is None:
+                    break
+                await application.update_queue.put(Update.de_json(data, application.bot))
+                processed += 1
+        finally:
+            heartbeat.cancel()
+            await application.stop()
+
+
+class WorkerProcess:
+    """
+    A worker process and the queue of updates routed to it
+    """
+
+    def __init__(self, index: int, context, target_args: tuple):
+        self.index = index
+        self.context = context
+        self.target_args = target_args
+        self.updates = None
+        self.process = None
+        self.restarts = 0
+        self.routed = 0
+        # updates put in the current queue
+        self.queued = 0
+        # updates routed while the worker restarts, sent to the new process once it is started
+        self.buffered = None
+        self.last_status = {}
+        self.last_heartbeat = 0.0
+
+    def start(self, status: multiprocessing.Queue):
+        # A process killed while using a queue can leave it corrupted, so every process gets a new one
+        self.updates = self.context.Queue()
+        self.queued = 0
+        self.process = self.context.Process(
+            target=run_worker,
+            args=(self.index, *self.target_args, self.updates, status),
+            name=f'worker-{self.index}',
+            daemon=True
+        )
+        self.process.start()
+        self.last_heartbeat = time.monotonic()
+
+    def send(self, update: dict):
+        """
+        Sends an update to the worker, or keeps it until the worker is started again if it is restarting
+        """
+        if self.buffered is not None:
+            self.buffered.append(update)
+        else:
+            self.updates.put(update)
+            self.queued += 1
+
+    def drain(self) -> list[dict]:
+        """
+        Returns the updates left in the queue of the stopped worker, so that they can be sent to the new process
+        """
+        updates = []
+        while True:
+            try:
+                update = self.updates.get(timeout=DRAIN_TIMEOUT)
+            except queue.Empty:
+                break
+            except Exception as e:
+                # The queue may be corrupted if the process was killed while reading it
+                logging.warning(f'Failed to drain the queue of worker {self.index}: {str(e)}')
+                break
+            if update is not None:
+                updates.append(update)
+        self.updates.close()
+        # Updates that could not be drained must not keep the ingress from exiting
+        self.updates.cancel_join_thread()
+        return updates
+
+    def is_healthy(self) -> bool:
+        return self.process.is_alive() and time.monotonic() - self.last_heartbeat < HEARTBEAT_TIMEOUT
+
+    def stop(self):
+        if self.process.is_alive():
+            self.updates.put(None)
+            self.process.join(SHUTDOWN_TIMEOUT)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+
+class ShardedBot:
+    """
+    Runs the bot in several worker processes to use more than one CPU core.
+    The ingress process receives the updates (long polling or webhook) and routes them by
+    consistent hash of the chat id, so each chat's updates are handled in order by the same worker,
+    which keeps the conversation in memory. Workers send heartbeats and are restarted if they die
+    or stop responding.
+    """
+
+    def __init__(self, config: dict, workers: int, bot_factory: Callable[..., Any], factory_args: tuple):
+        """
+        Initializes the ingress.
+        :param config: The Telegram bot configuration
+        :param workers: The number of worker processes
+        :param bot_factory: Top-level function creating a `ChatGPTTelegramBot` in a worker process
+        :param factory_args: Arguments for `bot_factory`, must be picklable
+        """
+        self.config = config
+        self.context = multiprocessing.get_context('spawn')
+        self.status = self.context.Queue()
+        self.workers = [WorkerProcess(index, self.context, (bot_factory, factory_args)) for index in range(workers)]
+        self.ring = HashRing(list(range(workers)))
+        self.stop_event = None
+        self.load_logged_at = time.monotonic()
+
+    def route(self, update: dict):
+        """
+        Sends an update to the worker responsible for its chat
+        """
+        worker = self.workers[self.ring.node_for(routing_key(update))]
+        worker.send(update)
+        worker.routed += 1
+
+    async def monitor(self):
+        """
+        Collects the workers' heartbeats, restarts unhealthy workers and logs their load
+        """
+        while not self.stop_event.is_set():
+            while True:
+                try:
+                    index, worker_status = self.status.get_nowait()
+                except queue.Empty:
+                    break
+                self.workers[index].last_status = worker_status
+                self.workers[index].last_heartbeat = time.monotonic()
+
+            for worker in self.workers:
+                if not worker.is_healthy():
+                    logging.warning(f'Worker {worker.index} is not responding (exit code: '
+                                    f'{worker.process.exitcode}), restarting it')
+                    await self.restart(worker)
+
+            if time.monotonic() - self.load_logged_at >= LOAD_LOG_INTERVAL:
+                self.load_logged_at = time.monotonic()
+                logging.info('Worker load: ' + ', '.join(
+                    f'#{worker.index}: {worker.routed} routed, {worker.last_status.get("processed", 0)} processed, '
+                    f'{worker.last_status.get("pending", 0)} pending, {worker.restarts} restarts'
+                    for worker in self.workers
+                ))
+
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), timeout=HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def restart(self, worker: WorkerProcess):
+        """
+        Restarts a worker. The updates left in its queue and those routed to it in the meantime
+        are sent to the new process, the updates the stopped process had already taken are lost.
+        """
+        worker.buffered = []
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, worker.stop)
+        left = await loop.run_in_executor(None, worker.drain)
+        # Updates taken from the queue since the last heartbeat were probably not handled
+        lost = max(0, worker.queued - len(left) - worker.last_status.get('processed', 0))
+        worker.restarts += 1
+        worker.last_status = {}
+        worker.start(self.status)
+        updates, worker.buffered = left + worker.buffered, None
+        for update in updates:
+            worker.send(update)
+        logging.warning(f'Restarted worker {worker.index}: {len(left)} updates left in its queue and '
+                        f'{len(updates) - len(left)} routed during the restart were sent again, '
+                        f'{lost} updates taken by the stopped process since its last heartbeat may be lost')
+
+    async def poll(self, bot: Bot):
+        """
+        Fetches updates with long polling until the bot is stopped
+        """
+        await bot.delete_webhook()
+        offset = None
+        while not self.stop_event.is_set():
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=POLLING_TIMEOUT,
+                                                read_timeout=POLLING_TIMEOUT + 10,
+                                                allowed_updates=Update.ALL_TYPES)
+            except TelegramError as e:
+                logging.warning(f'Failed to get updates: {str(e)}')
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                self.route(update.to_dict())
+                offset = update.update_id + 1
+
+    async def serve(self):
+        """
+        Starts the workers and routes updates to them until the process is stopped
+        """
+        self.stop_event = asyncio.Event()
+        for stop_signal in (signal.SIGINT, signal.SIGTERM):
+            try:
+                asyncio.get_running_loop().add_signal_handler(stop_signal, self.stop_event.set)
+            except NotImplementedError:
+                pass
+
+        for worker in self.workers:
+            worker.start(self.status)
+        logging.info(f'Started {len(self.workers)} workers')
+
+        bot = Bot(
+            token=self.config['token'],
+            request=HTTPXRequest(proxy=self.config['proxy']),
+            get_updates_request=HTTPXRequest(proxy=self.config['proxy'])
+        )
+        monitor = asyncio.create_task(self.monitor())
+        server = None
+        async with bot:
+            try:
+                if self.config['webhook_url']:
+                    async def enqueue(data: dict):
+                        self.route(data)
+
+                    server = WebhookServer(
+                        listen=self.config['webhook_listen'],
+                        port=self.config['webhook_port'],
+                        path=urlparse(self.config['webhook_url']).path,
+                        secret_token=self.config['webhook_secret_token'],
+                        handler=enqueue
+                    )
+                    await server.start()
+                    try:
+                        await bot.set_webhook(url=self.config['webhook_url'],
+                                              secret_token=self.config['webhook_secret_token'],
+                                              allowed_updates=Update.ALL_TYPES)
+                    except TelegramError as e:
+                        logging.error(f'Failed to register the webhook {self.config["webhook_url"]}: {str(e)}')
+                    await self.stop_event.wait()
+                else:
+                    polling = asyncio.create_task(self.poll(bot))
+                    await self.stop_event.wait()
+                    polling.cancel()
+                    await asyncio.gather(polling, return_exceptions=True)
+            finally:
+                self.stop_event.set()
+                if server is not None:
+                    await server.stop()
+                await monitor
+                for worker in self.workers:
+                    await asyncio.get_running_loop().run_in_executor(None, worker.stop)
+                logging.info('All workers stopped')
+
+    def run(self):
+        """
+        Runs the bot indefinitely until the user presses Ctrl+C
+        """
+        asyncio.run(self.serve())
@@ -0,0 +1,42 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Any
+
+
+@dataclass(frozen=True)
+class TextDelta:
+    """
+    A new piece of the answer text
+    """
+    text: str
+
+
+@dataclass(frozen=True)
+class ToolCallStarted:
+    """
+    The model requested a function call, which is about to be executed
+    """
+    function_name: str
+    arguments: str
+
+
+@dataclass(frozen=True)
+class ToolCallFinished:
+    """
+    A function call requested by the model has been executed
+    """
+    function_name: str
+    result: Any
+
+
+@dataclass(frozen=True)
+class StreamFinished:
+    """
+    The answer is complete.
+    `footer` contains the usage/plugin information to append to the answer,
+    `direct_result` is set if a plugin result must be sent directly to the user instead.
+    """
+    tokens_used: int
+    footer: str = ''
+    direct_result: Any = None
@@ -0,0 +1,297 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import Callable
+
+from telegram import InlineKeyboardMarkup, Message, Update
+from telegram.error import RetryAfter, TimedOut
+from telegram.ext import ContextTypes
+
+from message_chunker import MessageChunker, TELEGRAM_MESSAGE_LIMIT
+from rate_limiter import PRIORITY_STREAM_EDIT
+from utils import is_group_chat, get_thread_id, get_reply_to_message_id, edit_message_with_retry, \
+    reply_text_markdown, retry_after_seconds
+
+# Minimum number of seconds between two edits of a streamed message, per kind of chat.
+# Telegram allows about one message per second in private chats and 20 messages per minute in groups.
+DEFAULT_EDIT_INTERVALS = {
+    'private': 1.0,
+    'group': 3.0,
+    'inline': 1.5,
+}
+
+# Upper bound for the edit interval learned from flood control errors
+MAX_EDIT_INTERVAL = 15.0
+
+# Number of attempts for edits that must be delivered (rollovers and final answers)
+FORCED_EDIT_ATTEMPTS = 3
+
+
+class EditScheduler:
+    """
+    Tracks how often streamed messages can be edited in each chat.
+    Starts from the default interval for the kind of chat, backs off when Telegram answers
+    with `RetryAfter` and slowly recovers after successful edits.
+    """
+
+    def __init__(self, intervals: dict[str, float] | None = None):
+        """
+        Initializes the scheduler.
+        :param intervals: Default edit interval in seconds per kind of chat (private, group, inline)
+        """
+        self.intervals = intervals or DEFAULT_EDIT_INTERVALS
+        self.chat_intervals = {}  # {chat_key: interval in seconds}
+        self.blocked_until = {}  # {chat_key: monotonic timestamp}
+
+    def interval(self, chat_key, kind: str) -> float:
+        """
+        Returns the current minimum interval between two edits in the given chat
+        """
+        return self.chat_intervals.get(chat_key, self.intervals[kind])
+
+    def delay(self, chat_key) -> float:
+        """
+        Returns the number of seconds to wait before the chat accepts edits again
+        """
+        blocked_until = self.blocked_until.get(chat_key)
+        if blocked_until is None:
+            return 0.0
+        remaining = blocked_until - time.monotonic()
+        if remaining <= 0:
+            del self.blocked_until[chat_key]
+            return 0.0
+        return remaining
+
+    def on_success(self, chat_key, kind: str):
+        """
+        Lowers a previously learned interval back towards the default one
+        """
+        interval = self.chat_intervals.get(chat_key)
+        if interval is None:
+            return
+        interval *= 0.9
+        if interval <= self.intervals[kind]:
+            del self.chat_intervals[chat_key]
+        else:
+            self.chat_intervals[chat_key] = interval
+
+    def on_retry_after(self, chat_key, kind: str, retry_after: float):
+        """
+        Blocks the chat for the requested time and doubles its edit interval
+        """
+        self.blocked_until[chat_key] = time.monotonic() + retry_after
+        self.chat_intervals[chat_key] = min(MAX_EDIT_INTERVAL, self.interval(chat_key, kind) * 2)
+        logging.info(f'Flood control hit for chat {chat_key}: retrying in {retry_after}s, '
+                     f'edit interval is now {self.chat_intervals[chat_key]:.1f}s')
+
+
+class StreamRenderer:
+    """
+    Renders a streamed answer into one or more Telegram messages.
+    The answer is fed as text deltas. Edits are sent based on elapsed time and the chat's
+    flood limits, intermediate snapshots that arrive too early or that would not change the
+    message are dropped. Markdown is converted locally, so partial answers are formatted too.
+    Answers longer than Telegram's message limit are rolled over into new messages
+    (except for inline messages, which are truncated).
+    """
+
+    def __init__(self, context: ContextTypes.DEFAULT_TYPE, scheduler: EditScheduler, update: Update, config: dict,
+                 inline_message_id: str | None = None, formatter: Callable[[str, bool], str] | None = None,
+                 reply_markup: InlineKeyboardMarkup | None = None):
+        """
+        Initializes the renderer for a single streamed answer.
+        :param context: The context to use
+        :param scheduler: The edit scheduler shared by all streams
+        :param update: Telegram update object
+        :param config: The bot configuration
+        :param inline_message_id: The inline message to edit, if the answer is for an inline query
+        :param formatter: Optional function building the message text from the content and a `final` flag
+        :param reply_markup: Optional inline keyboard shown on the messages until they are complete
+        """
+        self.context = context
+        self.scheduler = scheduler
+        self.update = update
+        self.config = config
+        self.inline_message_id = inline_message_id
+        self.formatter = formatter or (lambda content, final: content)
+        self.reply_markup = reply_markup
+
+        if inline_message_id is not None:
+            self.kind = 'inline'
+            self.chat_key = ('inline', update.effective_user.id)
+        else:
+            self.kind = 'group' if is_group_chat(update) else 'private'
+            self.chat_key = update.effective_chat.id
+
+        self.message: Message | None = None
+        self.messages_sent = 0
+        self.parts = []  # all text received so far
+        self.chunker = MessageChunker(TELEGRAM_MESSAGE_LIMIT)  # holds the text of the current message
+        self.last_text = ''
+        self.last_edit_at = 0.0
+        self.has_markup = False  # whether the current message shows the reply markup
+
+        # Metrics
+        self.started_at = time.monotonic()
+        self.first_byte_at = None
+        self.edits_sent = 0
+        self.edits_dropped = 0
+
+    @property
+    def content(self) -> str:
+        """
+        The complete text received so far
+        """
+        return ''.join(self.parts)
+
+    async def feed(self, delta: str):
+        """
+        Adds a new piece of the answer and renders it, if the chat's edit schedule allows it.
+        :param delta: The text received since the last call
+        """
+        if len(self.parts) == 0:
+            delta = delta.lstrip()
+            if len(delta) == 0:
+                return
+        self.parts.append(delta)
+
+        await self.__roll_over(delta)
+        text = self.__text(self.chunker.tail, final=False)
+        if len(text.strip()) == 0 or text == self.last_text:
+            return
+
+        if self.inline_message_id is None and self.message is None:
+            # Start the message right away, unless the chat is blocked by flood control
+            if self.scheduler.delay(self.chat_key) > 0:
+                self.edits_dropped += 1
+            else:
+                await self.__send_message(text)
+            return
+
+        if self.scheduler.delay(self.chat_key) > 0 or \
+                time.monotonic() - self.last_edit_at < self.scheduler.interval(self.chat_key, self.kind):
+            self.edits_dropped += 1
+            return
+
+        await self.__edit(text)
+
+    async def finish(self, footer: str = ''):
+        """
+        Renders the complete answer, waiting for flood limits if needed, and logs the stream metrics.
+        :param footer: Text to append to the answer (e.g. usage information)
+        """
+        self.chunker.tail = self.chunker.tail.rstrip()
+        await self.__roll_over(footer)
+        text = self.__text(self.chunker.tail, final=True)
+        if len(text.strip()) > 0:
+            if self.inline_message_id is None and self.message is None:
+                await self.__send_message(text, force=True)
+            else:
+                await self.__edit(text, force=True)
+
+        now = time.monotonic()
+        time_to_first_byte = (self.first_byte_at or now) - self.started_at
+        logging.info(f'Stream finished in chat {self.chat_key}: {self.edits_sent} edits sent, '
+                     f'{self.edits_dropped} edits dropped, first byte after {time_to_first_byte:.2f}s, '
+                     f'final after {now - self.started_at:.2f}s')
+
+    def __text(self, content: str, final: bool) -> str:
+        text = self.formatter(content, final)
+        if self.inline_message_id is not None:
+            # No chunking allowed in inline mode, only send the first 4096 characters
+            text = text[:TELEGRAM_MESSAGE_LIMIT]
+        return text
+
+    async def __roll_over(self, delta: str):
+        """
+        Adds the delta to the current message. Once it reaches Telegram's length limit,
+        the message is completed and a new one is started.
+        """
+        if self.inline_message_id is not None:
+            # The rest of the answer would be truncated anyway
+            if len(self.chunker.tail) < TELEGRAM_MESSAGE_LIMIT:
+                self.chunker.tail += delta
+            return
+
+        for completed in self.chunker.feed(delta):
+            completed = self.__text(completed, final=True)
+            if self.message is None:
+                await self.__send_message(completed, force=True)
+            else:
+                await self.__edit(completed, force=True)
+            # The next message is sent as soon as there is text for it
+            self.message = None
+
+    async def __send_message(self, text: str, force: bool = False):
+        """
+        Sends a new message, quoting the user's message only for the first one
+        """
+        reply_to_message_id = get_reply_to_message_id(self.config, self.update) if self.messages_sent == 0 else None
+        attempts = FORCED_EDIT_ATTEMPTS if force else 1
+        for _ in range(attempts):
+            if force:
+                await asyncio.sleep(self.scheduler.delay(self.chat_key))
+            try:
+                self.message = await reply_text_markdown(
+                    self.update.effective_message,
+                    message_thread_id=get_thread_id(self.update),
+                    reply_to_message_id=reply_to_message_id,
+                    reply_markup=None if force else self.reply_markup,
+                    text=text
+                )
+            except RetryAfter as e:
+                self.scheduler.on_retry_after(self.chat_key, self.kind, retry_after_seconds(e))
+                continue
+            except TimedOut:
+                continue
+            except Exception as e:
+                logging.warning(f'Failed to send streamed message: {str(e)}')
+                break
+
+            self.messages_sent += 1
+            self.first_byte_at = self.first_byte_at or time.monotonic()
+            self.last_text = text
+            self.last_edit_at = time.monotonic()
+            self.has_markup = not force and self.reply_markup is not None
+            self.edits_sent += 1
+            return
+
+        self.edits_dropped += 1
+
+    async def __edit(self, text: str, force: bool = False):
+        if text == self.last_text and not (force and self.has_markup):
+            # Telegram would answer with "Message is not modified"
+            return
+        attempts = FORCED_EDIT_ATTEMPTS if force else 1
+        for _ in range(attempts):
+            if force:
+                await asyncio.sleep(self.scheduler.delay(self.chat_key))
+            try:
+                await edit_message_with_retry(
+                    self.context,
+                    chat_id=None if self.inline_message_id is not None else self.message.chat_id,
+                    message_id=self.inline_message_id or str(self.message.message_id),
+                    text=text,
+                    is_inline=self.inline_message_id is not None,
+                    rate_limit_args=None if force else {'priority': PRIORITY_STREAM_EDIT},
+                    reply_markup=None if force else self.reply_markup
+                )
+            except RetryAfter as e:
+                self.scheduler.on_retry_after(self.chat_key, self.kind, retry_after_seconds(e))
+                continue
+            except TimedOut:
+                continue
+            except Exception:
+                break
+
+            self.scheduler.on_success(self.chat_key, self.kind)
+            self.first_byte_at = self.first_byte_at or time.monotonic()
+            self.last_text = text
+            self.last_edit_at = time.monotonic()
+            self.has_markup = not force and self.reply_markup is not None
+            self.edits_sent += 1
+            return
+
+        self.edits_dropped += 1
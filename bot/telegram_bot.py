@@ -1,27 +1,56 @@
 from __future__ import annotations
 
 import asyncio
+import functools
+import hashlib
 import logging
-import os
-import io
+import signal
 
+from urllib.parse import urlparse
 from uuid import uuid4
 from telegram import BotCommandScopeAllGroupChats, Update, constants
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton, InlineQueryResultArticle
-from telegram import InputTextMessageContent, BotCommand
-from telegram.error import RetryAfter, TimedOut, BadRequest
+from telegram import InputTextMessageContent, BotCommand, Message
+from telegram.error import TelegramError
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, \
-    filters, InlineQueryHandler, CallbackQueryHandler, Application, ContextTypes, CallbackContext
-
-from pydub import AudioSegment
-from PIL import Image
-
-from utils import is_group_chat, get_thread_id, message_text, wrap_with_indicator, split_into_chunks, \
-    edit_message_with_retry, get_stream_cutoff_values, is_allowed, get_remaining_budget, is_admin, is_within_budget, \
-    get_reply_to_message_id, add_chat_request_to_usage_tracker, error_handler, is_direct_result, handle_direct_result, \
-    cleanup_intermediate_files
+    filters, InlineQueryHandler, CallbackQueryHandler, ChatMemberHandler, Application, ContextTypes, CallbackContext
+
+from PIL import UnidentifiedImageError
+
+from utils import is_group_chat, get_thread_id, message_text, merge_messages, split_into_chunks, \
+    edit_message_with_retry, is_allowed, get_remaining_budget, is_within_budget, \
+    get_reply_to_message_id, add_chat_request_to_usage_tracker, error_handler, handle_direct_result, \
+    cleanup_intermediate_files, reply_text_markdown, gather_or_cancel
+from access_policy import AccessPolicy
+from audio_pipeline import AudioPipeline
+from admission import AdmissionController
+from cache import TTLCache
+from chat_action import ChatActionService
+from debounce import KeyedDebouncer
+from generation_registry import GenerationRegistry, Generation
+from group_membership import GroupMembershipCache, MEMBER_STATUSES
+from image_processing import select_photo_size
 from openai_helper import OpenAIHelper, localized_text
+from plugin_result import DirectResult
+from rate_limiter import PriorityRateLimiter
+from stream_events import TextDelta, StreamFinished
+from stream_renderer import StreamRenderer, EditScheduler
+from transcript_cache import TranscriptCache
 from usage_tracker import UsageTracker
+from webhook_server import WebhookServer
+
+# Seconds to wait for the user to stop typing before answering an inline query
+INLINE_QUERY_DEBOUNCE = 0.6
+
+# Seconds to wait for more images of an album, which Telegram sends as one message per image
+MEDIA_GROUP_WINDOW = 1.0
+
+# Seconds Telegram may cache the result of an inline query
+INLINE_QUERY_CACHE_TIME = 300
+
+# Pending inline prompts are kept until the user clicks the result, or for this many seconds
+INLINE_QUERY_TTL = 3600
+MAX_INLINE_QUERIES = 10000
 
 
 class ChatGPTTelegramBot:
@@ -56,9 +85,25 @@ class ChatGPTTelegramBot:
         )] + self.commands
         self.disallowed_message = localized_text('disallowed', bot_language)
         self.budget_limit_message = localized_text('budget_limit', bot_language)
+        self.busy_message = localized_text('busy', bot_language)
         self.usage = {}
         self.last_message = {}
-        self.inline_queries_cache = {}
+        self.inline_queries_cache = TTLCache(MAX_INLINE_QUERIES, INLINE_QUERY_TTL)
+        self.inline_query_debouncer = KeyedDebouncer(INLINE_QUERY_DEBOUNCE)
+        self.message_debouncer = KeyedDebouncer(config['message_coalesce_window']) \
+            if config['message_coalesce_window'] > 0 else None
+        self.media_group_debouncer = KeyedDebouncer(MEDIA_GROUP_WINDOW)
+        self.edit_scheduler = EditScheduler()
+        self.access_policy = AccessPolicy(config)
+        self.admission = AdmissionController(config)
+        self.chat_actions = ChatActionService()
+        self.generations = GenerationRegistry()
+        self.audio_pipeline = AudioPipeline(segment_duration=config['transcription_segment_duration'])
+        self.transcript_cache = None
+        if config['transcription_cache_size'] > 0:
+            self.transcript_cache = TranscriptCache(config['transcription_cache_path'],
+                                                    config['transcription_cache_size'])
+        self.group_membership = GroupMembershipCache(ttl=config['group_membership_cache_ttl'])
 
     async def help(self, update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
         """
@@ -82,7 +127,7 @@ class ChatGPTTelegramBot:
         """
         Returns token usage statistics for current day and month.
         """
-        if not await is_allowed(self.config, update, context):
+        if not await is_allowed(self.access_policy, update, context, group_membership=self.group_membership):
             logging.warning(f'User {update.message.from_user.name} (id: {update.message.from_user.id}) '
                             'is not allowed to request their usage statistics')
             await self.send_disallowed_message(update, context)
@@ -100,12 +145,13 @@ class ChatGPTTelegramBot:
         (transcribe_minutes_today, transcribe_seconds_today, transcribe_minutes_month,
          transcribe_seconds_month) = self.usage[user_id].get_current_transcription_duration()
         vision_today, vision_month = self.usage[user_id].get_current_vision_tokens()
+        cached_vision_today, cached_vision_month = self.usage[user_id].get_current_cached_vision_tokens()
         characters_today, characters_month = self.usage[user_id].get_current_tts_usage()
         current_cost = self.usage[user_id].get_current_cost()
 
         chat_id = update.effective_chat.id
         chat_messages, chat_token_length = self.openai.get_conversation_stats(chat_id)
-        remaining_budget = get_remaining_budget(self.config, self.usage, update)
+        remaining_budget = get_remaining_budget(self.access_policy, self.usage, update)
         bot_language = self.config['bot_language']
         
         text_current_conversation = (
@@ -123,6 +169,8 @@ class ChatGPTTelegramBot:
         text_today_vision = ""
         if self.config.get('enable_vision', False):
             text_today_vision = f"{vision_today} {localized_text('stats_vision', bot_language)}\n"
+            if cached_vision_today > 0:
+                text_today_vision += f"{cached_vision_today} {localized_text('stats_vision_cached', bot_language)}\n"
 
         text_today_tts = ""
         if self.config.get('enable_tts_generation', False):
@@ -147,6 +195,8 @@ class ChatGPTTelegramBot:
         text_month_vision = ""
         if self.config.get('enable_vision', False):
             text_month_vision = f"{vision_month} {localized_text('stats_vision', bot_language)}\n"
+            if cached_vision_month > 0:
+                text_month_vision += f"{cached_vision_month} {localized_text('stats_vision_cached', bot_language)}\n"
 
         text_month_tts = ""
         if self.config.get('enable_tts_generation', False):
@@ -175,7 +225,7 @@ class ChatGPTTelegramBot:
             )
         # No longer works as of July 21st 2023, as OpenAI has removed the billing API
         # add OpenAI account information for admin request
-        # if is_admin(self.config, user_id):
+        # if self.access_policy.is_admin(user_id):
         #     text_budget += (
         #         f"{localized_text('stats_openai', bot_language)}"
         #         f"{self.openai.get_billing_current_month():.2f}"
@@ -188,7 +238,7 @@ class ChatGPTTelegramBot:
         """
         Resend the last request
         """
-        if not await is_allowed(self.config, update, context):
+        if not await is_allowed(self.access_policy, update, context, group_membership=self.group_membership):
             logging.warning(f'User {update.message.from_user.name}  (id: {update.message.from_user.id})'
                             ' is not allowed to resend the message')
             await self.send_disallowed_message(update, context)
@@ -216,7 +266,7 @@ class ChatGPTTelegramBot:
         """
         Resets the conversation.
         """
-        if not await is_allowed(self.config, update, context):
+        if not await is_allowed(self.access_policy, update, context, group_membership=self.group_membership):
             logging.warning(f'User {update.message.from_user.name} (id: {update.message.from_user.id}) '
                             'is not allowed to reset the conversation')
             await self.send_disallowed_message(update, context)
@@ -227,6 +277,8 @@ class ChatGPTTelegramBot:
 
         chat_id = update.effective_chat.id
         reset_content = message_text(update.message)
+        # Answers in progress would otherwise keep running and write to the new conversation
+        await self.generations.stop(self.generations.in_chat(chat_id))
         self.openai.reset_chat_history(chat_id=chat_id, content=reset_content)
         await update.effective_message.reply_text(
             message_thread_id=get_thread_id(update),
@@ -271,7 +323,7 @@ class ChatGPTTelegramBot:
                 user_id = update.message.from_user.id
                 self.usage[user_id].add_image_request(image_size, self.config['image_prices'])
                 # add guest chat request to guest usage tracker
-                if str(user_id) not in self.config['allowed_user_ids'].split(',') and 'guests' in self.usage:
+                if self.access_policy.is_guest(user_id) and 'guests' in self.usage:
                     self.usage["guests"].add_image_request(image_size, self.config['image_prices'])
 
             except Exception as e:
@@ -283,7 +335,7 @@ class ChatGPTTelegramBot:
                     parse_mode=constants.ParseMode.MARKDOWN
                 )
 
-        await wrap_with_indicator(update, context, _generate, constants.ChatAction.UPLOAD_PHOTO)
+        await self.chat_actions.wrap_with_indicator(update, context, _generate, constants.ChatAction.UPLOAD_PHOTO)
 
     async def tts(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
@@ -317,7 +369,7 @@ class ChatGPTTelegramBot:
                 user_id = update.message.from_user.id
                 self.usage[user_id].add_tts_request(text_length, self.config['tts_model'], self.config['tts_prices'])
                 # add guest chat request to guest usage tracker
-                if str(user_id) not in self.config['allowed_user_ids'].split(',') and 'guests' in self.usage:
+                if self.access_policy.is_guest(user_id) and 'guests' in self.usage:
                     self.usage["guests"].add_tts_request(text_length, self.config['tts_model'], self.config['tts_prices'])
 
             except Exception as e:
@@ -329,71 +381,86 @@ class ChatGPTTelegramBot:
                     parse_mode=constants.ParseMode.MARKDOWN
                 )
 
-        await wrap_with_indicator(update, context, _generate, constants.ChatAction.UPLOAD_VOICE)
+        await self.chat_actions.wrap_with_indicator(update, context, _generate, constants.ChatAction.UPLOAD_VOICE)
 
     async def transcribe(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
         Transcribe audio messages.
         """
-        if not self.config['enable_transcription'] or not await self.check_allowed_and_within_budget(update, context):
+        if not self.config['enable_transcription']:
             return
 
         if is_group_chat(update) and self.config['ignore_group_transcriptions']:
             logging.info('Transcription coming from group chat, ignoring...')
             return
 
+        if not await self.check_allowed_and_within_budget(update, context):
+            return
+
         chat_id = update.effective_chat.id
-        filename = update.message.effective_attachment.file_unique_id
+        attachment = update.message.effective_attachment
+        # Unique to the request, the same file may be forwarded several times at once
+        filename = f'{update.update_id}_{attachment.file_unique_id}'
 
         async def _execute():
-            filename_mp3 = f'{filename}.mp3'
             bot_language = self.config['bot_language']
-            try:
-                media_file = await context.bot.get_file(update.message.effective_attachment.file_id)
-                await media_file.download_to_drive(filename)
-            except Exception as e:
-                logging.exception(e)
-                await update.effective_message.reply_text(
-                    message_thread_id=get_thread_id(update),
-                    reply_to_message_id=get_reply_to_message_id(self.config, update),
-                    text=(
-                        f"{localized_text('media_download_fail', bot_language)[0]}: "
-                        f"{str(e)}. {localized_text('media_download_fail', bot_language)[1]}"
-                    ),
-                    parse_mode=constants.ParseMode.MARKDOWN
-                )
-                return
+            # Forwarded recordings keep their unique id, they don't need to be transcribed again
+            cache_key = self.openai.transcription_cache_key(attachment.file_unique_id)
+            cached = await self.transcript_cache.get(cache_key) if self.transcript_cache is not None else None
 
-            try:
-                audio_track = AudioSegment.from_file(filename)
-                audio_track.export(filename_mp3, format="mp3")
-                logging.info(f'New transcribe request received from user {update.message.from_user.name} '
-                             f'(id: {update.message.from_user.id})')
+            if cached is None:
+                try:
+                    media_file = await context.bot.get_file(attachment.file_id)
+                    media = await media_file.download_as_bytearray()
+                except Exception as e:
+                    logging.exception(e)
+                    await update.effective_message.reply_text(
+                        message_thread_id=get_thread_id(update),
+                        reply_to_message_id=get_reply_to_message_id(self.config, update),
+                        text=(
+                            f"{localized_text('media_download_fail', bot_language)[0]}: "
+                            f"{str(e)}. {localized_text('media_download_fail', bot_language)[1]}"
+                        ),
+                        parse_mode=constants.ParseMode.MARKDOWN
+                    )
+                    return
 
-            except Exception as e:
-                logging.exception(e)
-                await update.effective_message.reply_text(
-                    message_thread_id=get_thread_id(update),
-                    reply_to_message_id=get_reply_to_message_id(self.config, update),
-                    text=localized_text('media_type_fail', bot_language)
-                )
-                if os.path.exists(filename):
-                    os.remove(filename)
-                return
+                try:
+                    audio = await self.audio_pipeline.prepare(filename, bytes(media),
+                                                              mime_type=getattr(attachment, 'mime_type', None),
+                                                              duration=getattr(attachment, 'duration', None))
+                except Exception as e:
+                    logging.exception(e)
+                    await update.effective_message.reply_text(
+                        message_thread_id=get_thread_id(update),
+                        reply_to_message_id=get_reply_to_message_id(self.config, update),
+                        text=localized_text('media_type_fail', bot_language)
+                    )
+                    return
+
+            logging.info(f'New transcribe request received from user {update.message.from_user.name} '
+                         f'(id: {update.message.from_user.id})')
 
             user_id = update.message.from_user.id
             if user_id not in self.usage:
                 self.usage[user_id] = UsageTracker(user_id, update.message.from_user.name)
 
             try:
-                transcript = await self.openai.transcribe(filename_mp3)
+                if cached is None:
+                    transcript = await self.openai.transcribe_segments(audio.segments)
+                    duration = audio.duration or 0
+                    if self.transcript_cache is not None:
+                        await self.transcript_cache.set(cache_key, transcript, duration)
+                else:
+                    logging.info(f'Using the cached transcript of file {attachment.file_unique_id}')
+                    transcript = cached.transcript
+                    duration = cached.duration if self.config['transcription_cache_billing'] == 'full' else 0
 
                 transcription_price = self.config['transcription_price']
-                self.usage[user_id].add_transcription_seconds(audio_track.duration_seconds, transcription_price)
+                self.usage[user_id].add_transcription_seconds(duration, transcription_price)
 
-                allowed_user_ids = self.config['allowed_user_ids'].split(',')
-                if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
-                    self.usage["guests"].add_transcription_seconds(audio_track.duration_seconds, transcription_price)
+                if self.access_policy.is_guest(user_id) and 'guests' in self.usage:
+                    self.usage["guests"].add_transcription_seconds(duration, transcription_price)
 
                 # check if transcript starts with any of the prefixes
                 response_to_transcription = any(transcript.lower().startswith(prefix.lower()) if prefix else False
@@ -401,39 +468,42 @@ class ChatGPTTelegramBot:
 
                 if self.config['voice_reply_transcript'] and not response_to_transcription:
 
-                    # Split into chunks of 4096 characters (Telegram's message limit)
                     transcript_output = f"_{localized_text('transcript', bot_language)}:_\n\"{transcript}\""
-                    chunks = split_into_chunks(transcript_output)
+                    await self.__reply_in_chunks(update, transcript_output)
+                elif self.config['stream']:
+                    # Show the transcript right away, then stream the answer like for text prompts
+                    transcript_output = f"_{localized_text('transcript', bot_language)}:_\n\"{transcript}\""
+                    await self.__reply_in_chunks(update, transcript_output)
 
-                    for index, transcript_chunk in enumerate(chunks):
-                        await update.effective_message.reply_text(
-                            message_thread_id=get_thread_id(update),
-                            reply_to_message_id=get_reply_to_message_id(self.config, update) if index == 0 else None,
-                            text=transcript_chunk,
-                            parse_mode=constants.ParseMode.MARKDOWN
-                        )
+                    generation = self.generations.start(chat_id, user_id)
+                    try:
+                        total_tokens = await self.stream_answer(update, context, chat_id, transcript, generation)
+                    except asyncio.CancelledError:
+                        if not generation.stopped:
+                            raise
+                        # Stopped before the answer started, there is nothing to bill
+                        logging.info(f'Generation stopped in chat {chat_id}')
+                        total_tokens = None
+                    finally:
+                        self.generations.finish(generation)
+
+                    if total_tokens is not None:
+                        self.usage[user_id].add_chat_tokens(total_tokens, self.config['token_price'])
+                        if self.access_policy.is_guest(user_id) and 'guests' in self.usage:
+                            self.usage["guests"].add_chat_tokens(total_tokens, self.config['token_price'])
                 else:
                     # Get the response of the transcript
                     response, total_tokens = await self.openai.get_chat_response(chat_id=chat_id, query=transcript)
 
                     self.usage[user_id].add_chat_tokens(total_tokens, self.config['token_price'])
-                    if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
+                    if self.access_policy.is_guest(user_id) and 'guests' in self.usage:
                         self.usage["guests"].add_chat_tokens(total_tokens, self.config['token_price'])
 
-                    # Split into chunks of 4096 characters (Telegram's message limit)
                     transcript_output = (
                         f"_{localized_text('transcript', bot_language)}:_\n\"{transcript}\"\n\n"
                         f"_{localized_text('answer', bot_language)}:_\n{response}"
                     )
-                    chunks = split_into_chunks(transcript_output)
-
-                    for index, transcript_chunk in enumerate(chunks):
-                        await update.effective_message.reply_text(
-                            message_thread_id=get_thread_id(update),
-                            reply_to_message_id=get_reply_to_message_id(self.config, update) if index == 0 else None,
-                            text=transcript_chunk,
-                            parse_mode=constants.ParseMode.MARKDOWN
-                        )
+                    await self.__reply_in_chunks(update, transcript_output)
 
             except Exception as e:
                 logging.exception(e)
@@ -443,43 +513,94 @@ class ChatGPTTelegramBot:
                     text=f"{localized_text('transcribe_fail', bot_language)}: {str(e)}",
                     parse_mode=constants.ParseMode.MARKDOWN
                 )
-            finally:
-                if os.path.exists(filename_mp3):
-                    os.remove(filename_mp3)
-                if os.path.exists(filename):
-                    os.remove(filename)
 
-        await wrap_with_indicator(update, context, _execute, constants.ChatAction.TYPING)
+        await self.chat_actions.wrap_with_indicator(update, context, _execute, constants.ChatAction.TYPING)
+
+    async def __reply_in_chunks(self, update: Update, text: str):
+        """
+        Replies with a text split into chunks of 4096 characters (Telegram's message limit),
+        only the first chunk quotes the user's message
+        """
+        for index, chunk in enumerate(split_into_chunks(text)):
+            await reply_text_markdown(
+                update.effective_message,
+                message_thread_id=get_thread_id(update),
+                reply_to_message_id=get_reply_to_message_id(self.config, update) if index == 0 else None,
+                text=chunk
+            )
 
     async def vision(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
         Interpret image using vision model.
         """
-        if not self.config['enable_vision'] or not await self.check_allowed_and_within_budget(update, context):
+        if not self.config['enable_vision']:
             return
 
         chat_id = update.effective_chat.id
-        prompt = update.message.caption
+
+        if is_group_chat(update) and self.config['ignore_group_vision']:
+            logging.info('Vision coming from group chat, ignoring...')
+            return
+
+        # Albums arrive as one message per image, answer them as a single request from the last handler
+        messages = [update.message]
+        if update.message.media_group_id is not None:
+            messages = await self.media_group_debouncer.submit(
+                (chat_id, update.message.media_group_id), update.message)
+            if messages is None:
+                return
+            logging.info(f'Received an album of {len(messages)} images from user {update.message.from_user.name} '
+                         f'(id: {update.message.from_user.id})')
+
+        # The caption of an album is set on one of its messages, usually the first
+        prompt = next((message.caption for message in messages if message.caption), None)
 
         if is_group_chat(update):
-            if self.config['ignore_group_vision']:
-                logging.info('Vision coming from group chat, ignoring...')
+            trigger_keyword = self.config['group_trigger_keyword']
+            if (prompt is None and trigger_keyword != '') or \
+               (prompt is not None and not prompt.lower().startswith(trigger_keyword.lower())):
+                logging.info('Vision coming from group chat with wrong keyword, ignoring...')
                 return
-            else:
-                trigger_keyword = self.config['group_trigger_keyword']
-                if (prompt is None and trigger_keyword != '') or \
-                   (prompt is not None and not prompt.lower().startswith(trigger_keyword.lower())):
-                    logging.info('Vision coming from group chat with wrong keyword, ignoring...')
-                    return
-        
-        image = update.message.effective_attachment[-1]
-        
+
+        if not await self.check_allowed_and_within_budget(update, context):
+            return
+
+        # Images sent as files are only available in their original size
+        attachments = [select_photo_size(message.photo, self.config['vision_detail']) if message.photo
+                       else message.document for message in messages]
+
+        async def _download(attachment) -> bytes:
+            media_file = await context.bot.get_file(attachment.file_id)
+            return bytes(await media_file.download_as_bytearray())
+
+        # The same images (a meme, a forwarded photo...) are often sent again with the same prompt
+        cache_key = self.openai.vision_cache_key([attachment.file_unique_id for attachment in attachments], prompt)
 
         async def _execute():
             bot_language = self.config['bot_language']
+            user_id = update.message.from_user.id
+            if user_id not in self.usage:
+                self.usage[user_id] = UsageTracker(user_id, update.message.from_user.name)
+            vision_token_price = self.config['vision_token_price']
+
+            cached = self.openai.get_cached_interpretation(chat_id, cache_key)
+            if cached is not None:
+                logging.info(f'Using the cached answer to the vision request of user {update.message.from_user.name} '
+                             f'(id: {update.message.from_user.id})')
+                await reply_text_markdown(
+                    update.effective_message,
+                    message_thread_id=get_thread_id(update),
+                    reply_to_message_id=get_reply_to_message_id(self.config, update),
+                    text=cached.answer
+                )
+                cached_token_price = vision_token_price if self.config['vision_cache_billing'] == 'full' else 0
+                self.usage[user_id].add_cached_vision_tokens(cached.tokens, cached_token_price)
+                if self.access_policy.is_guest(user_id) and 'guests' in self.usage:
+                    self.usage["guests"].add_cached_vision_tokens(cached.tokens, cached_token_price)
+                return
+
             try:
-                media_file = await context.bot.get_file(image.file_id)
-                temp_file = io.BytesIO(await media_file.download_as_bytearray())
+                images = await gather_or_cancel(*(_download(attachment) for attachment in attachments))
             except Exception as e:
                 logging.exception(e)
                 await update.effective_message.reply_text(
@@ -492,156 +613,66 @@ class ChatGPTTelegramBot:
                     parse_mode=constants.ParseMode.MARKDOWN
                 )
                 return
-            
-            # convert jpg from telegram to png as understood by openai
 
-            temp_file_png = io.BytesIO()
+            logging.info(f'New vision request received from user {update.message.from_user.name} '
+                         f'(id: {update.message.from_user.id})')
 
+            total_tokens = 0
             try:
-                original_image = Image.open(temp_file)
-                
-                original_image.save(temp_file_png, format='PNG')
-                logging.info(f'New vision request received from user {update.message.from_user.name} '
-                             f'(id: {update.message.from_user.id})')
+                if self.config['stream']:
+                    generation = self.generations.start(chat_id, user_id)
+                    try:
+                        stream_response = self.openai.interpret_image_stream(chat_id=chat_id, images=images,
+                                                                             prompt=prompt, cache_key=cache_key)
+                        renderer = StreamRenderer(context, self.edit_scheduler, update, self.config,
+                                                  reply_markup=self.stop_button_markup(generation))
+                        total_tokens = await self.render_stream(
+                            stream_response, renderer, chat_id, generation,
+                            lambda direct_result: handle_direct_result(self.config, update, direct_result)
+                        )
+                    except asyncio.CancelledError:
+                        if not generation.stopped:
+                            raise
+                        # Stopped before the answer started, there is nothing to bill
+                        logging.info(f'Generation stopped in chat {chat_id}')
+                        total_tokens = None
+                    finally:
+                        self.generations.finish(generation)
+                    if total_tokens is None:
+                        return
 
-            except Exception as e:
+                else:
+                    interpretation, total_tokens = await self.openai.interpret_image(chat_id, images, prompt=prompt,
+                                                                                     cache_key=cache_key)
+
+                    await reply_text_markdown(
+                        update.effective_message,
+                        message_thread_id=get_thread_id(update),
+                        reply_to_message_id=get_reply_to_message_id(self.config, update),
+                        text=interpretation
+                    )
+            except UnidentifiedImageError as e:
                 logging.exception(e)
                 await update.effective_message.reply_text(
                     message_thread_id=get_thread_id(update),
                     reply_to_message_id=get_reply_to_message_id(self.config, update),
                     text=localized_text('media_type_fail', bot_language)
                 )
-            
-            
-
-            user_id = update.message.from_user.id
-            if user_id not in self.usage:
-                self.usage[user_id] = UsageTracker(user_id, update.message.from_user.name)
-
-            if self.config['stream']:
-
-                stream_response = self.openai.interpret_image_stream(chat_id=chat_id, fileobj=temp_file_png, prompt=prompt)
-                i = 0
-                prev = ''
-                sent_message = None
-                backoff = 0
-                stream_chunk = 0
-
-                async for content, tokens in stream_response:
-                    if is_direct_result(content):
-                        return await handle_direct_result(self.config, update, content)
-
-                    if len(content.strip()) == 0:
-                        continue
-
-                    stream_chunks = split_into_chunks(content)
-                    if len(stream_chunks) > 1:
-                        content = stream_chunks[-1]
-                        if stream_chunk != len(stream_chunks) - 1:
-                            stream_chunk += 1
-                            try:
-                                await edit_message_with_retry(context, chat_id, str(sent_message.message_id),
-                                                              stream_chunks[-2])
-                            except:
-                                pass
-                            try:
-                                sent_message = await update.effective_message.reply_text(
-                                    message_thread_id=get_thread_id(update),
-                                    text=content if len(content) > 0 else "..."
-                                )
-                            except:
-                                pass
-                            continue
-
-                    cutoff = get_stream_cutoff_values(update, content)
-                    cutoff += backoff
-
-                    if i == 0:
-                        try:
-                            if sent_message is not None:
-                                await context.bot.delete_message(chat_id=sent_message.chat_id,
-                                                                 message_id=sent_message.message_id)
-                            sent_message = await update.effective_message.reply_text(
-                                message_thread_id=get_thread_id(update),
-                                reply_to_message_id=get_reply_to_message_id(self.config, update),
-                                text=content,
-                            )
-                        except:
-                            continue
-
-                    elif abs(len(content) - len(prev)) > cutoff or tokens != 'not_finished':
-                        prev = content
-
-                        try:
-                            use_markdown = tokens != 'not_finished'
-                            await edit_message_with_retry(context, chat_id, str(sent_message.message_id),
-                                                          text=content, markdown=use_markdown)
-
-                        except RetryAfter as e:
-                            backoff += 5
-                            await asyncio.sleep(e.retry_after)
-                            continue
-
-                        except TimedOut:
-                            backoff += 5
-                            await asyncio.sleep(0.5)
-                            continue
-
-                        except Exception:
-                            backoff += 5
-                            continue
-
-                        await asyncio.sleep(0.01)
-
-                    i += 1
-                    if tokens != 'not_finished':
-                        total_tokens = int(tokens)
-
-                
-            else:
-
-                try:
-                    interpretation, total_tokens = await self.openai.interpret_image(chat_id, temp_file_png, prompt=prompt)
-
-
-                    try:
-                        await update.effective_message.reply_text(
-                            message_thread_id=get_thread_id(update),
-                            reply_to_message_id=get_reply_to_message_id(self.config, update),
-                            text=interpretation,
-                            parse_mode=constants.ParseMode.MARKDOWN
-                        )
-                    except BadRequest:
-                        try:
-                            await update.effective_message.reply_text(
-                                message_thread_id=get_thread_id(update),
-                                reply_to_message_id=get_reply_to_message_id(self.config, update),
-                                text=interpretation
-                            )
-                        except Exception as e:
-                            logging.exception(e)
-                            await update.effective_message.reply_text(
-                                message_thread_id=get_thread_id(update),
-                                reply_to_message_id=get_reply_to_message_id(self.config, update),
-                                text=f"{localized_text('vision_fail', bot_language)}: {str(e)}",
-                                parse_mode=constants.ParseMode.MARKDOWN
-                            )
-                except Exception as e:
-                    logging.exception(e)
-                    await update.effective_message.reply_text(
-                        message_thread_id=get_thread_id(update),
-                        reply_to_message_id=get_reply_to_message_id(self.config, update),
-                        text=f"{localized_text('vision_fail', bot_language)}: {str(e)}",
-                        parse_mode=constants.ParseMode.MARKDOWN
-                    )
-            vision_token_price = self.config['vision_token_price']
+                return
+            except Exception as e:
+                logging.exception(e)
+                await update.effective_message.reply_text(
+                    message_thread_id=get_thread_id(update),
+                    reply_to_message_id=get_reply_to_message_id(self.config, update),
+                    text=f"{localized_text('vision_fail', bot_language)}: {str(e)}",
+                    parse_mode=constants.ParseMode.MARKDOWN
+                )
             self.usage[user_id].add_vision_tokens(total_tokens, vision_token_price)
 
-            allowed_user_ids = self.config['allowed_user_ids'].split(',')
-            if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
+            if self.access_policy.is_guest(user_id) and 'guests' in self.usage:
                 self.usage["guests"].add_vision_tokens(total_tokens, vision_token_price)
 
-        await wrap_with_indicator(update, context, _execute, constants.ChatAction.TYPING)
+        await self.chat_actions.wrap_with_indicator(update, context, _execute, constants.ChatAction.TYPING)
 
     async def prompt(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
@@ -650,16 +681,31 @@ class ChatGPTTelegramBot:
         if update.edited_message or not update.message or update.message.via_bot:
             return
 
-        if not await self.check_allowed_and_within_budget(update, context):
-            return
+        # Long texts are split by Telegram into several messages, answer them as a single prompt
+        if self.message_debouncer is not None:
+            key = (update.effective_chat.id, update.message.from_user.id)
+            # In groups, only a message addressed to the bot starts a batch, the messages following it continue it
+            if is_group_chat(update) and not self.message_debouncer.is_pending(key) and \
+                    not self.is_addressed_to_bot(update.message, context.bot.id):
+                logging.warning('Message does not start with trigger keyword, ignoring...')
+                return
+            messages = await self.message_debouncer.submit(key, update.message)
+            if messages is None:
+                return
+            if len(messages) > 1:
+                logging.info(f'Merging {len(messages)} consecutive messages from user '
+                             f'{update.message.from_user.name} (id: {update.message.from_user.id})')
+                with update.message._unfrozen() as message:
+                    message.text = merge_messages([part.text or '' for part in messages])
+                    # The entities of the first message are still valid, as it starts the merged text
+                    message.entities = messages[0].entities
 
-        logging.info(
-            f'New message received from user {update.message.from_user.name} (id: {update.message.from_user.id})')
         chat_id = update.effective_chat.id
         user_id = update.message.from_user.id
         prompt = message_text(update.message)
-        self.last_message[chat_id] = prompt
+        last_message = prompt
 
+        # Cheap filters first, so ignored group messages don't pay for the access and budget checks
         if is_group_chat(update):
             trigger_keyword = self.config['group_trigger_keyword']
 
@@ -678,127 +724,53 @@ class ChatGPTTelegramBot:
                     logging.warning('Message does not start with trigger keyword, ignoring...')
                     return
 
+        if not await self.check_allowed_and_within_budget(update, context):
+            return
+
+        logging.info(
+            f'New message received from user {update.message.from_user.name} (id: {update.message.from_user.id})')
+        self.last_message[chat_id] = last_message
+
+        if self.config['cancel_previous_generation'] and not is_group_chat(update):
+            await self.generations.stop(self.generations.in_chat(chat_id))
+        generation = self.generations.start(chat_id, user_id)
+
         try:
             total_tokens = 0
 
             if self.config['stream']:
-                await update.effective_message.reply_chat_action(
-                    action=constants.ChatAction.TYPING,
-                    message_thread_id=get_thread_id(update)
-                )
-
-                stream_response = self.openai.get_chat_response_stream(chat_id=chat_id, query=prompt)
-                i = 0
-                prev = ''
-                sent_message = None
-                backoff = 0
-                stream_chunk = 0
-
-                async for content, tokens in stream_response:
-                    if is_direct_result(content):
-                        return await handle_direct_result(self.config, update, content)
-
-                    if len(content.strip()) == 0:
-                        continue
-
-                    stream_chunks = split_into_chunks(content)
-                    if len(stream_chunks) > 1:
-                        content = stream_chunks[-1]
-                        if stream_chunk != len(stream_chunks) - 1:
-                            stream_chunk += 1
-                            try:
-                                await edit_message_with_retry(context, chat_id, str(sent_message.message_id),
-                                                              stream_chunks[-2])
-                            except:
-                                pass
-                            try:
-                                sent_message = await update.effective_message.reply_text(
-                                    message_thread_id=get_thread_id(update),
-                                    text=content if len(content) > 0 else "..."
-                                )
-                            except:
-                                pass
-                            continue
-
-                    cutoff = get_stream_cutoff_values(update, content)
-                    cutoff += backoff
-
-                    if i == 0:
-                        try:
-                            if sent_message is not None:
-                                await context.bot.delete_message(chat_id=sent_message.chat_id,
-                                                                 message_id=sent_message.message_id)
-                            sent_message = await update.effective_message.reply_text(
-                                message_thread_id=get_thread_id(update),
-                                reply_to_message_id=get_reply_to_message_id(self.config, update),
-                                text=content,
-                            )
-                        except:
-                            continue
-
-                    elif abs(len(content) - len(prev)) > cutoff or tokens != 'not_finished':
-                        prev = content
-
-                        try:
-                            use_markdown = tokens != 'not_finished'
-                            await edit_message_with_retry(context, chat_id, str(sent_message.message_id),
-                                                          text=content, markdown=use_markdown)
-
-                        except RetryAfter as e:
-                            backoff += 5
-                            await asyncio.sleep(e.retry_after)
-                            continue
-
-                        except TimedOut:
-                            backoff += 5
-                            await asyncio.sleep(0.5)
-                            continue
-
-                        except Exception:
-                            backoff += 5
-                            continue
-
-                        await asyncio.sleep(0.01)
-
-                    i += 1
-                    if tokens != 'not_finished':
-                        total_tokens = int(tokens)
+                total_tokens = await self.stream_answer(update, context, chat_id, prompt, generation)
+                if total_tokens is None:
+                    return
 
             else:
                 async def _reply():
                     nonlocal total_tokens
                     response, total_tokens = await self.openai.get_chat_response(chat_id=chat_id, query=prompt)
 
-                    if is_direct_result(response):
+                    if isinstance(response, DirectResult):
                         return await handle_direct_result(self.config, update, response)
 
                     # Split into chunks of 4096 characters (Telegram's message limit)
                     chunks = split_into_chunks(response)
 
                     for index, chunk in enumerate(chunks):
-                        try:
-                            await update.effective_message.reply_text(
-                                message_thread_id=get_thread_id(update),
-                                reply_to_message_id=get_reply_to_message_id(self.config,
-                                                                            update) if index == 0 else None,
-                                text=chunk,
-                                parse_mode=constants.ParseMode.MARKDOWN
-                            )
-                        except Exception:
-                            try:
-                                await update.effective_message.reply_text(
-                                    message_thread_id=get_thread_id(update),
-                                    reply_to_message_id=get_reply_to_message_id(self.config,
-                                                                                update) if index == 0 else None,
-                                    text=chunk
-                                )
-                            except Exception as exception:
-                                raise exception
-
-                await wrap_with_indicator(update, context, _reply, constants.ChatAction.TYPING)
-
-            add_chat_request_to_usage_tracker(self.usage, self.config, user_id, total_tokens)
+                        await reply_text_markdown(
+                            update.effective_message,
+                            message_thread_id=get_thread_id(update),
+                            reply_to_message_id=get_reply_to_message_id(self.config,
+                                                                        update) if index == 0 else None,
+                            text=chunk
+                        )
+
+                await self.chat_actions.wrap_with_indicator(update, context, _reply, constants.ChatAction.TYPING)
 
+            add_chat_request_to_usage_tracker(self.usage, self.config, self.access_policy, user_id, total_tokens)
+
+        except asyncio.CancelledError:
+            if not generation.stopped:
+                raise
+            logging.info(f'Generation stopped in chat {chat_id}')
         except Exception as e:
             logging.exception(e)
             await update.effective_message.reply_text(
@@ -807,25 +779,127 @@ class ChatGPTTelegramBot:
                 text=f"{localized_text('chat_fail', self.config['bot_language'])} {str(e)}",
                 parse_mode=constants.ParseMode.MARKDOWN
             )
+        finally:
+            self.generations.finish(generation)
+
+    def is_addressed_to_bot(self, message: Message, bot_id: int) -> bool:
+        """
+        Checks if a group message is addressed to the bot: it starts with the trigger keyword
+        or the /chat command, or it replies to the bot
+        """
+        trigger_keyword = self.config['group_trigger_keyword'].lower()
+        if message_text(message).lower().startswith(trigger_keyword) or \
+                (message.text or '').lower().startswith('/chat'):
+            return True
+        reply_to = message.reply_to_message
+        return reply_to is not None and reply_to.from_user is not None and reply_to.from_user.id == bot_id
+
+    async def stream_answer(self, update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, query: str,
+                            generation: Generation) -> int | None:
+        """
+        Streams the answer to a query into the chat, with a button to stop it.
+        :param update: Telegram update object
+        :param context: The context to use
+        :param chat_id: The conversation to continue
+        :param query: The query to answer
+        :param generation: The generation of the answer
+        :return: The number of tokens to bill, or None if a plugin result was sent instead of an answer
+        """
+        await update.effective_message.reply_chat_action(
+            action=constants.ChatAction.TYPING,
+            message_thread_id=get_thread_id(update)
+        )
+        stream_response = self.openai.get_chat_response_stream(chat_id=chat_id, query=query)
+        renderer = StreamRenderer(context, self.edit_scheduler, update, self.config,
+                                  reply_markup=self.stop_button_markup(generation))
+        return await self.render_stream(stream_response, renderer, chat_id, generation,
+                                        lambda direct_result: handle_direct_result(self.config, update, direct_result))
+
+    async def render_stream(self, stream_response, renderer: StreamRenderer, chat_id: int, generation: Generation,
+                            on_direct_result) -> int | None:
+        """
+        Renders a streamed answer, finishing it with the part received so far if it is stopped.
+        :param stream_response: The events of the streamed answer
+        :param renderer: The renderer showing the answer, with the stop button of the generation
+        :param chat_id: The conversation the answer belongs to
+        :param generation: The generation of the answer
+        :param on_direct_result: Coroutine function sending a plugin result instead of an answer
+        :return: The number of tokens to bill, or None if a plugin result was sent instead of an answer
+        """
+        total_tokens = 0
+        try:
+            async for event in stream_response:
+                if isinstance(event, TextDelta):
+                    await renderer.feed(event.text)
+                elif isinstance(event, StreamFinished):
+                    if event.direct_result is not None:
+                        await on_direct_result(event.direct_result)
+                        return None
+                    total_tokens = event.tokens_used
+                    await renderer.finish(event.footer)
+        except asyncio.CancelledError:
+            if not generation.stopped:
+                raise
+            # Closes the upstream stream, the part of the answer received so far is kept in the history
+            await stream_response.aclose()
+            if len(renderer.content) > 0:
+                # Only the tokens received so far are billed
+                total_tokens = self.openai.get_conversation_stats(chat_id)[1]
+                stopped = localized_text('stopped', self.config['bot_language'])
+                await renderer.finish(f'\n\n---\n⏹ {stopped}')
+        return total_tokens
+
+    def stop_button_markup(self, generation: Generation) -> InlineKeyboardMarkup:
+        """
+        Returns the inline keyboard with the button stopping a streamed answer
+        """
+        return InlineKeyboardMarkup([[
+            InlineKeyboardButton(text=f'⏹ {localized_text("stop", self.config["bot_language"])}',
+                                 callback_data=f'stop:{generation.generation_id}')
+        ]])
+
+    async def stop_generation(self, update: Update, context: CallbackContext):
+        """
+        Stops a streamed answer when its "Stop" button is pressed
+        """
+        callback_query = update.callback_query
+        user_id = callback_query.from_user.id
+        generation_id = callback_query.data.split(':')[1]
+        generation = self.generations.get(int(generation_id)) if generation_id.isdigit() else None
+        # Only the user who asked, or an admin, can stop an answer
+        if generation is None or (generation.user_id != user_id and not self.access_policy.is_admin(user_id)):
+            await callback_query.answer()
+            return
+
+        logging.info(f'User {callback_query.from_user.name} (id: {user_id}) stopped a generation '
+                     f'in chat {generation.chat_id}')
+        await callback_query.answer(localized_text('stopped', self.config['bot_language']))
+        await self.generations.stop([generation])
 
     async def inline_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
         Handle the inline query. This is run when you type: @botusername <query>
         """
         query = update.inline_query.query
+        # Telegram sends a query on every keystroke, only answer the one the user settled on
+        if await self.inline_query_debouncer.submit(update.inline_query.from_user.id, query) is None:
+            return
         if len(query) < 3:
             return
         if not await self.check_allowed_and_within_budget(update, context, is_inline=True):
             return
 
         callback_data_suffix = "gpt:"
-        result_id = str(uuid4())
-        self.inline_queries_cache[result_id] = query
+        # The same query from the same user always gets the same result, which Telegram can then cache
+        result_id = hashlib.sha256(f'{update.inline_query.from_user.id}:{query}'.encode()).hexdigest()[:32]
+        self.inline_queries_cache.set(result_id, query)
         callback_data = f'{callback_data_suffix}{result_id}'
 
-        await self.send_inline_query_result(update, result_id, message_content=query, callback_data=callback_data)
+        await self.send_inline_query_result(update, result_id, message_content=query, callback_data=callback_data,
+                                            cache_time=INLINE_QUERY_CACHE_TIME)
 
-    async def send_inline_query_result(self, update: Update, result_id, message_content, callback_data=""):
+    async def send_inline_query_result(self, update: Update, result_id, message_content, callback_data="",
+                                       cache_time=0):
         """
         Send inline query result
         """
@@ -847,7 +921,8 @@ class ChatGPTTelegramBot:
                 reply_markup=reply_markup
             )
 
-            await update.inline_query.answer([inline_query_result], cache_time=0)
+            # Results depend on the user's permissions and budget, they must not be shared
+            await update.inline_query.answer([inline_query_result], cache_time=cache_time, is_personal=True)
         except Exception as e:
             logging.error(f'An error occurred while generating the result card for inline query {e}')
 
@@ -871,10 +946,9 @@ class ChatGPTTelegramBot:
                 total_tokens = 0
 
                 # Retrieve the prompt from the cache
+                # The prompt is kept until it expires, as Telegram may show the cached result again
                 query = self.inline_queries_cache.get(unique_id)
-                if query:
-                    self.inline_queries_cache.pop(unique_id)
-                else:
+                if not query:
                     error_message = (
                         f'{localized_text("error", bot_language)}. '
                         f'{localized_text("try_again", bot_language)}'
@@ -884,79 +958,72 @@ class ChatGPTTelegramBot:
                                                   is_inline=True)
                     return
 
+                # Telegram may show a cached result long after the query was checked, so the answer is checked again
+                if not await is_allowed(self.access_policy, update, context, is_inline=True):
+                    logging.warning(f'User {name} (id: {user_id}) is not allowed to use the bot')
+                    await edit_message_with_retry(context, chat_id=None, message_id=inline_message_id,
+                                                  text=f'{query}\n\n_{answer_tr}:_\n{self.disallowed_message}',
+                                                  is_inline=True)
+                    return
+                if not is_within_budget(self.access_policy, self.usage, update, is_inline=True):
+                    logging.warning(f'User {name} (id: {user_id}) reached their usage limit')
+                    await edit_message_with_retry(context, chat_id=None, message_id=inline_message_id,
+                                                  text=f'{query}\n\n_{answer_tr}:_\n{self.budget_limit_message}',
+                                                  is_inline=True)
+                    return
+
+                if not await self.admission.admit(update.update_id, user_id, user_id,
+                                                  is_admin=self.access_policy.is_admin(user_id)):
+                    await edit_message_with_retry(context, chat_id=None, message_id=inline_message_id,
+                                                  text=f'{query}\n\n_{answer_tr}:_\n{self.busy_message}',
+                                                  is_inline=True)
+                    return
+
                 unavailable_message = localized_text("function_unavailable_in_inline_mode", bot_language)
                 if self.config['stream']:
-                    stream_response = self.openai.get_chat_response_stream(chat_id=user_id, query=query)
-                    i = 0
-                    prev = ''
-                    backoff = 0
-                    async for content, tokens in stream_response:
-                        if is_direct_result(content):
-                            cleanup_intermediate_files(content)
-                            await edit_message_with_retry(context, chat_id=None,
-                                                          message_id=inline_message_id,
-                                                          text=f'{query}\n\n_{answer_tr}:_\n{unavailable_message}',
-                                                          is_inline=True)
-                            return
-
-                        if len(content.strip()) == 0:
-                            continue
-
-                        cutoff = get_stream_cutoff_values(update, content)
-                        cutoff += backoff
-
-                        if i == 0:
-                            try:
-                                await edit_message_with_retry(context, chat_id=None,
-                                                              message_id=inline_message_id,
-                                                              text=f'{query}\n\n{answer_tr}:\n{content}',
-                                                              is_inline=True)
-                            except:
-                                continue
-
-                        elif abs(len(content) - len(prev)) > cutoff or tokens != 'not_finished':
-                            prev = content
-                            try:
-                                use_markdown = tokens != 'not_finished'
-                                divider = '_' if use_markdown else ''
-                                text = f'{query}\n\n{divider}{answer_tr}:{divider}\n{content}'
-
-                                # We only want to send the first 4096 characters. No chunking allowed in inline mode.
-                                text = text[:4096]
-
-                                await edit_message_with_retry(context, chat_id=None, message_id=inline_message_id,
-                                                              text=text, markdown=use_markdown, is_inline=True)
-
-                            except RetryAfter as e:
-                                backoff += 5
-                                await asyncio.sleep(e.retry_after)
-                                continue
-                            except TimedOut:
-                                backoff += 5
-                                await asyncio.sleep(0.5)
-                                continue
-                            except Exception:
-                                backoff += 5
-                                continue
-
-                            await asyncio.sleep(0.01)
-
-                        i += 1
-                        if tokens != 'not_finished':
-                            total_tokens = int(tokens)
+                    def _format_inline_answer(content: str, final: bool) -> str:
+                        divider = '_' if final else ''
+                        return f'{query}\n\n{divider}{answer_tr}:{divider}\n{content}'
+
+                    async def _answer_unavailable(direct_result: DirectResult):
+                        cleanup_intermediate_files(direct_result)
+                        await edit_message_with_retry(context, chat_id=None,
+                                                      message_id=inline_message_id,
+                                                      text=f'{query}\n\n_{answer_tr}:_\n{unavailable_message}',
+                                                      is_inline=True)
+
+                    # Inline answers continue the private conversation of the user
+                    generation = self.generations.start(user_id, user_id)
+                    try:
+                        stream_response = self.openai.get_chat_response_stream(chat_id=user_id, query=query)
+                        renderer = StreamRenderer(context, self.edit_scheduler, update, self.config,
+                                                  inline_message_id=inline_message_id, formatter=_format_inline_answer,
+                                                  reply_markup=self.stop_button_markup(generation))
+                        total_tokens = await self.render_stream(stream_response, renderer, user_id, generation,
+                                                                _answer_unavailable)
+                    except asyncio.CancelledError:
+                        if not generation.stopped:
+                            raise
+                        # Stopped before the answer started, there is nothing to bill
+                        logging.info(f'Inline generation stopped for user {user_id}')
+                        total_tokens = None
+                    finally:
+                        self.generations.finish(generation)
+                    if total_tokens is None:
+                        return
 
                 else:
                     async def _send_inline_query_response():
                         nonlocal total_tokens
                         # Edit the current message to indicate that the answer is being processed
-                        await context.bot.edit_message_text(inline_message_id=inline_message_id,
-                                                            text=f'{query}\n\n_{answer_tr}:_\n{loading_tr}',
-                                                            parse_mode=constants.ParseMode.MARKDOWN)
+                        await edit_message_with_retry(context, chat_id=None, message_id=inline_message_id,
+                                                      text=f'{query}\n\n_{answer_tr}:_\n{loading_tr}',
+                                                      is_inline=True)
 
                         logging.info(f'Generating response for inline query by {name}')
                         response, total_tokens = await self.openai.get_chat_response(chat_id=user_id, query=query)
 
-                        if is_direct_result(response):
+                        if isinstance(response, DirectResult):
                             cleanup_intermediate_files(response)
                             await edit_message_with_retry(context, chat_id=None,
                                                           message_id=inline_message_id,
@@ -973,10 +1040,10 @@ class ChatGPTTelegramBot:
                         await edit_message_with_retry(context, chat_id=None, message_id=inline_message_id,
                                                       text=text_content, is_inline=True)
 
-                    await wrap_with_indicator(update, context, _send_inline_query_response,
-                                              constants.ChatAction.TYPING, is_inline=True)
+                    await self.chat_actions.wrap_with_indicator(update, context, _send_inline_query_response,
+                                                                constants.ChatAction.TYPING, is_inline=True)
 
-                add_chat_request_to_usage_tracker(self.usage, self.config, user_id, total_tokens)
+                add_chat_request_to_usage_tracker(self.usage, self.config, self.access_policy, user_id, total_tokens)
 
         except Exception as e:
             logging.error(f'Failed to respond to an inline query via button callback: {e}')
@@ -998,11 +1065,21 @@ class ChatGPTTelegramBot:
         name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
         user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
 
-        if not await is_allowed(self.config, update, context, is_inline=is_inline):
+        # Inline queries are only cached here, the answer is admitted when it is requested
+        if not is_inline and not await self.admission.admit(update.update_id, user_id, update.effective_chat.id,
+                                                            is_admin=self.access_policy.is_admin(user_id)):
+            await update.effective_message.reply_text(
+                message_thread_id=get_thread_id(update),
+                reply_to_message_id=get_reply_to_message_id(self.config, update),
+                text=self.busy_message
+            )
+            return False
+        if not await is_allowed(self.access_policy, update, context, is_inline=is_inline,
+                                group_membership=self.group_membership):
             logging.warning(f'User {name} (id: {user_id}) is not allowed to use the bot')
             await self.send_disallowed_message(update, context, is_inline)
             return False
-        if not is_within_budget(self.config, self.usage, update, is_inline=is_inline):
+        if not is_within_budget(self.access_policy, self.usage, update, is_inline=is_inline):
             logging.warning(f'User {name} (id: {user_id}) reached their usage limit')
             await self.send_budget_reached_message(update, context, is_inline)
             return False
@@ -1036,6 +1113,16 @@ class ChatGPTTelegramBot:
             result_id = str(uuid4())
             await self.send_inline_query_result(update, result_id, message_content=self.budget_limit_message)
 
+    async def track_chat_members(self, update: Update, _: ContextTypes.DEFAULT_TYPE):
+        """
+        Keeps the group membership cache up to date
+        """
+        if update.my_chat_member is not None:
+            if update.my_chat_member.new_chat_member.status not in MEMBER_STATUSES:
+                self.group_membership.forget_chat(update.my_chat_member.chat.id)
+            return
+        self.group_membership.on_chat_member(update.chat_member)
+
     async def post_init(self, application: Application) -> None:
         """
         Post initialization hook for the bot.
@@ -1043,9 +1130,21 @@ class ChatGPTTelegramBot:
         await application.bot.set_my_commands(self.group_commands, scope=BotCommandScopeAllGroupChats())
         await application.bot.set_my_commands(self.commands)
 
-    def run(self):
+    def admitted(self, handler):
         """
-        Runs the bot indefinitely until the user presses Ctrl+C
+        Wraps a handler to release the admission slot of the update once it is handled
+        """
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            try:
+                return await handler(update, context)
+            finally:
+                await self.admission.release(update.update_id)
+        return wrapper
+
+    def build_application(self) -> Application:
+        """
+        Builds the application and registers all handlers
         """
         application = ApplicationBuilder() \
             .token(self.config['token']) \
@@ -1053,31 +1152,92 @@ class ChatGPTTelegramBot:
             .get_updates_proxy_url(self.config['proxy']) \
             .post_init(self.post_init) \
             .concurrent_updates(True) \
+            .rate_limiter(PriorityRateLimiter(
+                global_rate=self.config['global_rate_limit'],
+                chat_rate=self.config['chat_rate_limit'],
+                group_rate=self.config['group_rate_limit'],
+            )) \
+            .connection_pool_size(self.config['connection_pool_size']) \
+            .pool_timeout(self.config['pool_timeout']) \
             .build()
 
         application.add_handler(CommandHandler('reset', self.reset))
         application.add_handler(CommandHandler('help', self.help))
-        application.add_handler(CommandHandler('image', self.image))
-        application.add_handler(CommandHandler('tts', self.tts))
+        application.add_handler(CommandHandler('image', self.admitted(self.image)))
+        application.add_handler(CommandHandler('tts', self.admitted(self.tts)))
         application.add_handler(CommandHandler('start', self.help))
         application.add_handler(CommandHandler('stats', self.stats))
-        application.add_handler(CommandHandler('resend', self.resend))
+        application.add_handler(CommandHandler('resend', self.admitted(self.resend)))
         application.add_handler(CommandHandler(
-            'chat', self.prompt, filters=filters.ChatType.GROUP | filters.ChatType.SUPERGROUP)
+            'chat', self.admitted(self.prompt), filters=filters.ChatType.GROUP | filters.ChatType.SUPERGROUP)
         )
         application.add_handler(MessageHandler(
             filters.PHOTO | filters.Document.IMAGE,
-            self.vision))
+            self.admitted(self.vision)))
         application.add_handler(MessageHandler(
             filters.AUDIO | filters.VOICE | filters.Document.AUDIO |
             filters.VIDEO | filters.VIDEO_NOTE | filters.Document.VIDEO,
-            self.transcribe))
-        application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), self.prompt))
+            self.admitted(self.transcribe)))
+        application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), self.admitted(self.prompt)))
         application.add_handler(InlineQueryHandler(self.inline_query, chat_types=[
             constants.ChatType.GROUP, constants.ChatType.SUPERGROUP, constants.ChatType.PRIVATE
         ]))
-        application.add_handler(CallbackQueryHandler(self.handle_callback_inline_query))
+        application.add_handler(CallbackQueryHandler(self.stop_generation, pattern='^stop:'))
+        application.add_handler(CallbackQueryHandler(self.admitted(self.handle_callback_inline_query)))
+        application.add_handler(ChatMemberHandler(self.track_chat_members, ChatMemberHandler.ANY_CHAT_MEMBER))
 
         application.add_error_handler(error_handler)
+        return application
 
-        application.run_polling()
+    async def run_webhook(self, application: Application):
+        """
+        Receives updates through the webhook server until the process is stopped
+        """
+        async def enqueue(data: dict):
+            await application.update_queue.put(Update.de_json(data, application.bot))
+
+        webhook_url = self.config['webhook_url']
+        server = WebhookServer(
+            listen=self.config['webhook_listen'],
+            port=self.config['webhook_port'],
+            path=urlparse(webhook_url).path,
+            secret_token=self.config['webhook_secret_token'],
+            handler=enqueue
+        )
+        stop_event = asyncio.Event()
+        for stop_signal in (signal.SIGINT, signal.SIGTERM):
+            try:
+                asyncio.get_running_loop().add_signal_handler(stop_signal, stop_event.set)
+            except NotImplementedError:
+                pass
+
+        async with application:
+            await self.post_init(application)
+            await application.start()
+            await server.start()
+            try:
+                await application.bot.set_webhook(
+                    url=webhook_url,
+                    secret_token=self.config['webhook_secret_token'],
+                    allowed_updates=Update.ALL_TYPES
+                )
+            except TelegramError as e:
+                # The server keeps running, e.g. to test it locally with recorded updates
+                logging.error(f'Failed to register the webhook {webhook_url}: {str(e)}')
+            try:
+                await stop_event.wait()
+            finally:
+                await server.stop()
+                await application.stop()
+
+    def run(self):
+        """
+        Runs the bot indefinitely until the user presses Ctrl+C
+        """
+        application = self.build_application()
+        if self.config['webhook_url']:
+            if self.config['webhook_secret_token'] is None:
+                logging.warning('WEBHOOK_SECRET_TOKEN is not set, anyone knowing the webhook URL can send updates')
+            asyncio.run(self.run_webhook(application))
+        else:
+            application.run_polling(allowed_updates=Update.ALL_TYPES)
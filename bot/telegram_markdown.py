@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import re
+
+# Characters that must be escaped in Telegram MarkdownV2, see https://core.telegram.org/bots/api#markdownv2-style
+SPECIAL_CHARACTERS = re.compile(r'([_*\[\]()~`>#+\-=|{}.!\\])')
+CODE_SPECIAL_CHARACTERS = re.compile(r'([`\\])')
+URL_SPECIAL_CHARACTERS = re.compile(r'([)\\])')
+
+CODE_FENCE = '```'
+
+INLINE_PATTERN = re.compile(
+    r'(?P<escaped>\\[!-/:-@\[-`{-~])'
+    r'|`(?P<code>[^`\n]+)`'
+    r'|\[(?P<link_text>[^\]\n]+)\]\((?P<link_url>[^()\s]+)\)'
+    r'|\*\*\*(?P<bold_italic>(?=\S)[^\n]+?(?<=\S))\*\*\*'
+    r'|\*\*(?P<bold>(?=\S)[^\n]+?(?<=\S))\*\*'
+    r'|__(?P<bold_underscore>(?=\S)[^\n]+?(?<=\S))__'
+    r'|~~(?P<strikethrough>(?=\S)[^\n]+?(?<=\S))~~'
+    r'|\*(?P<italic>(?=[^\s*])[^*\n]+?(?<=\S))\*'
+    r'|(?<![\w\\])_(?P<italic_underscore>(?=[^\s_])[^_\n]+?(?<=\S))_(?!\w)'
+)
+HEADING_PATTERN = re.compile(r'^\s{0,3}#{1,6}\s+(.+?)\s*#*\s*$')
+BULLET_PATTERN = re.compile(r'^(\s*)[-*+]\s+(.*)$')
+QUOTE_PATTERN = re.compile(r'^>\s?(.*)$')
+LANGUAGE_PATTERN = re.compile(r'^[\w+#.-]*$')
+
+
+def escape_markdown_v2(text: str) -> str:
+    """
+    Escapes all MarkdownV2 special characters, so the text is displayed as is
+    """
+    return SPECIAL_CHARACTERS.sub(r'\\\1', text)
+
+
+def escape_code(text: str) -> str:
+    """
+    Escapes the characters that are not allowed in MarkdownV2 code entities
+    """
+    return CODE_SPECIAL_CHARACTERS.sub(r'\\\1', text)
+
+
+def to_markdown_v2(text: str) -> str:
+    """
+    Converts Markdown as written by the model into valid Telegram MarkdownV2.
+    Supported formatting (bold, italic, strikethrough, inline code, code blocks, links, headings,
+    lists and quotes) is translated, everything else is escaped. Unclosed code blocks are closed,
+    so partial answers can be sent while streaming.
+    :param text: The Markdown text
+    :return: The MarkdownV2 text
+    """
+    output = []
+    language = None
+    code_lines = []
+    for line in text.split('\n'):
+        stripped = line.strip()
+        if language is not None:
+            if stripped.startswith(CODE_FENCE) and stripped.strip('`') == '':
+                output.append(_code_block(language, code_lines))
+                language = None
+            else:
+                code_lines.append(line)
+            continue
+
+        if stripped.startswith(CODE_FENCE):
+            if len(stripped) > 2 * len(CODE_FENCE) and stripped.endswith(CODE_FENCE):
+                # Single line code block
+                output.append(_code_block('', [stripped[len(CODE_FENCE):-len(CODE_FENCE)]]))
+                continue
+            language = stripped[len(CODE_FENCE):].strip()
+            code_lines = []
+            continue
+
+        output.append(_line(line))
+
+    if language is not None:
+        output.append(_code_block(language, code_lines))
+    return '\n'.join(output)
+
+
+def _code_block(language: str, lines: list[str]) -> str:
+    code = '\n'.join(lines)
+    if not LANGUAGE_PATTERN.match(language):
+        language = ''
+    if len(code.strip()) == 0:
+        # An empty block is still shown, as an empty code block
+        return f'{CODE_FENCE}{language}\n{CODE_FENCE}'
+    return f'{CODE_FENCE}{language}\n{escape_code(code)}\n{CODE_FENCE}'
+
+
+def _line(line: str) -> str:
+    heading = HEADING_PATTERN.match(line)
+    if heading:
+        title = heading.group(1).replace('**', '').replace('__', '')
+        return f'*{_inline(title, frozenset(["bold"]))}*'
+
+    bullet = BULLET_PATTERN.match(line)
+    if bullet:
+        return f'{bullet.group(1)}• {_inline(bullet.group(2))}'
+
+    quote = QUOTE_PATTERN.match(line)
+    if quote:
+        return f'>{_inline(quote.group(1))}'
+
+    return _inline(line)
+
+
+def _inline(text: str, active: frozenset = frozenset()) -> str:
+    """
+    Converts the inline formatting of a single line.
+    :param text: The text to convert
+    :param active: The styles of the enclosing entities, which are not nested again
+    """
+    output = []
+    position = 0
+    for match in INLINE_PATTERN.finditer(text):
+        output.append(escape_markdown_v2(text[position:match.start()]))
+        position = match.end()
+        groups = match.groupdict()
+
+        if groups['escaped'] is not None:
+            output.append(escape_markdown_v2(groups['escaped'][1]))
+        elif groups['code'] is not None:
+            output.append(f'`{escape_code(groups["code"])}`')
+        elif groups['bold_italic'] is not None:
+            inner = groups['bold_italic']
+            output.append(_inline(f'**_{inner}_**', active))
+        elif groups['link_text'] is not None:
+            url = URL_SPECIAL_CHARACTERS.sub(r'\\\1', groups['link_url'])
+            output.append(f'[{_inline(groups["link_text"], active)}]({url})')
+        else:
+            for style, marker, group in (('bold', '*', 'bold'), ('bold', '*', 'bold_underscore'),
+                                         ('strikethrough', '~', 'strikethrough'),
+                                         ('italic', '_', 'italic'), ('italic', '_', 'italic_underscore')):
+                inner = groups[group]
+                if inner is None:
+                    continue
+                if style in active:
+                    output.append(_inline(inner, active))
+                else:
+                    output.append(f'{marker}{_inline(inner, active | {style})}{marker}')
+                break
+    output.append(escape_markdown_v2(text[position:]))
+    return ''.join(output)
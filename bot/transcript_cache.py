@@ -0,0 +1,42 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+
+from cache import SQLiteLRUCache
+
+
+@dataclass(frozen=True)
+class CachedTranscript:
+    """
+    A transcript along with the duration of the transcribed recording
+    """
+    transcript: str
+    duration: float  # in seconds
+
+
+class TranscriptCache:
+    """
+    A persistent cache of transcripts, so that forwarded recordings are only transcribed once
+    """
+
+    def __init__(self, path: str, max_size: int):
+        """
+        Initializes the cache, creating the database if needed.
+        :param path: The path of the database file
+        :param max_size: The maximum number of transcripts
+        """
+        self.cache = SQLiteLRUCache(path, 'transcripts', {'transcript': 'TEXT NOT NULL', 'duration': 'REAL NOT NULL'},
+                                    max_size)
+
+    async def get(self, key: str) -> CachedTranscript | None:
+        """
+        Returns the cached transcript for the key, if any
+        """
+        row = (await self.cache.get([key])).get(key)
+        return CachedTranscript(*row) if row is not None else None
+
+    async def set(self, key: str, transcript: str, duration: float):
+        """
+        Stores a transcript, evicting the least recently used ones if the cache is full
+        """
+        await self.cache.set({key: (transcript, duration)})
@@ -1,8 +1,17 @@
-import os.path
+import asyncio
+import copy
+import logging
+import os
 import pathlib
 import json
+import threading
 from datetime import date
 
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
 
 def year_month(date_str):
     # extract string of year-month from date, eg: '2023-03'
@@ -49,26 +58,97 @@ class UsageTracker:
         :param logs_dir: path to directory of usage logs, defaults to "usage_logs"
         """
         self.user_id = user_id
+        self.user_name = user_name
         self.logs_dir = logs_dir
         # path to usage file of given user
         self.user_file = f"{logs_dir}/{user_id}.json"
+        # identity of the loaded version of the usage file, to notice the updates of other workers
+        self.file_version = None
+        # number of updates not written to the usage file yet
+        self.pending_writes = 0
+        # serializes the writes of this process, the file lock serializes them across workers
+        self.write_lock = threading.Lock()
+        self.usage = self.new_usage()
+        self.reload()
+
+    def new_usage(self):
+        """Returns the usage of a user without any request"""
+        return {
+            "user_name": self.user_name,
+            "current_cost": {"day": 0.0, "month": 0.0, "all_time": 0.0, "last_update": str(date.today())},
+            "usage_history": {"chat_tokens": {}, "transcription_seconds": {}, "number_images": {}, "tts_characters": {},
+                              "vision_tokens": {}, "cached_vision_tokens": {}}
+        }
 
-        if os.path.isfile(self.user_file):
-            with open(self.user_file, "r") as file:
-                self.usage = json.load(file)
-            if 'vision_tokens' not in self.usage['usage_history']:
-                self.usage['usage_history']['vision_tokens'] = {}
-            if 'tts_characters' not in self.usage['usage_history']:
-                self.usage['usage_history']['tts_characters'] = {}
-        else:
-            # ensure directory exists
-            pathlib.Path(logs_dir).mkdir(exist_ok=True)
-            # create new dictionary for this user
-            self.usage = {
-                "user_name": user_name,
-                "current_cost": {"day": 0.0, "month": 0.0, "all_time": 0.0, "last_update": str(date.today())},
-                "usage_history": {"chat_tokens": {}, "transcription_seconds": {}, "number_images": {}, "tts_characters": {}, "vision_tokens":{}}
-            }
+    def reload(self):
+        """
+        Loads the usage from the usage log file if it changed since it was last loaded.
+        With several workers, the file may have been updated by another one.
+        """
+        if self.pending_writes > 0:
+            # the file does not have the latest updates of this process yet
+            return
+        try:
+            stat = os.stat(self.user_file)
+        except FileNotFoundError:
+            return
+        file_version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if file_version == self.file_version:
+            return
+        with open(self.user_file, "r") as file:
+            self.usage = json.load(file)
+        self.file_version = file_version
+        for key in ('vision_tokens', 'tts_characters', 'cached_vision_tokens'):
+            if key not in self.usage['usage_history']:
+                self.usage['usage_history'][key] = {}
+
+    def update(self, apply):
+        """
+        Applies an update to the usage, then to the usage log file.
+        From the event loop, the file is updated in a thread, as it may wait for other workers to release it.
+        :param apply: function updating the usage of the tracker it is given
+        """
+        apply(self)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.write(apply)
+            return
+        self.pending_writes += 1
+        loop.run_in_executor(None, self.write, apply).add_done_callback(self.__write_done)
+
+    def __write_done(self, future):
+        self.pending_writes -= 1
+        if future.exception() is not None:
+            logging.warning(f'Failed to write the usage log of user {self.user_id}: {str(future.exception())}')
+
+    def write(self, apply):
+        """
+        Applies an update to the usage log file. The latest file is loaded under an exclusive lock,
+        so that the updates made by other workers in the meantime are kept.
+        The file is replaced when written, so the lock is taken on a separate `.lock` file, which stays next to it.
+        :param apply: function updating the usage of the tracker it is given
+        """
+        # ensure directory exists
+        pathlib.Path(self.logs_dir).mkdir(exist_ok=True)
+        with self.write_lock, open(f"{self.user_file}.lock", "w") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                latest = copy.copy(self)
+                latest.file_version = None
+                latest.pending_writes = 0
+                latest.usage = self.new_usage()
+                latest.reload()
+                apply(latest)
+                # the file is replaced at once, so that it is never read while partially written
+                temp_file = f"{self.user_file}.tmp"
+                with open(temp_file, "w") as outfile:
+                    json.dump(latest.usage, outfile)
+                os.replace(temp_file, self.user_file)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
 
     # token usage functions:
 
@@ -77,27 +157,27 @@ class UsageTracker:
         :param tokens: total tokens used in last request
         :param tokens_price: price per 1000 tokens, defaults to 0.002
         """
-        today = date.today()
-        token_cost = round(float(tokens) * tokens_price / 1000, 6)
-        self.add_current_costs(token_cost)
-
-        # update usage_history
-        if str(today) in self.usage["usage_history"]["chat_tokens"]:
-            # add token usage to existing date
-            self.usage["usage_history"]["chat_tokens"][str(today)] += tokens
-        else:
-            # create new entry for current date
-            self.usage["usage_history"]["chat_tokens"][str(today)] = tokens
+        def apply(tracker):
+            today = date.today()
+            token_cost = round(float(tokens) * tokens_price / 1000, 6)
+            tracker.add_current_costs(token_cost)
+
+            # update usage_history
+            if str(today) in tracker.usage["usage_history"]["chat_tokens"]:
+                # add token usage to existing date
+                tracker.usage["usage_history"]["chat_tokens"][str(today)] += tokens
+            else:
+                # create new entry for current date
+                tracker.usage["usage_history"]["chat_tokens"][str(today)] = tokens
 
-        # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+        self.update(apply)
 
     def get_current_token_usage(self):
         """Get token amounts used for today and this month
 
         :return: total number of tokens used per day and per month
         """
+        self.reload()
         today = date.today()
         if str(today) in self.usage["usage_history"]["chat_tokens"]:
             usage_day = self.usage["usage_history"]["chat_tokens"][str(today)]
@@ -119,30 +199,30 @@ class UsageTracker:
         :param image_prices: prices for images of sizes ["256x256", "512x512", "1024x1024"],
                              defaults to [0.016, 0.018, 0.02]
         """
-        sizes = ["256x256", "512x512", "1024x1024"]
-        requested_size = sizes.index(image_size)
-        image_cost = image_prices[requested_size]
-        today = date.today()
-        self.add_current_costs(image_cost)
-
-        # update usage_history
-        if str(today) in self.usage["usage_history"]["number_images"]:
-            # add token usage to existing date
-            self.usage["usage_history"]["number_images"][str(today)][requested_size] += 1
-        else:
-            # create new entry for current date
-            self.usage["usage_history"]["number_images"][str(today)] = [0, 0, 0]
-            self.usage["usage_history"]["number_images"][str(today)][requested_size] += 1
+        def apply(tracker):
+            sizes = ["256x256", "512x512", "1024x1024"]
+            requested_size = sizes.index(image_size)
+            image_cost = image_prices[requested_size]
+            today = date.today()
+            tracker.add_current_costs(image_cost)
+
+            # update usage_history
+            if str(today) in tracker.usage["usage_history"]["number_images"]:
+                # add token usage to existing date
+                tracker.usage["usage_history"]["number_images"][str(today)][requested_size] += 1
+            else:
+                # create new entry for current date
+                tracker.usage["usage_history"]["number_images"][str(today)] = [0, 0, 0]
+                tracker.usage["usage_history"]["number_images"][str(today)][requested_size] += 1
 
-        # write updated image number to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+        self.update(apply)
 
     def get_current_image_count(self):
         """Get number of images requested for today and this month.
 
         :return: total number of images requested per day and per month
         """
+        self.reload()
         today = date.today()
         if str(today) in self.usage["usage_history"]["number_images"]:
             usage_day = sum(self.usage["usage_history"]["number_images"][str(today)])
@@ -163,27 +243,27 @@ class UsageTracker:
         :param tokens: total tokens used in last request
         :param vision_token_price: price per 1K tokens transcription, defaults to 0.01
         """
-        today = date.today()
-        token_price = round(tokens * vision_token_price / 1000, 2)
-        self.add_current_costs(token_price)
-
-        # update usage_history
-        if str(today) in self.usage["usage_history"]["vision_tokens"]:
-            # add requested seconds to existing date
-            self.usage["usage_history"]["vision_tokens"][str(today)] += tokens
-        else:
-            # create new entry for current date
-            self.usage["usage_history"]["vision_tokens"][str(today)] = tokens
+        def apply(tracker):
+            today = date.today()
+            token_price = round(tokens * vision_token_price / 1000, 2)
+            tracker.add_current_costs(token_price)
+
+            # update usage_history
+            if str(today) in tracker.usage["usage_history"]["vision_tokens"]:
+                # add requested seconds to existing date
+                tracker.usage["usage_history"]["vision_tokens"][str(today)] += tokens
+            else:
+                # create new entry for current date
+                tracker.usage["usage_history"]["vision_tokens"][str(today)] = tokens
 
-        # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+        self.update(apply)
 
     def get_current_vision_tokens(self):
         """Get vision tokens for today and this month.
 
         :return: total amount of vision tokens per day and per month
         """
+        self.reload()
         today = date.today()
         if str(today) in self.usage["usage_history"]["vision_tokens"]:
             tokens_day = self.usage["usage_history"]["vision_tokens"][str(today)]
@@ -196,38 +276,69 @@ class UsageTracker:
                 tokens_month += tokens
         return tokens_day, tokens_month
 
-    # tts usage functions:
+    def add_cached_vision_tokens(self, tokens, vision_token_price=0.01):
+        """
+        Adds the vision tokens of an answer reused from the cache to a users usage history and updates current cost.
+        They are kept apart from the vision tokens actually requested.
+        :param tokens: tokens used by the request whose answer was reused
+        :param vision_token_price: price per 1K tokens charged for reused answers, 0 if they are free
+        """
+        def apply(tracker):
+            today = date.today()
+            token_price = round(tokens * vision_token_price / 1000, 2)
+            tracker.add_current_costs(token_price)
 
-    def add_tts_request(self, text_length, tts_model, tts_prices):
-        tts_models = ['tts-1', 'tts-1-hd']
-        price = tts_prices[tts_models.index(tts_model)]
+            # update usage_history
+            history = tracker.usage["usage_history"]["cached_vision_tokens"]
+            history[str(today)] = history.get(str(today), 0) + tokens
+
+        self.update(apply)
+
+    def get_current_cached_vision_tokens(self):
+        """Get vision tokens of answers reused from the cache for today and this month.
+
+        :return: total amount of cached vision tokens per day and per month
+        """
+        self.reload()
         today = date.today()
-        tts_price = round(text_length * price / 1000, 2)
-        self.add_current_costs(tts_price)
+        history = self.usage["usage_history"]["cached_vision_tokens"]
+        tokens_day = history.get(str(today), 0)
+        month = str(today)[:7]  # year-month as string
+        tokens_month = sum(tokens for day, tokens in history.items() if day.startswith(month))
+        return tokens_day, tokens_month
 
-        if 'tts_characters' not in self.usage['usage_history']:
-            self.usage['usage_history']['tts_characters'] = {}
-        
-        if tts_model not in self.usage['usage_history']['tts_characters']:
-            self.usage['usage_history']['tts_characters'][tts_model] = {}
+    # tts usage functions:
 
-        # update usage_history
-        if str(today) in self.usage["usage_history"]["tts_characters"][tts_model]:
-            # add requested text length to existing date
-            self.usage["usage_history"]["tts_characters"][tts_model][str(today)] += text_length
-        else:
-            # create new entry for current date
-            self.usage["usage_history"]["tts_characters"][tts_model][str(today)] = text_length
+    def add_tts_request(self, text_length, tts_model, tts_prices):
+        def apply(tracker):
+            tts_models = ['tts-1', 'tts-1-hd']
+            price = tts_prices[tts_models.index(tts_model)]
+            today = date.today()
+            tts_price = round(text_length * price / 1000, 2)
+            tracker.add_current_costs(tts_price)
+
+            if 'tts_characters' not in tracker.usage['usage_history']:
+                tracker.usage['usage_history']['tts_characters'] = {}
+
+            if tts_model not in tracker.usage['usage_history']['tts_characters']:
+                tracker.usage['usage_history']['tts_characters'][tts_model] = {}
+
+            # update usage_history
+            if str(today) in tracker.usage["usage_history"]["tts_characters"][tts_model]:
+                # add requested text length to existing date
+                tracker.usage["usage_history"]["tts_characters"][tts_model][str(today)] += text_length
+            else:
+                # create new entry for current date
+                tracker.usage["usage_history"]["tts_characters"][tts_model][str(today)] = text_length
 
-        # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+        self.update(apply)
 
     def get_current_tts_usage(self):
         """Get length of speech generated for today and this month.
 
         :return: total amount of characters converted to speech per day and per month
         """
+        self.reload()
 
         tts_models = ['tts-1', 'tts-1-hd']
         today = date.today()
@@ -254,21 +365,20 @@ class UsageTracker:
         :param seconds: total seconds used in last request
         :param minute_price: price per minute transcription, defaults to 0.006
         """
-        today = date.today()
-        transcription_price = round(seconds * minute_price / 60, 2)
-        self.add_current_costs(transcription_price)
-
-        # update usage_history
-        if str(today) in self.usage["usage_history"]["transcription_seconds"]:
-            # add requested seconds to existing date
-            self.usage["usage_history"]["transcription_seconds"][str(today)] += seconds
-        else:
-            # create new entry for current date
-            self.usage["usage_history"]["transcription_seconds"][str(today)] = seconds
+        def apply(tracker):
+            today = date.today()
+            transcription_price = round(seconds * minute_price / 60, 2)
+            tracker.add_current_costs(transcription_price)
+
+            # update usage_history
+            if str(today) in tracker.usage["usage_history"]["transcription_seconds"]:
+                # add requested seconds to existing date
+                tracker.usage["usage_history"]["transcription_seconds"][str(today)] += seconds
+            else:
+                # create new entry for current date
+                tracker.usage["usage_history"]["transcription_seconds"][str(today)] = seconds
 
-        # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+        self.update(apply)
 
     def add_current_costs(self, request_cost):
         """
@@ -297,6 +407,7 @@ class UsageTracker:
 
         :return: total amount of time transcribed per day and per month (4 values)
         """
+        self.reload()
         today = date.today()
         if str(today) in self.usage["usage_history"]["transcription_seconds"]:
             seconds_day = self.usage["usage_history"]["transcription_seconds"][str(today)]
@@ -317,6 +428,7 @@ class UsageTracker:
 
         :return: cost of current day and month
         """
+        self.reload()
         today = date.today()
         last_update = date.fromisoformat(self.usage["current_cost"]["last_update"])
         if today == last_update:
@@ -1,18 +1,25 @@
 from __future__ import annotations
 
 import asyncio
-import itertools
-import json
 import logging
 import os
 import base64
 
 import telegram
-from telegram import Message, MessageEntity, Update, ChatMember, constants
+from telegram import InlineKeyboardMarkup, Message, MessageEntity, Update, constants
 from telegram.ext import CallbackContext, ContextTypes
 
+from access_policy import AccessPolicy
+from group_membership import GroupMembershipCache
+from message_chunker import MessageChunker
+from plugin_result import DirectResult
+from telegram_markdown import to_markdown_v2
 from usage_tracker import UsageTracker
 
+# Texts longer than Telegram's message limit (4096 UTF-16 code units) are sent by clients as several messages,
+# split on a word boundary shortly before the limit
+SPLIT_MESSAGE_MIN_LENGTH = 3900
+
 
 def message_text(message: Message) -> str:
     """
@@ -29,22 +36,6 @@ def message_text(message: Message) -> str:
     return message_txt if len(message_txt) > 0 else ''
 
 
-async def is_user_in_group(update: Update, context: CallbackContext, user_id: int) -> bool:
-    """
-    Checks if user_id is a member of the group
-    """
-    try:
-        chat_member = await context.bot.get_chat_member(update.message.chat_id, user_id)
-        return chat_member.status in [ChatMember.OWNER, ChatMember.ADMINISTRATOR, ChatMember.MEMBER]
-    except telegram.error.BadRequest as e:
-        if str(e) == "User not found":
-            return False
-        else:
-            raise e
-    except Exception as e:
-        raise e
-
-
 def get_thread_id(update: Update) -> int | None:
     """
     Gets the message thread id for the update, if any
@@ -54,18 +45,6 @@ def get_thread_id(update: Update) -> int | None:
     return None
 
 
-def get_stream_cutoff_values(update: Update, content: str) -> int:
-    """
-    Gets the stream cutoff values for the message length
-    """
-    if is_group_chat(update):
-        # group chats have stricter flood limits
-        return 180 if len(content) > 1000 else 120 if len(content) > 200 \
-            else 90 if len(content) > 50 else 50
-    return 90 if len(content) > 1000 else 45 if len(content) > 200 \
-        else 25 if len(content) > 50 else 15
-
-
 def is_group_chat(update: Update) -> bool:
     """
     Checks if the message was sent from a group chat
@@ -78,40 +57,41 @@ def is_group_chat(update: Update) -> bool:
     ]
 
 
-def split_into_chunks(text: str, chunk_size: int = 4096) -> list[str]:
+def merge_messages(texts: list[str]) -> str:
     """
-    Splits a string into chunks of a given size.
+    Merges the texts of consecutive messages. The parts of a long text split by Telegram are joined as they are,
+    other messages start on a new line.
     """
-    return [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+    merged = texts[0]
+    for previous, text in zip(texts, texts[1:]):
+        is_split = len(previous.encode('utf-16-le')) // 2 >= SPLIT_MESSAGE_MIN_LENGTH
+        merged += ('' if is_split else '\n') + text
+    return merged
 
 
-async def wrap_with_indicator(update: Update, context: CallbackContext, coroutine,
-                              chat_action: constants.ChatAction = "", is_inline=False):
+def split_into_chunks(text: str, chunk_size: int = 4096) -> list[str]:
     """
-    Wraps a coroutine while repeatedly sending a chat action to the user.
+    Splits a string into chunks of a given size, preferring paragraph and line boundaries
+    and keeping code blocks intact across chunks.
     """
-    task = context.application.create_task(coroutine(), update=update)
-    while not task.done():
-        if not is_inline:
-            context.application.create_task(
-                update.effective_chat.send_action(chat_action, message_thread_id=get_thread_id(update))
-            )
-        try:
-            await asyncio.wait_for(asyncio.shield(task), 4.5)
-        except asyncio.TimeoutError:
-            pass
+    return MessageChunker(chunk_size).split(text)
 
 
 async def edit_message_with_retry(context: ContextTypes.DEFAULT_TYPE, chat_id: int | None,
-                                  message_id: str, text: str, markdown: bool = True, is_inline: bool = False):
+                                  message_id: str, text: str, markdown: bool = True, is_inline: bool = False,
+                                  rate_limit_args: dict | None = None,
+                                  reply_markup: InlineKeyboardMarkup | None = None):
     """
-    Edit a message with retry logic in case of failure (e.g. broken markdown)
+    Edit a message with retry logic in case of failure.
+    Markdown is converted to MarkdownV2 locally, the plain text retry is only a safety net.
     :param context: The context to use
     :param chat_id: The chat id to edit the message in
     :param message_id: The message id to edit
     :param text: The text to edit the message with
     :param markdown: Whether to use markdown parse mode
     :param is_inline: Whether the message to edit is an inline message
+    :param rate_limit_args: Optional arguments for the rate limiter (e.g. the request priority)
+    :param reply_markup: The inline keyboard to show, if any (editing without one removes it)
     :return: None
     """
     try:
@@ -119,18 +99,25 @@ async def edit_message_with_retry(context: ContextTypes.DEFAULT_TYPE, chat_id: i
             chat_id=chat_id,
             message_id=int(message_id) if not is_inline else None,
             inline_message_id=message_id if is_inline else None,
-            text=text,
-            parse_mode=constants.ParseMode.MARKDOWN if markdown else None,
+            text=to_markdown_v2(text) if markdown else text,
+            parse_mode=constants.ParseMode.MARKDOWN_V2 if markdown else None,
+            rate_limit_args=rate_limit_args,
+            reply_markup=reply_markup,
         )
     except telegram.error.BadRequest as e:
         if str(e).startswith("Message is not modified"):
             return
+        if not markdown:
+            raise e
+        logging.warning(f'Failed to edit message with markdown, retrying as plain text: {str(e)}')
         try:
             await context.bot.edit_message_text(
                 chat_id=chat_id,
                 message_id=int(message_id) if not is_inline else None,
                 inline_message_id=message_id if is_inline else None,
                 text=text,
+                rate_limit_args=rate_limit_args,
+                reply_markup=reply_markup,
             )
         except Exception as e:
             logging.warning(f'Failed to edit message: {str(e)}')
@@ -141,6 +128,33 @@ async def edit_message_with_retry(context: ContextTypes.DEFAULT_TYPE, chat_id: i
         raise e
 
 
+def retry_after_seconds(error: telegram.error.RetryAfter) -> float:
+    """
+    Returns the number of seconds to wait as requested by a flood control error
+    """
+    retry_after = error.retry_after
+    if hasattr(retry_after, 'total_seconds'):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+async def reply_text_markdown(message: Message, text: str, **kwargs) -> Message:
+    """
+    Replies to a message with the text converted to MarkdownV2, falling back to plain text
+    if Telegram still rejects it
+    :param message: The message to reply to
+    :param text: The Markdown text to send
+    :param kwargs: Additional arguments for `reply_text`
+    :return: The sent message
+    """
+    try:
+        return await message.reply_text(text=to_markdown_v2(text), parse_mode=constants.ParseMode.MARKDOWN_V2,
+                                         **kwargs)
+    except telegram.error.BadRequest as e:
+        logging.warning(f'Failed to send message with markdown, retrying as plain text: {str(e)}')
+        return await message.reply_text(text=text, **kwargs)
+
+
 async def error_handler(_: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Handles errors in the telegram-python-bot library.
@@ -148,142 +162,74 @@ async def error_handler(_: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logging.error(f'Exception while handling an update: {context.error}')
 
 
-async def is_allowed(config, update: Update, context: CallbackContext, is_inline=False) -> bool:
+async def is_allowed(access_policy: AccessPolicy, update: Update, context: CallbackContext, is_inline=False,
+                     group_membership: GroupMembershipCache | None = None) -> bool:
     """
     Checks if the user is allowed to use the bot.
+    :param is_inline: Whether the update is an inline query or the callback of an inline message
     """
-    if config['allowed_user_ids'] == '*':
-        return True
-
-    user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
-    if is_admin(config, user_id):
-        return True
-    name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
-    allowed_user_ids = config['allowed_user_ids'].split(',')
-    # Check if user is allowed
-    if str(user_id) in allowed_user_ids:
+    user_id = update.effective_user.id if is_inline else update.message.from_user.id
+    if access_policy.is_allowed_user(user_id):
         return True
     # Check if it's a group a chat with at least one authorized member
     if not is_inline and is_group_chat(update):
-        admin_user_ids = config['admin_user_ids'].split(',')
-        for user in itertools.chain(allowed_user_ids, admin_user_ids):
-            if not user.strip():
-                continue
-            if await is_user_in_group(update, context, user):
-                logging.info(f'{user} is a member. Allowing group chat message...')
-                return True
+        group_membership = group_membership or GroupMembershipCache(ttl=0)
+        if await group_membership.is_authorized(context.bot, update.message.chat_id, access_policy.group_member_ids):
+            return True
+        name = update.message.from_user.name
         logging.info(f'Group chat messages from user {name} '
                      f'(id: {user_id}) are not allowed')
     return False
 
 
-def is_admin(config, user_id: int, log_no_admin=False) -> bool:
-    """
-    Checks if the user is the admin of the bot.
-    The first user in the user list is the admin.
-    """
-    if config['admin_user_ids'] == '-':
-        if log_no_admin:
-            logging.info('No admin user defined.')
-        return False
-
-    admin_user_ids = config['admin_user_ids'].split(',')
-
-    # Check if user is in the admin user list
-    if str(user_id) in admin_user_ids:
-        return True
-
-    return False
-
-
-def get_user_budget(config, user_id) -> float | None:
-    """
-    Get the user's budget based on their user ID and the bot configuration.
-    :param config: The bot configuration object
-    :param user_id: User id
-    :return: The user's budget as a float, or None if the user is not found in the allowed user list
-    """
-
-    # no budget restrictions for admins and '*'-budget lists
-    if is_admin(config, user_id) or config['user_budgets'] == '*':
-        return float('inf')
-
-    user_budgets = config['user_budgets'].split(',')
-    if config['allowed_user_ids'] == '*':
-        # same budget for all users, use value in first position of budget list
-        if len(user_budgets) > 1:
-            logging.warning('multiple values for budgets set with unrestricted user list '
-                            'only the first value is used as budget for everyone.')
-        return float(user_budgets[0])
-
-    allowed_user_ids = config['allowed_user_ids'].split(',')
-    if str(user_id) in allowed_user_ids:
-        user_index = allowed_user_ids.index(str(user_id))
-        if len(user_budgets) <= user_index:
-            logging.warning(f'No budget set for user id: {user_id}. Budget list shorter than user list.')
-            return 0.0
-        return float(user_budgets[user_index])
-    return None
-
-
-def get_remaining_budget(config, usage, update: Update, is_inline=False) -> float:
+def get_remaining_budget(access_policy: AccessPolicy, usage, update: Update, is_inline=False) -> float:
     """
     Calculate the remaining budget for a user based on their current usage.
-    :param config: The bot configuration object
+    :param access_policy: The access and budget policy
     :param usage: The usage tracker object
     :param update: Telegram update object
     :param is_inline: Boolean flag for inline queries
     :return: The remaining budget for the user as a float
     """
-    # Mapping of budget period to cost period
-    budget_cost_map = {
-        "monthly": "cost_month",
-        "daily": "cost_today",
-        "all-time": "cost_all_time"
-    }
-
-    user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
-    name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
+    user_id = update.effective_user.id if is_inline else update.message.from_user.id
+    name = update.effective_user.name if is_inline else update.message.from_user.name
     if user_id not in usage:
         usage[user_id] = UsageTracker(user_id, name)
 
     # Get budget for users
-    user_budget = get_user_budget(config, user_id)
-    budget_period = config['budget_period']
+    user_budget = access_policy.user_budget(user_id)
     if user_budget is not None:
-        cost = usage[user_id].get_current_cost()[budget_cost_map[budget_period]]
+        if user_budget == float('inf'):
+            return user_budget
+        cost = usage[user_id].get_current_cost()[access_policy.cost_period()]
         return user_budget - cost
 
     # Get budget for guests
     if 'guests' not in usage:
         usage['guests'] = UsageTracker('guests', 'all guest users in group chats')
-    cost = usage['guests'].get_current_cost()[budget_cost_map[budget_period]]
-    return config['guest_budget'] - cost
+    cost = usage['guests'].get_current_cost()[access_policy.cost_period()]
+    return access_policy.guest_budget - cost
 
 
-def is_within_budget(config, usage, update: Update, is_inline=False) -> bool:
+def is_within_budget(access_policy: AccessPolicy, usage, update: Update, is_inline=False) -> bool:
     """
     Checks if the user reached their usage limit.
     Initializes UsageTracker for user and guest when needed.
-    :param config: The bot configuration object
+    :param access_policy: The access and budget policy
     :param usage: The usage tracker object
     :param update: Telegram update object
     :param is_inline: Boolean flag for inline queries
     :return: Boolean indicating if the user has a positive budget
     """
-    user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
-    name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
-    if user_id not in usage:
-        usage[user_id] = UsageTracker(user_id, name)
-    remaining_budget = get_remaining_budget(config, usage, update, is_inline=is_inline)
-    return remaining_budget > 0
+    return get_remaining_budget(access_policy, usage, update, is_inline=is_inline) > 0
 
 
-def add_chat_request_to_usage_tracker(usage, config, user_id, used_tokens):
+def add_chat_request_to_usage_tracker(usage, config, access_policy: AccessPolicy, user_id, used_tokens):
     """
     Add chat request to usage tracker
     :param usage: The usage tracker object
     :param config: The bot configuration object
+    :param access_policy: The access and budget policy
     :param user_id: The user id
     :param used_tokens: The number of tokens used
     """
@@ -294,8 +240,7 @@ def add_chat_request_to_usage_tracker(usage, config, user_id, used_tokens):
         # add chat request to users usage tracker
         usage[user_id].add_chat_tokens(used_tokens, config['token_price'])
         # add guest chat request to guest usage tracker
-        allowed_user_ids = config['allowed_user_ids'].split(',')
-        if str(user_id) not in allowed_user_ids and 'guests' in usage:
+        if access_policy.is_guest(user_id) and 'guests' in usage:
             usage["guests"].add_chat_tokens(used_tokens, config['token_price'])
     except Exception as e:
         logging.warning(f'Failed to add tokens to usage_logs: {str(e)}')
@@ -314,33 +259,13 @@ def get_reply_to_message_id(config, update: Update):
     return None
 
 
-def is_direct_result(response: any) -> bool:
-    """
-    Checks if the dict contains a direct result that can be sent directly to the user
-    :param response: The response value
-    :return: Boolean indicating if the result is a direct result
-    """
-    if type(response) is not dict:
-        try:
-            json_response = json.loads(response)
-            return json_response.get('direct_result', False)
-        except:
-            return False
-    else:
-        return response.get('direct_result', False)
-
-
-async def handle_direct_result(config, update: Update, response: any):
+async def handle_direct_result(config, update: Update, result: DirectResult):
     """
     Handles a direct result from a plugin
     """
-    if type(response) is not dict:
-        response = json.loads(response)
-
-    result = response['direct_result']
-    kind = result['kind']
-    format = result['format']
-    value = result['value']
+    kind = result.kind
+    format = result.format
+    value = result.value
 
     common_args = {
         'message_thread_id': get_thread_id(update),
@@ -361,31 +286,36 @@ async def handle_direct_result(config, update: Update, response: any):
         await update.effective_message.reply_dice(**common_args, emoji=value)
 
     if format == 'path':
-        cleanup_intermediate_files(response)
+        cleanup_intermediate_files(result)
 
 
-def cleanup_intermediate_files(response: any):
+def cleanup_intermediate_files(result: DirectResult):
     """
     Deletes intermediate files created by plugins
     """
-    if type(response) is not dict:
-        response = json.loads(response)
+    if result.format == 'path':
+        if os.path.exists(result.value):
+            os.remove(result.value)
 
-    result = response['direct_result']
-    format = result['format']
-    value = result['value']
 
-    if format == 'path':
-        if os.path.exists(value):
-            os.remove(value)
-
-
-# Function to encode the image
-def encode_image(fileobj):
-    image = base64.b64encode(fileobj.getvalue()).decode('utf-8')
-    return f'data:image/jpeg;base64,{image}'
+def encode_image(image: bytes, mime_type: str = 'image/jpeg') -> str:
+    """
+    Encodes an image as a data URL
+    """
+    return f'data:{mime_type};base64,{base64.b64encode(image).decode("utf-8")}'
 
 
-def decode_image(imgbase64):
-    image = imgbase64[len('data:image/jpeg;base64,'):]
-    return base64.b64decode(image)
+async def gather_or_cancel(*coroutines) -> list:
+    """
+    Runs coroutines concurrently and returns their results in order.
+    As soon as one of them fails, the others are cancelled instead of being left running in the background.
+    """
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        if len(pending) > 0:
+            await asyncio.wait(pending)
@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import asyncio
+import hmac
+import json
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+# Maximum size of an update, Telegram updates are a few kilobytes at most
+MAX_BODY_SIZE = 1024 * 1024
+
+# Number of recent update ids remembered to detect redeliveries
+RECENT_UPDATES_SIZE = 10000
+
+# Seconds an idle keep-alive connection is kept open
+KEEP_ALIVE_TIMEOUT = 60
+
+SECRET_TOKEN_HEADER = 'x-telegram-bot-api-secret-token'
+
+STATUS_TEXTS = {
+    200: 'OK',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    411: 'Length Required',
+    413: 'Payload Too Large',
+}
+
+
+class WebhookServer:
+    """
+    A minimal HTTP server receiving updates from Telegram's webhook.
+    Requests are validated against the secret token, redelivered updates are ignored and every
+    accepted update is handed to the handler, which should only enqueue it, before answering 200.
+    """
+
+    def __init__(self, listen: str, port: int, path: str, secret_token: str | None,
+                 handler: Callable[[dict], Awaitable[None]]):
+        """
+        Initializes the server.
+        :param listen: The address to listen on
+        :param port: The port to listen on
+        :param path: The URL path updates are posted to
+        :param secret_token: The secret token Telegram sends with every update, or None to accept all requests
+        :param handler: Coroutine function called with each new update as a dictionary
+        """
+        self.listen = listen
+        self.port = port
+        self.path = '/' + path.strip('/')
+        self.secret_token = secret_token
+        self.handler = handler
+        self.recent_update_ids = OrderedDict()
+        self.connections = {}  # {writer: task serving the connection}
+        self.server: asyncio.AbstractServer | None = None
+
+        # Stats
+        self.updates_received = 0
+        self.duplicates_ignored = 0
+        self.requests_rejected = 0
+
+    async def start(self):
+        """
+        Starts listening for updates
+        """
+        self.server = await asyncio.start_server(self.__handle_connection, self.listen, self.port)
+        logging.info(f'Webhook server listening on {self.listen}:{self.port}{self.path}')
+
+    async def stop(self):
+        """
+        Stops listening and closes the server
+        """
+        if self.server is None:
+            return
+        self.server.close()
+        for writer in list(self.connections):
+            writer.close()
+        await asyncio.gather(*self.connections.values(), return_exceptions=True)
+        await self.server.wait_closed()
+        self.server = None
+        logging.info(f'Webhook server stopped: {self.updates_received} updates received, '
+                     f'{self.duplicates_ignored} duplicates ignored, {self.requests_rejected} requests rejected')
+
+    def is_duplicate(self, update_id: int) -> bool:
+        """
+        Remembers the update id and returns whether it was already seen recently
+        """
+        if update_id in self.recent_update_ids:
+            self.recent_update_ids.move_to_end(update_id)
+            return True
+        self.recent_update_ids[update_id] = None
+        if len(self.recent_update_ids) > RECENT_UPDATES_SIZE:
+            self.recent_update_ids.popitem(last=False)
+        return False
+
+    async def __handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Serves the requests of a connection until the client closes it
+        """
+        self.connections[writer] = asyncio.current_task()
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), timeout=KEEP_ALIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                status, keep_alive = await self.__handle_request(request_line, reader)
+                self.__respond(writer, status, keep_alive)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError) as e:
+            logging.debug(f'Webhook connection closed: {str(e)}')
+        finally:
+            self.connections.pop(writer, None)
+            writer.close()
+
+    async def __handle_request(self, request_line: bytes, reader: asyncio.StreamReader) -> tuple[int, bool]:
+        """
+        Reads a request and handles the update in its body.
+        :return: The HTTP status code and whether the connection can be kept open
+        """
+        parts = request_line.decode('latin-1').split()
+        if len(parts) != 3:
+            return 400, False
+        method, target, version = parts
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+        if 'content-length' not in headers:
+            return (411 if method == 'POST' else 405), False
+        try:
+            content_length = int(headers['content-length'])
+        except ValueError:
+            return 400, False
+        if content_length < 0:
+            return 400, False
+        if content_length > MAX_BODY_SIZE:
+            return 413, False
+        body = await reader.readexactly(content_length)
+
+        if method != 'POST':
+            return 405, keep_alive
+        if target.split('?', 1)[0].rstrip('/') != self.path.rstrip('/'):
+            return 404, keep_alive
+        if self.secret_token is not None and \
+                not hmac.compare_digest(headers.get(SECRET_TOKEN_HEADER, ''), self.secret_token):
+            self.requests_rejected += 1
+            logging.warning('Rejected webhook request with an invalid secret token')
+            return 403, keep_alive
+
+        try:
+            update = json.loads(body)
+            update_id = int(update['update_id'])
+        except (ValueError, TypeError, KeyError):
+            self.requests_rejected += 1
+            return 400, keep_alive
+
+        if self.is_duplicate(update_id):
+            self.duplicates_ignored += 1
+            logging.info(f'Ignoring redelivered update {update_id}')
+            return 200, keep_alive
+
+        self.updates_received += 1
+        try:
+            await self.handler(update)
+        except Exception as e:
+            # Answering with an error would only make Telegram redeliver an update that cannot be handled
+            logging.exception(f'Failed to enqueue update {update_id}: {str(e)}')
+        return 200, keep_alive
+
+    @staticmethod
+    def __respond(writer: asyncio.StreamWriter, status: int, keep_alive: bool):
+        body = STATUS_TEXTS[status].encode()
+        writer.write(
+            f'HTTP/1.1 {status} {STATUS_TEXTS[status]}\r\n'
+            f'Content-Type: text/plain\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            f'Connection: {"keep-alive" if keep_alive else "close"}\r\n'
+            f'\r\n'.encode() + body
+        )
@@ -0,0 +1,17 @@
+from telegram_markdown import to_markdown_v2
+
+
+def test_code_block():
+    assert to_markdown_v2('```python\nprint("a`b")\n```') == '```python\nprint("a\\`b")\n```'
+
+
+def test_empty_code_block():
+    assert to_markdown_v2('before\n```\n```\nafter') == 'before\n```\n```\nafter'
+
+
+def test_blank_code_block_keeps_its_language():
+    assert to_markdown_v2('```python\n  \n\n```') == '```python\n```'
+
+
+def test_unclosed_empty_code_block():
+    assert to_markdown_v2('code:\n```') == 'code:\n```\n```'